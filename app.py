@@ -1,11 +1,14 @@
 import os
 import csv
 import io
+import hashlib
+import threading
+import time
 
 from flask_sqlalchemy import SQLAlchemy
-from models import db, Member, Strength, PromotionRule, DefaultCardCount, HandicapRule, Match, MatchResult, GradeHistory, MatchCardState, TodayParticipant, PromotionCounterReset, Setting, InitialAssessmentResult
+from models import db, Member, Strength, PromotionRule, DefaultCardCount, HandicapRule, Match, MatchResult, GradeHistory, MatchCardState, PromotionCounterReset, Setting, InitialAssessmentResult
 from models import MatchMemo, GradeHistory, ActivityOutsideRecord, BlindCount, Club, OwnerAuditLog, Owner
-from forms import MemberForm, StrengthCountForm, DefaultCardCountForm
+from forms import MemberForm, StrengthCountForm, DefaultCardCountForm, AttendanceRetentionForm
 from flask import session, abort
 from flask import send_file
 from flask import request, redirect, url_for
@@ -13,28 +16,29 @@ from flask_wtf import FlaskForm
 from wtforms import StringField
 from flask import Flask, render_template, request, redirect, session, url_for, jsonify, flash
 from datetime import datetime, date, timedelta
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, object_session
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.sql import case
-from sqlalchemy import Integer, desc, cast, not_
-from sqlalchemy import and_, or_
+from sqlalchemy import desc
+from sqlalchemy import and_, or_, false, bindparam
 from zoneinfo import ZoneInfo
 import traceback
 from flask_migrate import Migrate
 from types import SimpleNamespace
 from werkzeug.security import generate_password_hash, check_password_hash
 import secrets, string, zipfile, tempfile
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
+from PIL import ImageDraw
 try:
     import qrcode
 except Exception:
     qrcode = None  # ライブラリ未導入でもアプリが落ちないように
-from pathlib import Path
+from qr_render import get_jp_font as _get_jp_font, render_qr_labels
 from sqlalchemy.exc import IntegrityError
 from types import SimpleNamespace
 import json
+import click
 from flask import g
-from sqlalchemy import event, Integer, case, func
+from sqlalchemy import event, case, func
 from wtforms.validators import DataRequired, Length
 
 JST = ZoneInfo("Asia/Tokyo")
@@ -94,6 +98,355 @@ db.init_app(app)
 # マイグレーション初期化
 migrate = Migrate(app, db)
 
+# --- サーバーサイド・セッション ---
+# 署名付きCookieに参加者IDリスト等を丸ごと載せると 4KB 上限に近づくため、
+# Cookie には不透明な sid だけを載せ、中身はサーバー側（DB or ファイル）に保存します。
+#   SESSION_BACKEND=db（既定） / filesystem / cookie（従来どおり署名付きCookie）
+#   SESSION_FILE_DIR: filesystem 時の保存先（既定: database/sessions）
+#   SESSION_LIFETIME_DAYS: 有効期限（既定: 14日。アクセスのたびに延長）
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+
+app.config.setdefault("SESSION_BACKEND", os.environ.get("SESSION_BACKEND", "db").lower())
+app.config.setdefault("SESSION_FILE_DIR", os.environ.get("SESSION_FILE_DIR") or os.path.join(_basedir, "database", "sessions"))
+app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=int(os.environ.get("SESSION_LIFETIME_DAYS", "14")))
+
+
+class LazyServerSession(dict, SessionMixin):
+    """sid だけ持って生成し、最初に中身へ触れたときにストアから読み込むセッション"""
+
+    def __init__(self, sid, loader=None, new=False):
+        super().__init__()
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self._loader = loader
+        self._loaded = loader is None
+        self.expires_at = None  # ストア上の有効期限（延長判定に使う）
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._loaded = True
+            loaded = self._loader(self.sid) if self._loader else None
+            if loaded is None:
+                # 期限切れ/存在しない sid は新規扱い（固定化攻撃対策で sid も振り直す）
+                self.sid = _new_session_sid()
+                self.new = True
+            else:
+                data, self.expires_at = loaded
+                dict.update(self, data)
+        self.accessed = True
+
+    # --- 読み取り系 ---
+    def __getitem__(self, key):
+        self._ensure_loaded()
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._ensure_loaded()
+        return super().__contains__(key)
+
+    def __iter__(self):
+        self._ensure_loaded()
+        return super().__iter__()
+
+    def __len__(self):
+        self._ensure_loaded()
+        return super().__len__()
+
+    def get(self, key, default=None):
+        self._ensure_loaded()
+        return super().get(key, default)
+
+    def keys(self):
+        self._ensure_loaded()
+        return super().keys()
+
+    def items(self):
+        self._ensure_loaded()
+        return super().items()
+
+    def values(self):
+        self._ensure_loaded()
+        return super().values()
+
+    # --- 書き込み系 ---
+    def __setitem__(self, key, value):
+        self._ensure_loaded()
+        self.modified = True
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._ensure_loaded()
+        self.modified = True
+        super().__delitem__(key)
+
+    def pop(self, key, *default):
+        self._ensure_loaded()
+        self.modified = True
+        return super().pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        self._ensure_loaded()
+        self.modified = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._ensure_loaded()
+        self.modified = True
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self._ensure_loaded()
+        self.modified = True
+        super().clear()
+
+    def regenerate(self):
+        """ログイン/ログアウト時に sid を振り直す（セッション固定化対策）"""
+        self._ensure_loaded()
+        if not self.new:
+            self.old_sid = self.sid
+        self.sid = _new_session_sid()
+        self.new = True
+        self.modified = True
+
+
+def _new_session_sid() -> str:
+    return secrets.token_urlsafe(32)
+
+
+class _DbSessionStore:
+    """server_session テーブルに JSON で保存（複数ワーカー/複数台で共有可）"""
+
+    def load(self, sid):
+        from models import ServerSession
+        t = ServerSession.__table__
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(t.c.data, t.c.expires_at).where(t.c.sid == sid)
+            ).first()
+        if not row or row.expires_at <= datetime.utcnow():
+            return None
+        try:
+            return json.loads(row.data or "{}"), row.expires_at
+        except ValueError:
+            return None
+
+    def save(self, sid, data, expires_at):
+        from models import ServerSession
+        t = ServerSession.__table__
+        payload = json.dumps(data, ensure_ascii=False)
+        # リクエスト側の db.session とは独立したトランザクションで書く
+        with db.engine.begin() as conn:
+            res = conn.execute(
+                t.update().where(t.c.sid == sid).values(data=payload, expires_at=expires_at)
+            )
+            if res.rowcount == 0:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(t.insert().values(sid=sid, data=payload, expires_at=expires_at))
+                except IntegrityError:
+                    conn.execute(
+                        t.update().where(t.c.sid == sid).values(data=payload, expires_at=expires_at)
+                    )
+
+    def touch(self, sid, expires_at):
+        from models import ServerSession
+        t = ServerSession.__table__
+        with db.engine.begin() as conn:
+            conn.execute(t.update().where(t.c.sid == sid).values(expires_at=expires_at))
+
+    def delete(self, sid):
+        from models import ServerSession
+        t = ServerSession.__table__
+        with db.engine.begin() as conn:
+            conn.execute(t.delete().where(t.c.sid == sid))
+
+    def sweep(self, now):
+        from models import ServerSession
+        t = ServerSession.__table__
+        with db.engine.begin() as conn:
+            return conn.execute(t.delete().where(t.c.expires_at <= now)).rowcount or 0
+
+
+class _FileSessionStore:
+    """1セッション = 1ファイル（単一サーバー運用向け）。expires_at はファイル内に持つ"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, sid):
+        # sid は token_urlsafe なので英数と -_ のみ。念のためパス区切りを排除
+        safe = "".join(ch for ch in sid if ch.isalnum() or ch in "-_")
+        return os.path.join(self.directory, f"{safe}.json")
+
+    def load(self, sid):
+        try:
+            with open(self._path(sid), "r", encoding="utf-8") as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            expires_at = datetime.fromisoformat(obj.get("expires_at"))
+        except (TypeError, ValueError):
+            return None
+        if expires_at <= datetime.utcnow():
+            return None
+        return obj.get("data") or {}, expires_at
+
+    def save(self, sid, data, expires_at):
+        path = self._path(sid)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"expires_at": expires_at.isoformat(), "data": data}, f, ensure_ascii=False)
+        os.replace(tmp, path)  # 途中状態のファイルを読ませない
+
+    def touch(self, sid, expires_at):
+        loaded = self.load(sid)
+        if loaded is not None:
+            self.save(sid, loaded[0], expires_at)
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except OSError:
+            pass
+
+    def sweep(self, now):
+        removed = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    exp = datetime.fromisoformat(json.load(f).get("expires_at"))
+            except (OSError, ValueError, TypeError):
+                exp = None
+            if exp is None or exp <= now:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Cookie には署名付き sid のみを載せ、中身は store に保存する"""
+
+    # 期限切れ掃除の間隔（ワーカーごと）。毎リクエストではなく時々だけ走らせる
+    SWEEP_INTERVAL = timedelta(minutes=10)
+    # 中身が変わっていなくても、この間隔を過ぎたら有効期限を延長する
+    TOUCH_INTERVAL = timedelta(hours=1)
+
+    def __init__(self, store):
+        self.store = store
+        self._last_sweep = None
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="server-session")
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode("ascii")
+                # 中身は最初のアクセス時に読み込む（静的ファイル等では DB に触れない）
+                return LazyServerSession(sid, loader=self.store.load)
+            except BadSignature:
+                pass
+        return LazyServerSession(_new_session_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        self._maybe_sweep()
+
+        old_sid = getattr(session, "old_sid", None)
+        if old_sid:
+            self.store.delete(old_sid)
+
+        # 一度も触れていないセッションは何もしない（Cookie もそのまま）
+        if not session._loaded:
+            return
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=self.get_cookie_secure(app),
+                                       samesite=self.get_cookie_samesite(app),
+                                       httponly=self.get_cookie_httponly(app))
+            return
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        now = datetime.utcnow()
+        expires_at = now + app.permanent_session_lifetime
+        if session.modified or session.new:
+            self.store.save(session.sid, dict(session), expires_at)
+        elif self._should_touch(session, expires_at):
+            self.store.touch(session.sid, expires_at)
+        else:
+            return
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid.encode("ascii")).decode("ascii"),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def _should_touch(self, session, expires_at):
+        # 読むだけのリクエストで毎回書き込まないよう、前回延長から一定時間経った時だけ延長する
+        if session.expires_at is None:
+            return True
+        return expires_at - session.expires_at >= self.TOUCH_INTERVAL
+
+    def _maybe_sweep(self):
+        now = datetime.utcnow()
+        if self._last_sweep and now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        try:
+            self.store.sweep(now)
+        except Exception:
+            app.logger.exception("server session sweep failed")
+
+
+if app.config["SESSION_BACKEND"] == "db":
+    app.session_interface = ServerSideSessionInterface(_DbSessionStore())
+elif app.config["SESSION_BACKEND"] == "filesystem":
+    app.session_interface = ServerSideSessionInterface(_FileSessionStore(app.config["SESSION_FILE_DIR"]))
+# "cookie" の場合は Flask 標準の署名付きCookieセッションのまま
+
+
+def regenerate_session_id():
+    """サーバーサイド・セッション時のみ sid を振り直す（Cookie セッションでは何もしない）"""
+    if isinstance(session, LazyServerSession):
+        session.regenerate()
+
+
+@app.cli.command("sweep-sessions")
+def sweep_sessions_command():
+    """期限切れのサーバーサイド・セッションを削除する（cron 等から実行）"""
+    iface = app.session_interface
+    if not isinstance(iface, ServerSideSessionInterface):
+        print("SESSION_BACKEND=cookie のため対象なし")
+        return
+    removed = iface.store.sweep(datetime.utcnow())
+    print(f"removed {removed} expired sessions")
+
 # --- 勝敗記号の正規化ユーティリティ ---
 # 人が手で入力した「〇/○/◯」の混在を最小限で吸収します。
 # 設計上の正規の記号は「○ / ● / △ / ◇ / ◆」です（未認定者の扱いもこれで統一）。
@@ -199,34 +552,103 @@ app.jinja_env.globals.update(
     jst_today_str=jst_today_str,
 )
 
-# --- DB方言に応じて「member_code が数字だけ」を判定する式を返すヘルパ ---
-def expr_member_code_is_numeric():
+# --- member_code の自然順（数字だけ→数値順で先、英字混じり→文字順、未設定→最後） ---
+# 並び順キーは member.member_code_sort に保存済み（models.member_code_sort_key）。
+# (club_id, member_code_sort) の索引でそのまま読めるので、式での判定や Python での並べ直しは不要
+def member_code_order(order="asc"):
+    """order_by() に渡す並び順（order は 'asc' / 'desc'）"""
+    return Member.member_code_sort.desc() if order == "desc" else Member.member_code_sort.asc()
+
+# --- 一覧のページ分割（キーセット方式：OFFSET を使わず「前のページの端の行より後」を索引でたどる） ---
+# ?per=件数 &after=<前ページ最後の行のid>（次へ） / &before=<前ページ先頭の行のid>（前へ）
+PAGE_SIZE_OPTIONS = (50, 100, 200, 500)
+DEFAULT_PAGE_SIZE = 100
+COUNT_ESTIMATE_CAP = 10000   # 件数はここまで数える（超えたら「10000件以上」）
+
+
+def _seek_key_eq(expr, value):
+    return expr.is_(None) if value is None else expr == value
+
+
+def _seek_key_after(expr, descending, nullable, value):
+    # NULL は昇順で最後・降順で先頭（PostgreSQL の既定と同じ並び）
+    if value is None:
+        return expr.isnot(None) if descending else false()
+    if descending:
+        return expr < value
+    return or_(expr > value, expr.is_(None)) if nullable else expr > value
+
+
+def keyset_paginate(query, order_keys, id_column):
     """
-    return: SQLAlchemy のブール式
-      - PostgreSQL:  member_code ~ '^[0-9]+$'
-      - SQLite:      member_code GLOB '[0-9]*' AND NOT GLOB '*[^0-9]*'
+    query をキーセット方式で1ページ分だけ読む。
+    order_keys: [(式, 降順か, NULLあり得るか), ...] 最後は一意な列（id）にすること
+    return: SimpleNamespace(rows, per, next_after, prev_before, total, total_capped)
     """
-    dialect = db.engine.dialect.name  # ← ここを修正（session.bind は None になり得る）
-    if dialect == "postgresql":
-        return Member.member_code.op('~')('^[0-9]+$')
+    try:
+        per = int(request.args.get("per") or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        per = DEFAULT_PAGE_SIZE
+    if per not in PAGE_SIZE_OPTIONS:
+        per = DEFAULT_PAGE_SIZE
+    after = (request.args.get("after") or "").strip()
+    before = (request.args.get("before") or "").strip()
+    backward = bool(before) and not after
+    cursor = (before if backward else after) or None
+
+    keys = [(expr, (not descending) if backward else descending, nullable)
+            for expr, descending, nullable in order_keys]
+
+    # 件数の目安：COUNT_ESTIMATE_CAP+1 件で打ち切って数える（履歴が長くても一定時間）
+    total = (query.order_by(None).with_entities(id_column)
+             .limit(COUNT_ESTIMATE_CAP + 1).count())
+
+    # カーソルは id 列の型に直す（数字でない after=abc などは先頭ページ。DB に型違いの値を渡さない）
+    if cursor:
+        try:
+            cursor = id_column.type.python_type(cursor)
+        except (TypeError, ValueError, NotImplementedError):
+            cursor = None
+
+    q = query
+    anchor = None
+    if cursor is not None:
+        # カーソルは行の id だけ。並びのキーは DB から取り直す（消えていたら先頭ページ）
+        anchor = (query.order_by(None).with_entities(*[expr for expr, _, _ in keys])
+                  .filter(id_column == cursor).first())
+    if anchor is not None:
+        q = q.filter(or_(*[
+            and_(*[_seek_key_eq(keys[j][0], anchor[j]) for j in range(i)],
+                 _seek_key_after(expr, descending, nullable, anchor[i]))
+            for i, (expr, descending, nullable) in enumerate(keys)
+        ]))
     else:
-        # SQLite想定（GLOB利用）
-        return and_(
-            Member.member_code.op('GLOB')('[0-9]*'),
-            not_(Member.member_code.op('GLOB')('*[^0-9]*'))
-        )
+        backward = False
+        keys = [(expr, descending, nullable) for expr, descending, nullable in order_keys]
+
+    order_by = []
+    for expr, descending, nullable in keys:
+        col = expr.desc() if descending else expr.asc()
+        if nullable:
+            col = col.nulls_first() if descending else col.nulls_last()
+        order_by.append(col)
+    rows = q.order_by(*order_by).limit(per + 1).all()
+    has_more = len(rows) > per
+    rows = rows[:per]
+    if backward:
+        rows.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = anchor is not None, has_more
 
-# --- 並び替えで使う「数値値」も安全に作る（数字だけの時だけCAST） ---
-from sqlalchemy import null
-def expr_member_code_numeric_value():
-    """
-    return: CASE WHEN is_numeric THEN CAST(member_code AS INTEGER) ELSE NULL END
-            ※ 非数値にCASTしないのでPostgreSQLでも安全
-    """
-    is_numeric = expr_member_code_is_numeric()
-    return case(
-        (is_numeric, cast(Member.member_code, Integer)),
-        else_=null()
+    return SimpleNamespace(
+        rows=rows,
+        per=per,
+        options=PAGE_SIZE_OPTIONS,
+        next_after=(rows[-1].id if rows and has_next else None),
+        prev_before=(rows[0].id if rows and has_prev else None),
+        total=min(total, COUNT_ESTIMATE_CAP),
+        total_capped=total > COUNT_ESTIMATE_CAP,
     )
 
 def get_current_grade(member_id):
@@ -254,12 +676,18 @@ AUTH_PWHASH_KEY = "auth.password_hash"
 OWNER_AUTH_USER_KEY = "OWNER_AUTH_USER"
 OWNER_AUTH_PWHASH_KEY = "OWNER_AUTH_PWHASH"
 
+_default_owner_ensured = False  # ワーカーごとに1回確認すれば十分（毎リクエストの SELECT を省く）
+
 def ensure_default_owner():
     """Ownerテーブルにデフォルト owner / ownerpass を用意（初回のみ）"""
+    global _default_owner_ensured
+    if _default_owner_ensured:
+        return
     exists = Owner.query.filter_by(username="owner").first()
     if not exists:
         db.session.add(Owner(username="owner", password_hash=generate_password_hash("ownerpass")))
         db.session.commit()
+    _default_owner_ensured = True
 
 def ensure_default_admin():
     """
@@ -282,6 +710,82 @@ def _issue_token(n=16):
     alphabet = string.ascii_lowercase + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(n))
 
+def _issue_unique_values(n, length, taken, column):
+    """
+    重複しないランダム値を n 個。taken（読み込み済み）と照合し、DB 全体との衝突はまとめて1回の IN で確認する
+    （Member.id / qr_token は全クラブで一意）
+    """
+    values = []
+    while len(values) < n:
+        batch = set()
+        while len(batch) < n - len(values):
+            v = _issue_token(length)
+            if v not in taken:
+                batch.add(v)
+        clash = {v for (v,) in db.session.query(column).filter(column.in_(batch))} if batch else set()
+        values.extend(batch - clash)
+        taken.update(batch)
+    return values
+
+
+QR_TOKEN_LENGTH = 16   # 英数16桁
+QR_TOKEN_ISSUE_CHUNK = 1000   # 一括発行の UPDATE 1文あたりの人数（バインド変数の上限に収める）
+
+
+def issue_missing_qr_tokens(club_id=None, active_only=False):
+    """
+    QRトークン未発行の会員にまとめて発行する（club_id=None なら全クラブ。active_only なら現役会員だけ）。
+      - 既存トークンは最初に1回だけ読み、生成した値の重複はメモリ上で確認
+      - 書き込みは QR_TOKEN_ISSUE_CHUNK 人ずつの一括 UPDATE … RETURNING（qr_token の一意索引が最後の砦。
+        ぶつかったら読み直して1回だけやり直す）。同時に別の処理が発行した人は書き換えず、数にも入れない
+    コミットは呼び出し側。return: 発行件数（実際に書き込めた人数）
+    """
+    t = Member.__table__
+    for attempt in range(2):
+        q = db.session.query(Member.id, Member.club_id).filter(Member.qr_token.is_(None))
+        if club_id is not None:
+            q = q.filter(Member.club_id == club_id)
+        if active_only:
+            q = q.filter(Member.is_active.is_(True))
+        targets = q.all()
+        if not targets:
+            return 0
+
+        # qr_token は全クラブで一意なので、既存の集合も全体から
+        taken = {tok for (tok,) in db.session.query(Member.qr_token).filter(Member.qr_token.isnot(None))}
+        new_tokens = set()
+        while len(new_tokens) < len(targets):
+            tok = _issue_token(QR_TOKEN_LENGTH)
+            if tok not in taken:
+                new_tokens.add(tok)
+
+        applied = {}   # id -> (club_id, qr_token)：実際に書き込めた行だけ
+        try:
+            with db.session.begin_nested():
+                for chunk in _chunks(list(zip((mid for mid, _ in targets), new_tokens)), QR_TOKEN_ISSUE_CHUNK):
+                    mapping = dict(chunk)
+                    rows = db.session.execute(
+                        t.update()
+                        .where(t.c.id.in_(list(mapping)), t.c.qr_token.is_(None))   # 同時発行とは重ねない
+                        .values(qr_token=case(mapping, value=t.c.id))
+                        .returning(t.c.id, t.c.club_id, t.c.qr_token))
+                    applied.update((r.id, (r.club_id, r.qr_token)) for r in rows)
+        except IntegrityError:
+            if attempt:
+                raise
+            continue
+        if not applied:
+            return 0
+        # 一括文は ORM のイベントを通らないので、索引の破棄をここで予約（コミット時に実行）
+        db.session.info.setdefault("changed_member_clubs", set()).update(c for c, _ in applied.values())
+        # 読み込み済みの会員オブジェクトにも反映
+        for mid, (_, tok) in applied.items():
+            obj = db.session.identity_map.get(db.session.identity_key(Member, mid))
+            if obj is not None:
+                set_committed_value(obj, "qr_token", tok)
+        return len(applied)
+    return 0
+
 def generate_qr_code(member_id, member_name):
     # QRコード作成
     qr = qrcode.QRCode(box_size=10, border=4)
@@ -299,48 +803,6 @@ def generate_qr_code(member_id, member_name):
 
     return img
 
-def _get_jp_font(size=24):
-    """
-    日本語表示可能なフォントを順に試す（どれを掴んだかログ出力）。
-    1) <プロジェクト内> static/fonts/NotoSansJP-Regular.ttf
-    2) Linux系のNoto CJK
-    3) Windows標準
-    4) 最後にデフォルト
-    """
-    candidates = [
-        Path(os.path.join(basedir, "static", "fonts", "NotoSansJP-Regular.ttf")),
-        Path("/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc"),
-        Path("/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc"),
-        Path("/usr/share/fonts/opentype/noto/NotoSansCJKjp-Regular.otf"),
-        Path("/usr/share/fonts/truetype/noto/NotoSansCJKjp-Regular.otf"),
-        Path("C:/Windows/Fonts/meiryo.ttc"),
-        Path("C:/Windows/Fonts/msgothic.ttc"),
-        Path("C:/Windows/Fonts/msmincho.ttc"),
-    ]
-
-    for p in candidates:
-        try:
-            if not p.exists():
-                continue
-            # .ttc は index=0、.ttf/.otf はそのまま
-            if p.suffix.lower() == ".ttc":
-                font = ImageFont.truetype(str(p), size, index=0)
-            else:
-                # 一部環境でパス解決に失敗するケースに備えて bytes 読み込みでも試す
-                try:
-                    font = ImageFont.truetype(str(p), size)
-                except Exception:
-                    with open(p, "rb") as f:
-                        font = ImageFont.truetype(io.BytesIO(f.read()), size)
-            app.logger.info(f"[QR-FONT] using: {p}")
-            return font
-        except Exception as e:
-            app.logger.warning(f"[QR-FONT] failed: {p} ({e})")
-            continue
-
-    app.logger.error("[QR-FONT] fallback to default font (no JP glyphs)")
-    return ImageFont.load_default()
-
 def next_grade_of(current_grade: str) -> str | None:
     """
     Strength マスタの order に基づき、現在より強い側（昇段/昇級先）の“次の”棋力名を返す。
@@ -465,23 +927,43 @@ def ensure_admin_username_exists_for(club_id: str) -> None:
         set_setting_value_for(club_id, AUTH_USER_KEY, "admin")
 
 # --- クラブ別 管理者認証の初期値を保証（開発用の最低限） ---
+def current_club_obj():
+    """
+    g.current_club の Club オブジェクト（初めて使うときに1回だけ読む）。
+    QR受付などの API は使わないので、before_request では読まない
+    """
+    if "current_club_obj" not in g:
+        club_id = getattr(g, "current_club", None)
+        g.current_club_obj = Club.query.get(club_id) if club_id else None
+    return g.current_club_obj
+
+
+_default_admin_ensured_clubs = set()   # 初期パスワードを確認済みのクラブ（ワーカーごと）
+
+
 def ensure_default_admin_for_club():
     """
     Club.admin_password_hash が未設定ならだけ、'admin' で初期化する。
     ※ Setting 側の AUTH_* は参照しない（後方互換の保存先として残す場合は別途手動で）
+    クラブごとにワーカーで1回だけ確認する（毎リクエスト Club を読まない）
     """
-    club_obj = getattr(g, "current_club_obj", None)
+    club_id = getattr(g, "current_club", None)
+    if not club_id or club_id in _default_admin_ensured_clubs:
+        return
+    club_obj = current_club_obj()
     if club_obj and not club_obj.admin_password_hash:
         club_obj.admin_password_hash = generate_password_hash("admin")
         db.session.add(club_obj)
         db.session.commit()
+    if club_obj:
+        _default_admin_ensured_clubs.add(club_id)
 
 @app.context_processor
 def inject_club():
     """
-    before_request でセット済みの Club オブジェクトをそのまま注入。
+    現在のクラブの Club オブジェクトを注入（テンプレートを描くときだけ読む）。
     """
-    return dict(club=getattr(g, "current_club_obj", None))
+    return dict(club=current_club_obj())
 
 @app.route("/api/participants/<member_id>", methods=["DELETE"])
 def delete_today_participant(member_id):
@@ -503,19 +985,14 @@ def delete_today_participant(member_id):
         msg = f"{(m.name if m else member_id)}さんは対局中です"
         return jsonify(success=False, in_match=True, message=msg), 409
 
-    # 2) TodayParticipant から削除（見つからなければ 404）
-    entry = (
-        TodayParticipant.query
-        .filter(TodayParticipant.club_id == g.current_club)
-        .filter(TodayParticipant.date == date_str,
-                TodayParticipant.participant_id == str(member_id))
-        .first()
-    )
-    if not entry:
+    # 2) 在席中の来場記録を取消にする（見つからなければ 404）
+    room = _cancel_attendance(date_str, member_id)
+    if room is None:
         return jsonify(success=False, message="参加者が見つかりません"), 404
 
-    db.session.delete(entry)
+    _release_seat_claims(date_str, participant_ids=[member_id])
     db.session.commit()
+    publish_live_event("participants", {"removed": [str(member_id)]}, date=date_str, room=room)
     return jsonify(success=True), 200
 
 @app.route('/')
@@ -536,42 +1013,22 @@ def members():
         db.session.query(Member)
         .filter(Member.club_id == g.current_club)  # ★クラブ境界
         .filter(Member.is_active.is_(True))
-        .outerjoin(strength_alias, Member.grade == strength_alias.name)
+        # ★棋力順はこのクラブの設定だけ（他クラブの同名の棋力で行が重複しないように）
+        .outerjoin(strength_alias, (Member.grade == strength_alias.name)
+                   & (strength_alias.club_id == g.current_club))
     )
 
+    # 並びのキー（最後は会員の id で一意にする：ページ分割のため）
+    desc_ = (sort_order == 'desc')
     if sort_key == 'grade':
-        sort_column = case(
-            (strength_alias.order == None, -1), 
+        grade_order = case(
+            (strength_alias.order == None, -1),
             else_=strength_alias.order
         )
-        sort_column = sort_column.asc() if sort_order == 'asc' else sort_column.desc()
-        members = query.order_by(sort_column).all()
-    elif sort_key == 'member_type':
-        # 既存ロジックに合わせるならここで member_type のケースを分けてもOK
-        sort_col = getattr(Member, 'member_type')
-        sort_col = sort_col.asc() if sort_order == 'asc' else sort_col.desc()
-        members = query.order_by(sort_col).all()
+        order_keys = [(grade_order, desc_, False), (Member.member_code_sort, False, False)]
     elif sort_key == 'member_code' or sort_key == '' or sort_key is None:
-        # 数値だけ→数値順、英字混じり→文字順（DB方言対応）
-        is_numeric = case((expr_member_code_is_numeric(), 1), else_=0)
-        num_value  = expr_member_code_numeric_value()
-
-        if sort_order == 'desc':
-            members = (query
-                       .order_by(
-                           is_numeric.asc(),     # 数値でない → 先
-                           num_value.desc(),     # 数値グループ内は数値降順
-                           Member.member_code.desc()
-                       )
-                       .all())
-        else:
-            members = (query
-                       .order_by(
-                           is_numeric.desc(),    # 数値 → 先
-                           num_value.asc(),      # 数値グループ内は数値昇順
-                           Member.member_code.asc()
-                       )
-                       .all())
+        # 数値だけ→数値順、英字混じり→文字順（保存済みの並び順キー）
+        order_keys = [(Member.member_code_sort, desc_, False)]
     else:
         # その他の列は従来どおり
         sort_columns = {
@@ -580,12 +1037,14 @@ def members():
             'kana': Member.kana,
             'member_type': Member.member_type
         }
-        sort_column = sort_columns.get(sort_key, Member.member_code)
-        if sort_order == 'desc':
-            sort_column = sort_column.desc()
-        members = query.order_by(sort_column).all()
+        sort_column = sort_columns.get(sort_key)
+        order_keys = [(sort_column, desc_, False)] if sort_column is not None else [(Member.member_code_sort, desc_, False)]
+    order_keys.append((Member.id, desc_, False))
+
+    page = keyset_paginate(query, order_keys, Member.id)
     imported = request.args.get('imported')
-    return render_template('members.html', members=members, imported=imported, sort=sort_key, order=sort_order)
+    return render_template('members.html', members=page.rows, page=page, imported=imported,
+                           sort=sort_key, order=sort_order)
 
 @app.route('/add', methods=['GET', 'POST'])
 def add_member():
@@ -634,12 +1093,9 @@ def add_member():
             except Exception:
                 pass
 
-        # ★ QRトークン自動発行（重複防止ループ込み）
+        # ★ QRトークン自動発行（全クラブで一意。重複確認は1回の問い合わせ）
         if not getattr(new_member, "qr_token", None):
-            token = _issue_token(16)  # 英数16桁
-            while Member.query.filter_by(club_id=g.current_club, qr_token=token).first():
-                token = _issue_token(16)
-            new_member.qr_token = token  # ここで付与
+            new_member.qr_token = _issue_unique_values(1, QR_TOKEN_LENGTH, set(), Member.qr_token)[0]
 
         try:
             db.session.add(new_member)
@@ -991,279 +1447,733 @@ def set_default_card_count():
 
     return render_template('set_default_card_count.html', form=form)
 
-@app.route('/members/upload', methods=['POST'])
-def upload_members():
-    from collections import Counter
+@app.route('/settings/attendance', methods=['GET', 'POST'])
+def set_attendance_retention():
+    form = AttendanceRetentionForm()
 
-    file = request.files.get('file')
-    if not file:
-        return "ファイルが選択されていません", 400
+    existing = Setting.query.filter_by(
+        club_id=g.current_club, key=ATTENDANCE_RETENTION_KEY
+    ).first()
+    if request.method == 'GET':
+        form.days.data = existing.value if existing else "0"
 
-    stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig')
-    reader = csv.DictReader(stream)
-    imported_count = 0
+    if form.validate_on_submit():
+        days = (form.days.data or '').strip()
+        if not days.isdigit() or not (0 <= int(days) <= 3650):
+            return "0〜3650の整数で入力してください", 400
 
-    import re
-    # ひらがな50文字まで
-    re_kana = re.compile(r'^[ぁ-んー]{1,50}$')
-    # 会員ID：半角英数字＋ . _ % + - @ のみ、1〜20文字
-    re_code = re.compile(r'^[A-Za-z0-9._%+\-@]{1,20}$')
-
-    # --- 許容値の準備 ---
-    # Strength（クラブごとの棋力一覧）を取得し、集合化
-    strengths = Strength.query.filter_by(club_id=g.current_club).all()
-    strength_set = {s.name for s in strengths}
-    strength_set.add("未認定")  # 常に許容
+        if existing:
+            existing.value = days
+        else:
+            db.session.add(Setting(club_id=g.current_club, key=ATTENDANCE_RETENTION_KEY, value=days))
+        db.session.commit()
+        _audit("update_setting", g.current_club, note=f"key={ATTENDANCE_RETENTION_KEY}")
+        return redirect(url_for('settings_index'))
 
-    # member_type の許可リスト（運用実績に合わせて）
-    allowed_member_types = {"正会員", "臨時会員", "指導員", "スタッフ"}
+    return render_template('set_attendance_retention.html', form=form)
 
-    # レポート用カウンタ
-    skipped = Counter()    # 例: "kana=（空 or 値）" -> 件数
-    replaced = Counter()   # 例: "grade:18級→未認定" / "member_type:ABC→正会員"
+# ===== 裏の処理の状態（取り込みの進捗・プレビュー・QRカードZIP）は一時ディレクトリのファイルに置く =====
+# gunicorn のワーカーは複数あり得る（WEB_CONCURRENCY）。問い合わせ・確定・ダウンロードが別のワーカーに
+# 届いても読めるように、ワーカーのメモリではなく ID ごとの JSON ファイルにする（書くのは1つの処理だけ）
+import re
 
-    for row in reader:
-        # 入力列は（推奨）member_code, name, kana, grade, member_type
-        member_code_csv = (row.get('member_code', '') or '').strip()
-        name = (row.get('name', '') or '').strip()
-        kana = (row.get('kana', '') or '').strip()
-        grade = (row.get('grade', '') or '').strip()
-        member_type = (row.get('member_type', '') or '').strip()
-
-        # --- 必須チェック ---
-        if not member_code_csv or not name or not kana:
-            reason = []
-            if not member_code_csv:
-                reason.append("member_code=(空)")
-            if not name:
-                reason.append("name=(空)")
-            if not kana:
-                reason.append("kana=(空)")
-            skipped.update(reason or ["必須欠落"])
-            continue
+JOB_STATE_DIR = os.path.join(tempfile.gettempdir(), "club_job_state")
+RE_JOB_ID = re.compile(r'^[A-Za-z0-9_\-]{1,64}$')
 
-        # --- 仕様バリデーション ---
-        # 会員ID
-        if not re_code.match(member_code_csv):
-            skipped.update([f"member_code={member_code_csv}"])
-            continue
 
-        # 名前（日本語OK/20文字まで）
-        if len(name) > 20:
-            skipped.update([f"name={name}"])
-            continue
+def _job_state_path(kind, job_id):
+    """状態ファイルのパス（ID が不正なら None。パスには画面から来た値をそのまま使わない）"""
+    if not job_id or not RE_JOB_ID.match(job_id):
+        return None
+    return os.path.join(JOB_STATE_DIR, f"{kind}_{job_id}.json")
 
-        # かな（ひらがなのみ/50文字まで）
-        if not re_kana.match(kana):
-            skipped.update([f"kana={kana or '(空)'}"])
-            continue
 
-        # --- 置換ルール ---
-        # grade：Strength に無ければ「未認定」に置換
-        if grade not in strength_set:
-            if grade:  # 空欄が来た場合も「未認定」に寄せる（報告は空→未認定）
-                replaced.update([f"grade:{grade}→未認定"])
-            else:
-                replaced.update([f"grade:(空)→未認定"])
-            grade = "未認定"
-
-        # member_type：許可外は「正会員」に置換
-        if member_type not in allowed_member_types:
-            replaced.update([f"member_type:{member_type or '(空)'}→正会員"])
-            member_type = "正会員"
-
-        # 既存判定：club_id + member_code で一意
-        member = (
-            Member.query
-                  .filter_by(club_id=g.current_club, member_code=member_code_csv)
-                  .first()
-        )
+def write_job_state(kind, job_id, state):
+    """状態を丸ごと書く（一時ファイルに書いてから置き換えるので、読む側が書きかけを見ることはない）"""
+    path = _job_state_path(kind, job_id)
+    if path is None:
+        return
+    os.makedirs(JOB_STATE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=JOB_STATE_DIR, prefix=".tmp_")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, path)
 
-        if member:
-            # 既存更新
-            member.name = name
-            member.kana = kana
-            member.grade = grade
-            member.member_type = member_type
-        else:
-            # 新規作成（内部PKは英数12桁の衝突回避）
-            new_id = _issue_token(12)
-            while Member.query.get(new_id):
-                new_id = _issue_token(12)
-
-            member = Member(
-                id=new_id,
-                name=name,
-                kana=kana,
-                grade=grade,
-                member_type=member_type,
-                club_id=g.current_club
-            )
 
-            # 表示用ID（クラブ内ユニーク）
-            setattr(member, "member_code", member_code_csv)
+def read_job_state(kind, job_id):
+    path = _job_state_path(kind, job_id)
+    if path is None:
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-            # 新規は QR トークン付与（クラブ内ユニーク）
-            token = _issue_token(16)
-            while Member.query.filter_by(club_id=g.current_club, qr_token=token).first():
-                token = _issue_token(16)
-            member.qr_token = token
 
-            db.session.add(member)
+def update_job_state(kind, job_id, **fields):
+    state = read_job_state(kind, job_id)
+    if state is not None:
+        state.update(fields)
+        write_job_state(kind, job_id, state)
 
-        # 既存でも qr_token 未付与なら補完
-        if not getattr(member, "qr_token", None):
-            token = _issue_token(16)
-            while Member.query.filter_by(club_id=g.current_club, qr_token=token).first():
-                token = _issue_token(16)
-            member.qr_token = token
 
-        imported_count += 1
+def take_job_state(kind, job_id):
+    """状態を読んで消す（1回限り。同時に2つ来ても、ファイルを移せた方だけが受け取る）"""
+    path = _job_state_path(kind, job_id)
+    if path is None:
+        return None
+    claimed = f"{path}.{secrets.token_hex(4)}.taken"
+    try:
+        os.replace(path, claimed)
+    except OSError:
+        return None
+    try:
+        with open(claimed, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+    finally:
+        try:
+            os.remove(claimed)
+        except OSError:
+            pass
 
-    db.session.commit()
 
-    # 取り込みレポート：flash で表示
-    if replaced:
-        # 例）"grade:18級→未認定 … 3件 / member_type:ABC→正会員 … 2件"
-        rep_msg = " / ".join([f"{k} … {v}件" for k, v in replaced.items()])
-        flash(f"置換: {rep_msg}", "info")
-    if skipped:
-        # 例）"kana=カタカナ … 2件 / member_code=*** … 1件"
-        skip_msg = " / ".join([f"{k} … {v}件" for k, v in skipped.items()])
-        flash(f"スキップ: {skip_msg}", "warning")
+def prune_job_states(kind, ttl):
+    """ttl より前に更新された状態ファイルを消して、その中身を返す（後片付けは呼び出し側）"""
+    cutoff = time.time() - ttl.total_seconds()
+    expired = []
+    try:
+        names = os.listdir(JOB_STATE_DIR)
+    except OSError:
+        return expired
+    for name in names:
+        if not (name.startswith(f"{kind}_") and name.endswith(".json")):
+            continue
+        path = os.path.join(JOB_STATE_DIR, name)
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            os.remove(path)
+        except (OSError, ValueError):
+            continue
+        expired.append(state)
+    return expired
 
-    # 上部の「◯件インポートしました」をそのまま活かす
-    return redirect(url_for('members', imported=imported_count))
 
-@app.route('/members/export')
-def export_members():
-    output = io.StringIO()
-    writer = csv.writer(output)
+# ===== 会員CSVの取り込み（ストリーミング・チャンク単位） =====
+# 1行ずつ DB に問い合わせる代わりに、クラブの既存 member_code / トークンを最初に1回だけ読み、
+# CSV は MEMBER_IMPORT_CHUNK 行ずつ検証して、チャンクごとに複数行 INSERT / UPDATE してコミットする
+from collections import Counter
 
-    # 出力カラム：内部PK id は含めない
-    writer.writerow(['member_code', 'name', 'kana', 'grade', 'member_type'])
+MEMBER_IMPORT_CHUNK = 500
+MEMBER_IMPORT_STALE_CHECK_CHUNK = 10000   # 確定前の照合で IN に並べる member_code の数（バインド変数の上限に収める）
+MEMBER_IMPORT_TYPES = {"正会員", "臨時会員", "指導員", "スタッフ"}  # member_type の許可リスト（運用実績に合わせて）
+RE_IMPORT_KANA = re.compile(r'^[ぁ-んー]{1,50}$')             # ひらがな50文字まで
+RE_IMPORT_CODE = re.compile(r'^[A-Za-z0-9._%+\-@]{1,20}$')    # 会員ID：半角英数字＋ . _ % + - @ のみ、1〜20文字
 
-    # 並び順：
-    #   1) member_code が None は最後
-    #   2) 数字だけの member_code を数値グループとして先に並べ、数値昇順
-    #   3) 英字を含むものは文字昇順
-    #   4) 同値時は name → kana
-    is_numeric = case((expr_member_code_is_numeric(), 1), else_=0)
-    num_value  = expr_member_code_numeric_value()
+IMPORT_PROGRESS_TTL = timedelta(hours=1)
 
-    q = (
-        Member.query
-        .filter_by(club_id=g.current_club, is_active=True)
-        .order_by(
-            (Member.member_code.is_(None)).asc(),  # None を最後へ
-            is_numeric.desc(),                      # 数字のみ(1) → 先
-            num_value.asc(),                        # 数値グループは数値昇順
-            Member.member_code.asc(),               # 英字混じりは文字昇順
-            Member.name.asc(),
-            Member.kana.asc()
-        )
-    )
 
-    for m in q.all():
-        # None 安全化
-        member_code = (getattr(m, "member_code", "") or "")
-        writer.writerow([member_code, m.name, m.kana, m.grade, m.member_type])
+def _import_progress_id(club_id, job_id):
+    """
+    進捗の状態ファイルの ID。取り込みID は画面が振るので、クラブと組にしてから使う
+    （別のクラブが同じ ID を振っても、互いの進捗を上書きしない）。ID が不正なら None
+    """
+    if not job_id or not RE_JOB_ID.match(job_id):
+        return None
+    return hashlib.sha256(f"{club_id}\0{job_id}".encode("utf-8")).hexdigest()[:32]
 
-    output.seek(0)
-    bom = '\ufeff'  # UTF-8 BOM
-    return send_file(
-        io.BytesIO((bom + output.read()).encode('utf-8')),
-        mimetype='text/csv',
-        as_attachment=True,
-        download_name='members.csv'
-    )
 
-# 会員削除（退会）処理
-@app.route('/delete/<member_id>', methods=['POST'])
-def delete_member(member_id):
-    member = Member.query.get_or_404(member_id)
+def _set_import_progress(job_id, club_id, **fields):
+    """取り込みの進捗（画面のポーリング用。状態ファイル "member_import" に置く）"""
+    state_id = _import_progress_id(club_id, job_id)
+    if state_id is None:
+        return
+    state = read_job_state("member_import", state_id)
+    if state is None:
+        prune_job_states("member_import", IMPORT_PROGRESS_TTL)
+        state = {"club_id": club_id}
+    state.update(fields)
+    write_job_state("member_import", state_id, state)
 
-    # ✅ 削除前チェック：本日の参加者にいるなら削除不可
-    today = datetime.utcnow().strftime('%Y-%m-%d')
-    in_today = (
-        TodayParticipant.query
-        .filter_by(date=today, participant_id=member_id)
-        .first()
-    )
-    if in_today:
-        flash("この会員は現在参加中ですので退会できません", "error")
-        return redirect(url_for('members'))
 
-    # 退会（論理削除）
-    member.is_active = False
-    member.left_at = datetime.utcnow()
-    db.session.commit()
+def _validate_member_csv_row(row, strength_set, skipped, replaced):
+    """
+    CSV 1行を検証・置換して dict にする（不正なら skipped に理由を数えて None。理由は "_reject" にも残す）
+    入力列は（推奨）member_code, name, kana, grade, member_type
+    """
+    member_code_csv = (row.get('member_code', '') or '').strip()
+    name = (row.get('name', '') or '').strip()
+    kana = (row.get('kana', '') or '').strip()
+    grade = (row.get('grade', '') or '').strip()
+    member_type = (row.get('member_type', '') or '').strip()
+
+    # --- 必須チェック ---
+    if not member_code_csv or not name or not kana:
+        reason = []
+        if not member_code_csv:
+            reason.append("member_code=(空)")
+        if not name:
+            reason.append("name=(空)")
+        if not kana:
+            reason.append("kana=(空)")
+        row["_reject"] = reason or ["必須欠落"]
+        skipped.update(row["_reject"])
+        return None
 
-    flash(f"{member.name} さんを退会にしました。", "success")
-    return redirect(url_for('members'))
+    # --- 仕様バリデーション ---
+    # 会員ID
+    if not RE_IMPORT_CODE.match(member_code_csv):
+        row["_reject"] = [f"member_code={member_code_csv}"]
+        skipped.update(row["_reject"])
+        return None
 
-@app.route("/members/inactive")
-def inactive_members():
-    # 数字だけの member_code は数値順、英字を含むものは文字順
-    from sqlalchemy import case
+    # 名前（日本語OK/20文字まで）
+    if len(name) > 20:
+        row["_reject"] = [f"name={name}"]
+        skipped.update(row["_reject"])
+        return None
 
-    q = Member.query.filter_by(club_id=g.current_club, is_active=False)
+    # かな（ひらがなのみ/50文字まで）
+    if not RE_IMPORT_KANA.match(kana):
+        row["_reject"] = [f"kana={kana or '(空)'}"]
+        skipped.update(row["_reject"])
+        return None
 
-    is_numeric = case((expr_member_code_is_numeric(), 0), else_=1)
-    num_value  = expr_member_code_numeric_value()
+    # --- 置換ルール ---
+    # grade：Strength に無ければ「未認定」に置換
+    if grade not in strength_set:
+        if grade:  # 空欄が来た場合も「未認定」に寄せる（報告は空→未認定）
+            replaced.update([f"grade:{grade}→未認定"])
+        else:
+            replaced.update([f"grade:(空)→未認定"])
+        grade = "未認定"
 
-    inactive = (
-        q.order_by(
-            is_numeric.asc(),   # 0(=数字) → 1(=英字入り)
-            num_value.asc(),    # 数値グループは数値昇順
-            Member.member_code.asc()
-        ).all()
-    )
-    return render_template("members_inactive.html", members=inactive)
+    # member_type：許可外は「正会員」に置換
+    if member_type not in MEMBER_IMPORT_TYPES:
+        replaced.update([f"member_type:{member_type or '(空)'}→正会員"])
+        member_type = "正会員"
 
-@app.post("/members/<member_id>/restore")
-def restore_member(member_id):
-    m = Member.query.get(member_id)
-    if not m:
-        flash("会員が見つかりませんでした。", "error")
-        return redirect(url_for("inactive_members"))
-    if m.is_active:
-        flash("すでに現役会員です。", "info")
-        return redirect(url_for("inactive_members"))
+    return {"member_code": member_code_csv, "name": name, "kana": kana,
+            "grade": grade, "member_type": member_type}
 
-    # 復旧処理：現役化 + 退会日時クリア
-    m.is_active = True
-    m.left_at = None
-    db.session.commit()
-    flash(f"{m.name} さんを現役に復旧しました。", "success")
-    return redirect(url_for("inactive_members"))
 
-@app.route("/match/edit")
-def match_edit():
-    # 並び替えパラメータ（全会員名簿）
-    sort_members = request.args.get('sort_members', 'member_code')
-    order_members = request.args.get('order_members', 'asc')
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-    # 並び替えパラメータ（本日の参加者）
-    sort_participants = request.args.get('sort_participants', 'member_code')
-    order_participants = request.args.get('order_participants', 'asc')
 
-    # 今日の日付（UTC→日本時間にするなら修正要）
-    today = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d")
+def _iter_csv_chunks(reader, size):
+    chunk = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    # 🔧 追加：本日の参加者IDを取得して除外用に使う
-    today_ids = [
-        p.participant_id
-        for p in TodayParticipant.query.filter_by(club_id=g.current_club, date=today).all()
-    ]
 
-    # 会員種類のカスタム順序（正会員、臨時会員、指導員、スタッフ）
-    member_type_order = case(
-        (Member.member_type == '正会員', 1),
-        (Member.member_type == '臨時会員', 2),
-        (Member.member_type == '指導員', 3),
-        (Member.member_type == 'スタッフ', 4),
-        else_=5
+MEMBER_IMPORT_FIELDS = ("name", "kana", "grade", "member_type")
+MEMBER_IMPORT_FIELD_LABELS = {"name": "名前", "kana": "よみがな", "grade": "棋力",
+                              "member_type": "会員種類", "qr_token": "QRトークン"}
+
+
+def _load_member_import_context(club_id):
+    """取り込み先クラブの許容棋力・既存会員（member_code -> (id, {項目: 値}, qr_token)）・使用中の値を1回だけ読む"""
+    strength_set = {name for (name,) in db.session.query(Strength.name).filter(Strength.club_id == club_id)}
+    strength_set.add("未認定")  # 常に許容
+    existing = {}
+    tokens = set()
+    for r in (db.session.query(Member.id, Member.member_code, Member.name, Member.kana,
+                               Member.grade, Member.member_type, Member.qr_token)
+              .filter(Member.club_id == club_id)):
+        if r.qr_token:
+            tokens.add(r.qr_token)
+        if r.member_code:
+            existing[r.member_code] = (r.id, {f: getattr(r, f) for f in MEMBER_IMPORT_FIELDS}, r.qr_token)
+    return SimpleNamespace(strength_set=strength_set, existing=existing, tokens=tokens,
+                           member_ids={v[0] for v in existing.values()})
+
+
+def _diff_member_records(records, existing):
+    """
+    検証済みの行（member_code -> rec）を既存会員と突き合わせる
+    return: (new, updated, unchanged件数)。updated は {id, member_code, rec, old, token, changes}
+    """
+    new, updated, unchanged = [], [], 0
+    for code, rec in records.items():
+        cur = existing.get(code)
+        if cur is None:
+            new.append(rec)
+            continue
+        member_id, old, token = cur
+        changes = {f: (old[f], rec[f]) for f in MEMBER_IMPORT_FIELDS if old[f] != rec[f]}
+        if not token:
+            changes["qr_token"] = ("(なし)", "(新規発行)")
+        if not changes:
+            unchanged += 1
+            continue
+        updated.append({"id": member_id, "member_code": code, "rec": rec, "old": old, "token": token,
+                        "changes": changes})
+    return new, updated, unchanged
+
+
+def _write_member_import_chunk(club_id, ctx, new, updated):
+    """
+    新規・更新（それぞれ MEMBER_IMPORT_CHUNK 件まで）を複数行 INSERT / UPDATE してコミットする。
+    新規の内部PK（英数12桁）・QRトークン（英数16桁）はここでまとめて採番し、ctx.existing にも反映する
+    """
+    from models import member_code_sort_key
+    t = Member.__table__
+    if updated:
+        # 既存でも qr_token 未付与なら補完
+        fills = iter(_issue_unique_values(sum(1 for u in updated if not u["token"]), 16, ctx.tokens, Member.qr_token))
+        params = []
+        for u in updated:
+            u["token"] = u["token"] or next(fills)
+            rec = u["rec"]
+            params.append({"_id": u["id"], "_name": rec["name"], "_kana": rec["kana"], "_grade": rec["grade"],
+                           "_member_type": rec["member_type"], "_token": u["token"]})
+        db.session.execute(
+            t.update().where(t.c.id == bindparam("_id")).values(
+                name=bindparam("_name"), kana=bindparam("_kana"), grade=bindparam("_grade"),
+                member_type=bindparam("_member_type"), qr_token=bindparam("_token")),
+            params)
+    rows = []
+    if new:
+        new_ids = _issue_unique_values(len(new), 12, ctx.member_ids, Member.id)
+        new_tokens = _issue_unique_values(len(new), 16, ctx.tokens, Member.qr_token)
+        rows = [dict(rec, id=new_id, club_id=club_id, qr_token=token, is_active=True,
+                     member_code_sort=member_code_sort_key(rec["member_code"]))
+                for rec, new_id, token in zip(new, new_ids, new_tokens)]
+        db.session.execute(t.insert(), rows)
+
+    # 一括文は ORM のイベントを通らないので、索引・参加者一覧の破棄をここで予約（コミット時に実行）
+    if new or updated:
+        db.session.info.setdefault("changed_member_clubs", set()).add(club_id)
+    db.session.commit()
+
+    # 同じ member_code が後のチャンクにまた出てきたら、今書いた値との差分にする
+    for u in updated:
+        ctx.existing[u["member_code"]] = (u["id"], {f: u["rec"][f] for f in MEMBER_IMPORT_FIELDS}, u["token"])
+    for row in rows:
+        ctx.existing[row["member_code"]] = (row["id"], {f: row[f] for f in MEMBER_IMPORT_FIELDS}, row["qr_token"])
+
+
+def _new_member_import_result(**fields):
+    """
+    取り込み結果。conflict のときは途中で中止した（inserted / updated の件数はコミット済み。
+    CSV から直接のときは committed_line 行目まで）。stale は確定前の照合で食い違った member_code（何も書いていない）
+    """
+    return SimpleNamespace(imported=0, inserted=0, updated=0, unchanged=0, chunks=0, rows=0,
+                           skipped=Counter(), replaced=Counter(), conflict=False, stale=[],
+                           committed_line=None, **fields)
+
+
+def plan_member_import(stream, club_id):
+    """
+    会員CSVを1回だけ読み、クラブの会員（最初に1回だけ読む）との差分を作る。DB には書かない（プレビュー用）。
+      new       … 新規（club_id + member_code が無い）
+      updated   … 更新（項目ごとの変更 {項目: (前, 後)} 付き。QRトークン未付与の補完も含む）
+      unchanged … 変更なしの件数
+      rejected  … 取り込まない行 [(行番号, 理由)]
+    同じ member_code が複数行あれば後の行を採用。
+    """
+    reader = csv.DictReader(stream)
+    ctx = _load_member_import_context(club_id)
+
+    # レポート用カウンタ
+    skipped = Counter()    # 例: "kana=（空 or 値）" -> 件数
+    replaced = Counter()   # 例: "grade:18級→未認定" / "member_type:ABC→正会員"
+    records = {}           # member_code -> 検証済み（後の行で上書き）
+    rejected = []
+    rows = imported = 0
+    for line_no, row in enumerate(reader, start=2):   # 1行目は見出し
+        rows += 1
+        rec = _validate_member_csv_row(row, ctx.strength_set, skipped, replaced)
+        if rec is None:
+            rejected.append((line_no, " / ".join(row.get("_reject") or [])))
+            continue
+        imported += 1
+        records.pop(rec["member_code"], None)   # 後の行の位置に並べ直す
+        records[rec["member_code"]] = rec
+
+    new, updated, unchanged = _diff_member_records(records, ctx.existing)
+    return SimpleNamespace(
+        club_id=club_id, rows=rows, imported=imported,
+        new=new, updated=updated, unchanged=unchanged, rejected=rejected,
+        skipped=skipped, replaced=replaced,
+    )
+
+
+def _stale_member_import_codes(plan):
+    """
+    プレビュー後に変わった会員（新規のはずが登録済み・更新前の値が違う・消えた）の member_code。
+    クラブ全員は読み直さず、差分に出てくる member_code だけを IN で読む（ふつうは1回）
+    """
+    codes = [rec["member_code"] for rec in plan.new] + [u["member_code"] for u in plan.updated]
+    current = {}
+    for chunk in _chunks(codes, MEMBER_IMPORT_STALE_CHECK_CHUNK):
+        for r in (db.session.query(Member.id, Member.member_code, Member.name, Member.kana,
+                                   Member.grade, Member.member_type, Member.qr_token)
+                  .filter(Member.club_id == plan.club_id, Member.member_code.in_(chunk))):
+            current[r.member_code] = (r.id, {f: getattr(r, f) for f in MEMBER_IMPORT_FIELDS}, r.qr_token)
+    stale = [rec["member_code"] for rec in plan.new if rec["member_code"] in current]
+    for u in plan.updated:
+        cur = current.get(u["member_code"])
+        if cur is None or cur[0] != u["id"] or cur[1] != u["old"] or cur[2] != u["token"]:
+            stale.append(u["member_code"])
+    return stale
+
+
+def apply_member_import(plan, job_id=None, chunk_size=MEMBER_IMPORT_CHUNK):
+    """
+    プレビューで確認した差分を書き込む。先に DB と照合し、食い違いがあれば何も書かずに返す（result.stale）。
+    MEMBER_IMPORT_CHUNK 件ずつコミットして進捗を記録する
+    return: _new_member_import_result の形
+    """
+    club_id = plan.club_id
+    result = _new_member_import_result()
+    result.imported, result.unchanged, result.rows = plan.imported, plan.unchanged, plan.rows
+    result.skipped, result.replaced = plan.skipped, plan.replaced
+    total = len(plan.new) + len(plan.updated)
+    _set_import_progress(job_id, club_id, rows=0, total=total, chunks=0, imported=0, done=False)
+
+    # CSV は読み直さない。プレビュー後の変更だけは、差分に出てくる会員を照合して確かめる
+    result.stale = _stale_member_import_codes(plan)
+    if result.stale:
+        result.conflict = True
+        _set_import_progress(job_id, club_id, done=True, error="conflict")
+        return result
+
+    # 採番した内部PK・トークンの重複は _issue_unique_values が DB と照合するので、クラブの既存値は読まない
+    ctx = SimpleNamespace(existing={}, tokens=set(), member_ids=set())
+    try:
+        for new, updated in ([([], chunk) for chunk in _chunks(plan.updated, chunk_size)]
+                             + [(chunk, []) for chunk in _chunks(plan.new, chunk_size)]):
+            _write_member_import_chunk(club_id, ctx, new, updated)
+            result.inserted += len(new)
+            result.updated += len(updated)
+            result.chunks += 1
+            _set_import_progress(job_id, club_id, rows=result.inserted + result.updated, chunks=result.chunks,
+                                 imported=result.inserted + result.updated,
+                                 inserted=result.inserted, updated=result.updated)
+    except IntegrityError:
+        # 照合の後に別の端末が同じ会員IDを登録した等（コミット済みのチャンクは result の件数どおり）
+        db.session.rollback()
+        result.conflict = True
+        _set_import_progress(job_id, club_id, done=True, error="conflict")
+        return result
+
+    _set_import_progress(job_id, club_id, done=True)
+    return result
+
+
+def import_members_csv(stream, club_id, job_id=None, chunk_size=MEMBER_IMPORT_CHUNK):
+    """
+    会員CSVをそのまま取り込む。CSV は chunk_size 行ずつ読んで検証し、チャンクごとに書き込んでコミットする
+    （ファイル全体をメモリに載せない）。同じ member_code が複数行あれば後の行を採用。
+    途中で一意制約に当たったら中止し、コミット済みの CSV 行番号を result.committed_line に残す
+    """
+    reader = csv.DictReader(stream)
+    ctx = _load_member_import_context(club_id)
+    result = _new_member_import_result()
+    _set_import_progress(job_id, club_id, rows=0, chunks=0, imported=0, done=False)
+
+    line_no = 1   # 1行目は見出し
+    try:
+        for chunk in _iter_csv_chunks(reader, chunk_size):
+            result.rows += len(chunk)
+            line_no += len(chunk)
+            records = {}   # member_code -> 検証済み（チャンク内の重複は後の行）
+            for row in chunk:
+                rec = _validate_member_csv_row(row, ctx.strength_set, result.skipped, result.replaced)
+                if rec:
+                    records.pop(rec["member_code"], None)
+                    records[rec["member_code"]] = rec
+                    result.imported += 1
+            new, updated, unchanged = _diff_member_records(records, ctx.existing)
+            _write_member_import_chunk(club_id, ctx, new, updated)
+            result.inserted += len(new)
+            result.updated += len(updated)
+            result.unchanged += unchanged
+            result.chunks += 1
+            result.committed_line = line_no
+            _set_import_progress(job_id, club_id, rows=result.rows, chunks=result.chunks,
+                                 imported=result.imported, inserted=result.inserted, updated=result.updated)
+    except IntegrityError:
+        # 取り込み中に別の端末が同じ会員ID・QRトークンを登録した等（committed_line 行目まではコミット済み）
+        db.session.rollback()
+        result.conflict = True
+        _set_import_progress(job_id, club_id, done=True, error="conflict")
+        return result
+
+    _set_import_progress(job_id, club_id, done=True)
+    return result
+
+
+# --- 取り込みプレビュー：差分を短時間だけ保持し、確定時は CSV を読み直さずにそのまま書き込む
+#     （クラブ全員も読み直さない。プレビュー後の変更は差分に出てくる member_code だけ IN で照合する） ---
+IMPORT_PREVIEW_TTL = timedelta(minutes=15)
+IMPORT_PREVIEW_SHOW = 200      # 画面に並べる件数（区分ごと）
+
+
+def _store_import_preview(plan):
+    """差分を状態ファイル "member_import_preview" に置いて preview_id を返す（確定はどのワーカーからでも）"""
+    prune_job_states("member_import_preview", IMPORT_PREVIEW_TTL)
+    preview_id = secrets.token_urlsafe(16)
+    write_job_state("member_import_preview", preview_id, {
+        "club_id": plan.club_id, "expires_at": (datetime.utcnow() + IMPORT_PREVIEW_TTL).isoformat(),
+        "rows": plan.rows, "imported": plan.imported, "unchanged": plan.unchanged,
+        "new": plan.new, "updated": plan.updated,
+        "skipped": dict(plan.skipped), "replaced": dict(plan.replaced),
+    })
+    return preview_id
+
+
+def _take_import_preview(preview_id, club_id):
+    """保持中の差分を取り出す（1回限り。期限切れ・他クラブは None）"""
+    entry = take_job_state("member_import_preview", preview_id)
+    if (not entry or entry["club_id"] != club_id
+            or datetime.fromisoformat(entry["expires_at"]) < datetime.utcnow()):
+        return None
+    return SimpleNamespace(
+        club_id=club_id, rows=entry["rows"], imported=entry["imported"], unchanged=entry["unchanged"],
+        new=entry["new"], updated=entry["updated"], rejected=[],
+        skipped=Counter(entry["skipped"]), replaced=Counter(entry["replaced"]),
+    )
+
+
+def _flash_import_result(result):
+    # 取り込みレポート：flash で表示
+    flash(f"取り込み: {result.rows}行を{result.chunks}回に分けて処理"
+          f"（新規 {result.inserted}件 / 更新 {result.updated}件 / 変更なし {result.unchanged}件）", "info")
+    if result.replaced:
+        # 例）"grade:18級→未認定 … 3件 / member_type:ABC→正会員 … 2件"
+        rep_msg = " / ".join([f"{k} … {v}件" for k, v in result.replaced.items()])
+        flash(f"置換: {rep_msg}", "info")
+    if result.skipped:
+        # 例）"kana=カタカナ … 2件 / member_code=*** … 1件"
+        skip_msg = " / ".join([f"{k} … {v}件" for k, v in result.skipped.items()])
+        flash(f"スキップ: {skip_msg}", "warning")
+
+
+@app.route('/members/upload', methods=['POST'])
+def upload_members():
+    """
+    会員CSVの取り込み。
+      - file=CSV：そのまま取り込む
+      - preview_id=…：/members/upload/preview で確認した差分を取り込む（CSV は読み直さない）
+    """
+    fetch = request.headers.get("X-Requested-With") == "fetch"
+    # 画面が振った取り込みID（進捗のポーリング用。無くても取り込める）
+    job_id = (request.form.get('job') or '')[:64]
+    preview_id = (request.form.get('preview_id') or '').strip()
+
+    def _back():
+        if fetch:
+            return jsonify(success=False, redirect=url_for('members'))
+        return redirect(url_for('members'))
+
+    try:
+        if preview_id:
+            plan = _take_import_preview(preview_id, g.current_club)
+            if plan is None:
+                flash("プレビューの有効期限が切れました。もう一度CSVを選んでください。", "warning")
+                return _back()
+            result = apply_member_import(plan, job_id=job_id)
+        else:
+            file = request.files.get('file')
+            if not file:
+                return "ファイルが選択されていません", 400
+            stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig')
+            result = import_members_csv(stream, g.current_club, job_id=job_id)
+    except (UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        _set_import_progress(job_id, g.current_club, done=True, error=str(e))
+        flash(f"CSVを読み込めませんでした（UTF-8 のCSVか確認してください）: {e}", "error")
+        return _back()
+
+    if result.stale:
+        codes = "、".join(result.stale[:10]) + (f" ほか{len(result.stale) - 10}件" if len(result.stale) > 10 else "")
+        flash(f"プレビューの後に会員データが変更されたため、取り込みませんでした（会員ID: {codes}）。"
+              "もう一度プレビューからやり直してください。", "error")
+        return _back()
+    if result.conflict:
+        # 取り込み中に別の端末が同じ会員IDを登録した等。コミット済みの分をそのまま伝える
+        if preview_id:
+            done = f"更新 {result.updated}件・新規 {result.inserted}件は取り込み済みです"
+            retry = "もう一度プレビューからやり直してください"
+        elif result.committed_line:
+            done = (f"CSV の {result.committed_line}行目までは取り込み済みです"
+                    f"（新規 {result.inserted}件 / 更新 {result.updated}件）")
+            retry = f"{result.committed_line + 1}行目以降を取り込み直してください"
+        else:
+            done, retry = "何も取り込んでいません", "もう一度お試しください"
+        flash(f"取り込み中に会員データが変更されたため、途中で中止しました。{done}。{retry}。", "error")
+        return _back()
+
+    _flash_import_result(result)
+
+    # 上部の「◯件インポートしました」は実際に書き込んだ件数（新規＋更新。変更なしは含めない）
+    written = result.inserted + result.updated
+    if fetch:
+        return jsonify(success=True, imported=written, redirect=url_for('members', imported=written))
+    return redirect(url_for('members', imported=written))
+
+
+@app.route('/members/upload/preview', methods=['POST'])
+def upload_members_preview():
+    """会員CSVの取り込みプレビュー（新規・更新（項目ごと）・変更なし・取り込まない行）。DB には書かない"""
+    file = request.files.get('file')
+    if not file:
+        return "ファイルが選択されていません", 400
+    stream = io.TextIOWrapper(file.stream, encoding='utf-8-sig')
+    try:
+        plan = plan_member_import(stream, g.current_club)
+    except (UnicodeDecodeError, csv.Error) as e:
+        flash(f"CSVを読み込めませんでした（UTF-8 のCSVか確認してください）: {e}", "error")
+        return redirect(url_for('members'))
+
+    return render_template(
+        "members_import_preview.html",
+        plan=plan,
+        preview_id=_store_import_preview(plan),
+        ttl_minutes=int(IMPORT_PREVIEW_TTL.total_seconds() // 60),
+        show=IMPORT_PREVIEW_SHOW,
+        field_labels=MEMBER_IMPORT_FIELD_LABELS,
+    )
+
+
+@app.get('/api/members/upload/<job_id>/progress')
+def member_upload_progress(job_id):
+    """取り込み中の進捗（処理済み行数・チャンク数）。画面が0.5秒ごとに問い合わせる"""
+    entry = read_job_state("member_import", _import_progress_id(g.current_club, job_id))
+    if not entry or entry.get("club_id") != g.current_club:
+        return jsonify(success=False, message="進捗が見つかりません"), 404
+    entry.pop("club_id", None)
+    return jsonify(success=True, **entry)
+
+
+@app.route('/members/export')
+def export_members():
+    output = io.StringIO()
+    writer = csv.writer(output)
+
+    # 出力カラム：内部PK id は含めない
+    writer.writerow(['member_code', 'name', 'kana', 'grade', 'member_type'])
+
+    # 並び順：
+    #   1) 数字だけの member_code を数値グループとして先に並べ、数値昇順
+    #   2) 英字を含むものは文字昇順
+    #   3) member_code が None は最後（同値時は name → kana）
+    q = (
+        Member.query
+        .filter_by(club_id=g.current_club, is_active=True)
+        .order_by(
+            member_code_order(),
+            Member.name.asc(),
+            Member.kana.asc()
+        )
+    )
+
+    for m in q.all():
+        # None 安全化
+        member_code = (getattr(m, "member_code", "") or "")
+        writer.writerow([member_code, m.name, m.kana, m.grade, m.member_type])
+
+    output.seek(0)
+    bom = '\ufeff'  # UTF-8 BOM
+    return send_file(
+        io.BytesIO((bom + output.read()).encode('utf-8')),
+        mimetype='text/csv',
+        as_attachment=True,
+        download_name='members.csv'
+    )
+
+# 会員削除（退会）処理
+@app.route('/delete/<member_id>', methods=['POST'])
+def delete_member(member_id):
+    member = Member.query.get_or_404(member_id)
+
+    # ✅ 削除前チェック：本日の参加者にいるなら削除不可
+    today = datetime.utcnow().strftime('%Y-%m-%d')
+    from models import Attendance
+    in_today = (
+        db.session.query(Attendance.id)
+        .filter(Attendance.club_id == member.club_id, Attendance.date == today,
+                Attendance.member_id == str(member_id),
+                Attendance.left_at.is_(None), Attendance.cancelled_at.is_(None))
+        .first()
+    )
+    if in_today:
+        flash("この会員は現在参加中ですので退会できません", "error")
+        return redirect(url_for('members'))
+
+    # 退会（論理削除）
+    member.is_active = False
+    member.left_at = datetime.utcnow()
+    db.session.commit()
+
+    flash(f"{member.name} さんを退会にしました。", "success")
+    return redirect(url_for('members'))
+
+@app.route("/members/inactive")
+def inactive_members():
+    # 数字だけの member_code は数値順、英字を含むものは文字順
+    q = Member.query.filter_by(club_id=g.current_club, is_active=False)
+
+    page = keyset_paginate(q, [(Member.member_code_sort, False, False), (Member.id, False, False)], Member.id)
+    return render_template("members_inactive.html", members=page.rows, page=page)
+
+@app.post("/members/<member_id>/restore")
+def restore_member(member_id):
+    m = Member.query.get(member_id)
+    if not m:
+        flash("会員が見つかりませんでした。", "error")
+        return redirect(url_for("inactive_members"))
+    if m.is_active:
+        flash("すでに現役会員です。", "info")
+        return redirect(url_for("inactive_members"))
+
+    # 復旧処理：現役化 + 退会日時クリア
+    m.is_active = True
+    m.left_at = None
+    db.session.commit()
+    flash(f"{m.name} さんを現役に復旧しました。", "success")
+    return redirect(url_for("inactive_members"))
+
+@app.route("/match/edit")
+def match_edit():
+    # 並び替えパラメータ（全会員名簿）
+    sort_members = request.args.get('sort_members', 'member_code')
+    order_members = request.args.get('order_members', 'asc')
+
+    # 並び替えパラメータ（本日の参加者）
+    sort_participants = request.args.get('sort_participants', 'member_code')
+    order_participants = request.args.get('order_participants', 'asc')
+
+    # 今日の日付（UTC→日本時間にするなら修正要）
+    today = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d")
+
+    # 🔧 追加：本日の参加者IDを取得して除外用に使う
+    from models import Attendance
+    today_ids = [
+        mid for (mid,) in db.session.query(Attendance.member_id).filter(*_open_attendance_filter(today))
+    ]
+
+    # 会員種類のカスタム順序（正会員、臨時会員、指導員、スタッフ）
+    member_type_order = case(
+        (Member.member_type == '正会員', 1),
+        (Member.member_type == '臨時会員', 2),
+        (Member.member_type == '指導員', 3),
+        (Member.member_type == 'スタッフ', 4),
+        else_=5
     )
 
     # 並び替え処理（全会員名簿）
@@ -1291,25 +2201,7 @@ def match_edit():
         sort_column = member_type_order.asc() if order_members == 'asc' else member_type_order.desc()
         members = members_query.order_by(sort_column).all()
     elif sort_members == 'member_code' or not sort_members:
-        is_numeric = case((expr_member_code_is_numeric(), 1), else_=0)
-        num_value  = expr_member_code_numeric_value()
-
-        if order_members == 'desc':
-            members = (members_query
-                       .order_by(
-                           is_numeric.asc(),
-                           num_value.desc(),
-                           Member.member_code.desc()
-                       )
-                       .all())
-        else:
-            members = (members_query
-                       .order_by(
-                           is_numeric.desc(),
-                           num_value.asc(),
-                           Member.member_code.asc()
-                       )
-                       .all())
+        members = members_query.order_by(member_code_order(order_members)).all()
 
     else:
         sort_column = getattr(Member, sort_members, Member.id)
@@ -1323,13 +2215,14 @@ def match_edit():
         sort_members=sort_members,
         order_members=order_members,
         sort_participants=sort_participants,
-        order_participants=order_participants
+        order_participants=order_participants,
+        room=current_room(),  # 受付する会場（?room=。会場が1つなら空）
     )
 
 @app.route("/match/play", methods=["GET", "POST"])
 def match_play():
     if "participants" not in session or not session["participants"]:
-        return redirect(url_for("match_edit"))
+        return redirect(url_for("match_edit", room=current_room() or None))
 
     # 並び替え設定
     sort_key = request.args.get('sort', 'grade')
@@ -1349,21 +2242,7 @@ def match_play():
         )
         sort_column = sort_column.asc() if sort_order == 'asc' else sort_column.desc()
     elif sort_key == 'member_code' or not sort_key:
-        is_numeric = case((expr_member_code_is_numeric(), 1), else_=0)
-        num_value  = expr_member_code_numeric_value()
-
-        if sort_order == 'desc':
-            sort_column = (
-                is_numeric.asc(),
-                num_value.desc(),
-                Member.member_code.desc()
-            )
-        else:
-            sort_column = (
-                is_numeric.desc(),
-                num_value.asc(),
-                Member.member_code.asc()
-            )
+        sort_column = member_code_order(sort_order)
 
     else:
         sort_columns = {
@@ -1418,6 +2297,7 @@ def match_play():
         strength_order_map=strength_order_map,
         handicap_map=handicap_map,
         handicap_list=handicap_list,
+        room=current_room(),  # この端末の会場（?room=）
     )
 
 # 補助関数
@@ -1426,18 +2306,6 @@ def get_default_card_count():
     s = Setting.query.filter_by(club_id=g.current_club, key='default_card_count').first()
     return int(s.value) if (s and (s.value or '').isdigit()) else 5
 
-def get_member_options(exclude_ids):
-    all_members = (
-        Member.query
-        .filter_by(club_id=g.current_club)   # ★クラブ境界
-        .order_by(Member.kana)
-        .all()
-    )
-    return "".join(
-        f"<option value='{m.id}'>{m.name}</option>"
-        for m in all_members if m.id not in exclude_ids
-    )
-
 @app.route("/results")
 def results_index():
     """
@@ -1480,10 +2348,11 @@ def results_index():
         # 未認定 or 不明は -1（どのStrengthよりも弱い）
         return strength_order_map.get(grade_name, -1)
 
-    # --- 正会員のみ対象（表示順はここでは固定しない） ---
+    # --- 正会員のみ対象（member_code の自然順で取得＝既定の表示順） ---
     members = (
         Member.query
         .filter_by(club_id=g.current_club, member_type="正会員", is_active=True)
+        .order_by(member_code_order())
         .all()
     )
 
@@ -1534,17 +2403,9 @@ def results_index():
     default_sorted = sorted(rows, key=lambda x: (-x["winrate"], -x["wins"], -x["games"]))
 
     # --- 並び替え ---
-    def _code_key_for_row(row: dict):
-        s = str(row.get("member_code") or "")
-        is_num = s.isdigit()
-        return (not is_num, int(s) if is_num else 0, s)
-
-    if not sort_key:
-        # 既定は member_code の“自然順”昇順
-        rows = sorted(rows, key=_code_key_for_row)
-    else:
+    # 既定（member_code の“自然順”昇順）は取得順のまま。それ以外は集計値で並べ替える
+    if sort_key and sort_key != "member_code":
         key_funcs = {
-            "member_code": _code_key_for_row,                 # ★自然順
             "id":          lambda x: x["id"],
             "name":        lambda x: x["name"],
             "grade":       lambda x: x["grade_order"],
@@ -1552,8 +2413,13 @@ def results_index():
             "wins":        lambda x: x["wins"],
             "winrate":     lambda x: x["winrate"],
         }
-        keyfunc = key_funcs.get(sort_key) or _code_key_for_row
-        rows = sorted(rows, key=keyfunc, reverse=(sort_order == "desc"))
+        keyfunc = key_funcs.get(sort_key)
+        if keyfunc:
+            rows = sorted(rows, key=keyfunc, reverse=(sort_order == "desc"))
+        elif sort_order == "desc":
+            rows.reverse()
+    elif sort_key and sort_order == "desc":
+        rows.reverse()
 
 
     return render_template(
@@ -1613,10 +2479,11 @@ def public_results_index_token_canonical(club_id, token):
     def grade_order_value(grade_name: str) -> int:
         return strength_order_map.get(grade_name, -1)
 
-    # --- 対象：現役の正会員 ---
+    # --- 対象：現役の正会員（member_code の自然順で取得） ---
     members = (
         Member.query
         .filter_by(club_id=g.current_club, member_type="正会員", is_active=True)
+        .order_by(member_code_order())
         .all()
     )
 
@@ -1658,16 +2525,10 @@ def public_results_index_token_canonical(club_id, token):
             "winrate": winrate,
         })
 
-    # --- 並び替え（既定：member_code の“自然順”＝数字は数値として、英字混じりは文字列として） ---
-    def _code_key(row: dict):
-        s = str(row.get("member_code") or "")
-        is_num = s.isdigit()
-        # 数字だけ： (False, 数値, 元文字列)  /  英字混じり： (True, 0, 元文字列)
-        # → 昇順では「数字グループが先」で数値昇順、次に英字などが文字列昇順
-        return (not is_num, int(s) if is_num else 0, s)
-
+    # --- 並び替え（既定：member_code の“自然順”＝取得順。数字は数値として、英字混じりは文字列として） ---
     if not sort_key or sort_key == "member_code":
-        rows = sorted(rows, key=_code_key, reverse=(sort_order == "desc"))
+        if sort_order == "desc":
+            rows.reverse()
     else:
         key_funcs = {
             "id":       lambda x: x["id"],
@@ -1677,8 +2538,11 @@ def public_results_index_token_canonical(club_id, token):
             "wins":     lambda x: x["wins"],
             "winrate":  lambda x: x["winrate"],
         }
-        keyfunc = key_funcs.get(sort_key, _code_key)
-        rows = sorted(rows, key=keyfunc, reverse=(sort_order == "desc"))
+        keyfunc = key_funcs.get(sort_key)
+        if keyfunc:
+            rows = sorted(rows, key=keyfunc, reverse=(sort_order == "desc"))
+        elif sort_order == "desc":
+            rows.reverse()
 
     return render_template(
         "public_results.html",
@@ -2029,17 +2893,14 @@ def export_member_links():
     writer = csv.writer(output)
     writer.writerow(["member_id", "name", "url"])
 
+    # 念のため未付与の現役会員にはまとめて発行してから出力
+    if issue_missing_qr_tokens(g.current_club, active_only=True):
+        db.session.commit()
+
     # 公開URLベース（環境変数 PUBLIC_BASE_URL 優先）
     # ローカル検証例: set PUBLIC_BASE_URL=http://192.168.1.23:5000
     for m in Member.query.filter_by(club_id=g.current_club, is_active=True).order_by(Member.kana).all():
         token = getattr(m, "qr_token", "") or ""
-        if not token:
-            # 念のため未付与なら生成（重複防止ループ）
-            token = _issue_token(16)
-            while Member.query.filter_by(club_id=g.current_club, qr_token=token).first():
-                token = _issue_token(16)
-            m.qr_token = token
-            db.session.commit()
         url = _build_member_public_url(token)
         display_code = getattr(m, "member_code", None) or m.id
         writer.writerow([display_code, m.name, url])
@@ -2092,9 +2953,10 @@ def results_export_csv():
         return strength_order_map.get(grade_name, -1)
 
     # 正会員のみ対象（/results と同様） :contentReference[oaicite:3]{index=3}
+    # 出力順は会員ID（member_code）の自然順：取得順のまま
     members = Member.query.filter_by(
         club_id=g.current_club, member_type="正会員", is_active=True
-    ).all()
+    ).order_by(member_code_order()).all()
 
     # 対局結果（期間フィルタ）ベースクエリ（/results と同様） :contentReference[oaicite:4]{index=4}
     base = db.session.query(MatchResult, Match).join(Match, MatchResult.match_id == Match.id)
@@ -2135,17 +2997,6 @@ def results_export_csv():
             "winrate": winrate,
         })
 
-    # ▼ 会員ID（display_code = r["id"]）で自然順ソート
-    #    - 数字のみ: 数値昇順（先に並ぶ）
-    #    - 英字等含む: 文字列昇順（数字の後に並ぶ）
-    def _natkey_display_code(code: str):
-        s = (code or "").strip()
-        if s.isdigit():
-            return (0, int(s), s)  # 数字グループ（先頭）・数値キー
-        return (1, None, s)        # 非数字グループ（後方）・文字列キー
-
-    rows = sorted(rows, key=lambda x: _natkey_display_code(x["id"]))
-
     # CSV生成（BOM付きUTF-8でExcel想定）
     output = io.StringIO()
     writer = csv.writer(output)
@@ -2202,7 +3053,10 @@ def results_inactive_index():
         return strength_order_map.get(grade_name, -1)
 
     # 退会者のみ
-    members = Member.query.filter_by(club_id=g.current_club, member_type="正会員", is_active=False).all()
+    members = (Member.query
+               .filter_by(club_id=g.current_club, member_type="正会員", is_active=False)
+               .order_by(member_code_order())   # member_code の自然順（会員ID順の並べ替えはこの取得順）
+               .all())
 
     # 期間フィルタ付きの成績ベース
     base = db.session.query(MatchResult, Match).join(Match, MatchResult.match_id == Match.id)
@@ -2246,22 +3100,14 @@ def results_inactive_index():
     # デフォルト並び（勝率 desc → 勝数 desc → 対局数 desc）
     default_sorted = sorted(rows, key=lambda x: (-x["winrate"], -x["wins"], -x["games"]))
 
-    # 数字のみ → 数値順、英字含む → 文字順（数字グループが先）
-    def natkey(code: str):
-        s = (code or "").strip()
-        # 数字のみか判定
-        is_numeric = s.isdigit()
-        # グループ: 0=数字のみ, 1=英字含む
-        group = 0 if is_numeric else 1
-        num = int(s) if is_numeric else 0
-        return (group, num, s)
-
     if not sort_key:
         rows = default_sorted
+    elif sort_key in ("member_code", "id"):
+        # 数字のみ → 数値順、英字含む → 文字順（数字グループが先）＝取得順
+        if sort_order == "desc":
+            rows.reverse()
     else:
         key_funcs = {
-            "member_code": lambda x: natkey(x["member_code"]),  
-            "id":          lambda x: natkey(x["member_code"]),  
             "name":        lambda x: x["name"],
             "grade":       lambda x: x["grade_order"],
             "games":       lambda x: x["games"],
@@ -2431,211 +3277,455 @@ def normalize_result_for_initial_assessment(
 
     return result_self, result_opp
 
-@app.route('/save_match_result', methods=['POST'])  # JavaScript から送られてきた勝敗データをDBに記録する役割のPOST用API
-def save_match_result():
-    data = request.get_json()
-    match_type = data.get("match_type")
-    card_index = data.get("card_index")
-    today_str = datetime.now().strftime("%Y-%m-%d")
-
-    # 🔽 フリー対局の場合は記録せず、カード内容をリセットのみ行って終了
-    # 指導対局は「記録する」場合があるのでここでは除外
-    if match_type in ["フリー", "フリー対局"]:
-        card = MatchCardState.query.filter_by(date=today_str, card_index=card_index).first()
-        if card:
-            card.match_type = "認定戦"
-            card.p1_id = ""
-            card.p2_id = ""
-            card.status = "pending"
-            card.info_html = ""
-            card.original_html1 = ""
-            card.original_html2 = ""
-            db.session.commit()
-        return jsonify({"success": True, "message": f"{match_type}のため記録は保存されません。"})
-
-    try:
-        # パラメータの取得
-        p1_id = data["player1_id"]
-        p2_id = data["player2_id"]
-        result1 = data.get("result1", "") or ""
-        result2 = data.get("result2", "") or ""
-        handicap = data.get("handicap", "")
-
-        # --- 二重記録対策（30秒以内の完全重複をスキップ） ---------------------
-        from sqlalchemy import or_, and_
-        now_utc = datetime.utcnow()
-        window_start = now_utc - timedelta(seconds=30)
-
-        # 同一カード由来の二重送信で、p1/p2 の並びが同じ想定。
-        # 念のため逆順ケースも考慮。
-        recent_matches = (Match.query
-            .filter(Match.club_id == g.current_club)
-            .filter(Match.ended_at >= window_start)
-            .filter(or_(
-                and_(Match.player1_id == p1_id, Match.player2_id == p2_id),
-                and_(Match.player1_id == p2_id, Match.player2_id == p1_id),
-            ))
-            .order_by(Match.ended_at.desc())
-            .all())
-
-        def _results_equal(m: Match) -> bool:
-            # この対局の2本の結果を取得して、プレイヤーIDと結果の対応で一致判定
-            rs = {r.player_id: r.result for r in m.results}  # player_id -> "○/●/△/◇/◆"
-            r1 = rs.get(p1_id, None)
-            r2 = rs.get(p2_id, None)
-            # 同じ向き（p1→p2）で一致 or 逆向き（p2→p1）で一致、のいずれか
-            same = (r1 == result1 and r2 == result2)
-            rev  = (rs.get(p2_id) == result1 and rs.get(p1_id) == result2)
-            # 種別と駒落ちも一致させる
-            return (m.match_type == match_type and (m.handicap or "") == (handicap or "")) and (same or rev)
-
-        for m in recent_matches:
-            # 完全に一致するものがあればスキップ（成功扱いで返す）
-            if _results_equal(m):
-                # 画面のカードはリセットしたいので、既存のカードも初期化して返す
-                today_str = datetime.now().strftime("%Y-%m-%d")
-                card = MatchCardState.query.filter_by(date=today_str, card_index=card_index).first()
-                if card:
-                    card.match_type = "認定戦"
-                    card.p1_id = ""
-                    card.p2_id = ""
-                    card.status = "pending"
-                    card.info_html = ""
-                    card.original_html1 = ""
-                    card.original_html2 = ""
-                    db.session.commit()
-
-                return jsonify({
-                    "success": True,
-                    "skipped": True,
-                    "message": "同一の対局結果が30秒以内に既に記録されているため、重複保存をスキップしました。"
-                })
-        # ----------------------------------------------------------------------
+def _request_idempotency_key(data=None):
+    """送信ごとの冪等キー（JSON/フォームの idempotency_key か Idempotency-Key ヘッダー）"""
+    key = ((data or {}).get("idempotency_key")
+           or request.form.get("idempotency_key")
+           or request.headers.get("Idempotency-Key")
+           or "")
+    return str(key).strip()[:64] or None
 
-        # 対局時点の棋力（フロントから渡す想定。なければ空文字）
-        grade_at_time1 = data.get("grade_at_time1", "") or ""
-        grade_at_time2 = data.get("grade_at_time2", "") or ""
-
-        # --- 相互補完（どちらか一方だけ届いた場合でももう一方を補う） ---
-        if result1 and not result2 and result1 in RESULT_COMPLEMENT_MAP:
-            result2 = RESULT_COMPLEMENT_MAP[result1]
-        if result2 and not result1 and result2 in RESULT_COMPLEMENT_MAP:
-            # 逆写像で補完
-            inv = {v: k for k, v in RESULT_COMPLEMENT_MAP.items()}
-            if result2 in inv:
-                result1 = inv[result2]
-
-        # --- 初回認定の特例（◆/◇）を冪等に適用 ---
-        # 自分視点で正規化 → 相手視点も整合するよう個別に実行
-        result1, result2 = normalize_result_for_initial_assessment(
-            match_type, result1, result2, grade_at_time1, grade_at_time2
-        )
-        result2, result1 = normalize_result_for_initial_assessment(
-            match_type, result2, result1, grade_at_time2, grade_at_time1
-        )
 
-        # Matchレコードの作成
-        match = Match(
-            player1_id=p1_id,
-            player2_id=p2_id,
-            match_type=match_type,
-            handicap=handicap,
-            started_at=datetime.utcnow(),
-            ended_at=datetime.utcnow(),
-            is_recorded=True
-        )
-        db.session.add(match)
-        db.session.commit()
+def _find_match_by_idempotency_key(key):
+    """同じキーで記録済みの対局（club_id + idempotency_key の一意インデックスで1回引くだけ）"""
+    if not key:
+        return None
+    return Match.query.filter_by(club_id=g.current_club, idempotency_key=key).first()
 
-        # MatchResultレコード2件（勝敗）を作成
-        member1 = Member.query.get(p1_id)
-        member2 = Member.query.get(p2_id)
 
-        grade_at_time1 = data.get("grade_at_time1", "")
-        grade_at_time2 = data.get("grade_at_time2", "")
+RESULT_DUPLICATE_WINDOW = timedelta(seconds=30)   # 冪等キーなしの送信を二重記録とみなす時間
 
-        # ★追加：相手の棋力（未送信なら現在棋力でフォールバック）
-        p1_opponent_grade = data.get("p1_opponent_grade") or (member2.grade or "")
-        p2_opponent_grade = data.get("p2_opponent_grade") or (member1.grade or "")
 
-        result1_entry = MatchResult(
-            match_id=match.id,
-            player_id=p1_id,
-            result=result1,
-            grade_at_time=grade_at_time1,
-            opponent_name=member2.name,
-            opponent_grade=p1_opponent_grade,
-            promoted=False
-        )
+def _find_duplicate_match(key, data):
+    """
+    記録済みの同じ対局結果（二重送信・再送の判定）
+    - 冪等キーがあればそれで判定（一意インデックスで1回引くだけ）
+    - キーなしで送られたときは従来の30秒ガード：直近30秒に同じ2人・同じ種別と駒落ち・
+      同じ勝敗の対局があればそれ（結果は1回の SELECT でまとめて読む）
+    """
+    if key:
+        return _find_match_by_idempotency_key(key)
+    p1_id, p2_id = data.get("player1_id"), data.get("player2_id")
+    if not p1_id or not p2_id:
+        return None
+    recent = (Match.query
+              .filter(Match.club_id == g.current_club,
+                      Match.ended_at >= datetime.utcnow() - RESULT_DUPLICATE_WINDOW,
+                      or_(and_(Match.player1_id == p1_id, Match.player2_id == p2_id),
+                          and_(Match.player1_id == p2_id, Match.player2_id == p1_id)),
+                      Match.match_type == data.get("match_type"),
+                      func.coalesce(Match.handicap, "") == (data.get("handicap") or ""))
+              .order_by(Match.ended_at.desc())
+              .all())
+    if not recent:
+        return None
+    results = {}
+    for r in MatchResult.query.filter(MatchResult.match_id.in_([m.id for m in recent])):
+        results.setdefault(r.match_id, {})[r.player_id] = r.result
+    for m in recent:
+        rs = results.get(m.id, {})
+        if rs.get(p1_id) == (data.get("result1") or "") and rs.get(p2_id) == (data.get("result2") or ""):
+            return m
+    return None
 
-        result2_entry = MatchResult(
-            match_id=match.id,
-            player_id=p2_id,
-            result=result2,
-            grade_at_time=grade_at_time2,
-            opponent_name=member1.name,
-            opponent_grade=p2_opponent_grade,
-            promoted=False
-        )
 
-        # === ここから：備考の自動付与（前→後で統一） ===
-        current_grade1 = (member1.grade or "").strip()
-        current_grade2 = (member2.grade or "").strip()
-
-        result1_entry.post_grade = current_grade1
-        result2_entry.post_grade = current_grade2
-
-        def normalize_before(g: str, fallback: str) -> str:
-            """
-            g（対局前棋力）が空の場合は fallback（通常は対局後棋力＝post_grade）を使う。
-            これにより、空→未認定 と誤解して不要な「未認定→X」が付くのを防ぐ。
-            """
-            s = (g or "").strip()
-            if s:
-                return s
-            fb = (fallback or "").strip()
-            return fb or "未認定"
-
-        def set_note_and_flag(entry: MatchResult):
-            after_disp  = (entry.post_grade or "").strip()
-            if not after_disp:
-                return
-            before_disp = normalize_before(entry.grade_at_time, after_disp)
-            if before_disp != after_disp:
-                entry.note = f"{before_disp}→{after_disp}"
-                entry.promoted = True
-
-        set_note_and_flag(result1_entry)
-        set_note_and_flag(result2_entry)
-        # === ここまで：備考の自動付与 ===
-
-        db.session.add_all([result1_entry, result2_entry])
-        db.session.commit()
+def _build_match_result(data, idempotency_key=None):
+    """
+    対局結果（Match＋MatchResult 2件）を作成する。コミットは呼び出し側。
+    data は /save_match_result と同じ形（player1_id, player2_id, result1, result2, match_type, handicap, ...）
+    """
+    match_type = data.get("match_type")
+    card_index = data.get("card_index")
+    p1_id = data["player1_id"]
+    p2_id = data["player2_id"]
+    result1 = data.get("result1", "") or ""
+    result2 = data.get("result2", "") or ""
+    handicap = data.get("handicap", "")
+
+    # 対局時点の棋力（フロントから渡す想定。なければ空文字）
+    grade_at_time1 = data.get("grade_at_time1", "") or ""
+    grade_at_time2 = data.get("grade_at_time2", "") or ""
+
+    # --- 相互補完（どちらか一方だけ届いた場合でももう一方を補う） ---
+    if result1 and not result2 and result1 in RESULT_COMPLEMENT_MAP:
+        result2 = RESULT_COMPLEMENT_MAP[result1]
+    if result2 and not result1 and result2 in RESULT_COMPLEMENT_MAP:
+        # 逆写像で補完
+        inv = {v: k for k, v in RESULT_COMPLEMENT_MAP.items()}
+        if result2 in inv:
+            result1 = inv[result2]
+
+    # --- 初回認定の特例（◆/◇）を冪等に適用 ---
+    # 自分視点で正規化 → 相手視点も整合するよう個別に実行
+    result1, result2 = normalize_result_for_initial_assessment(
+        match_type, result1, result2, grade_at_time1, grade_at_time2
+    )
+    result2, result1 = normalize_result_for_initial_assessment(
+        match_type, result2, result1, grade_at_time2, grade_at_time1
+    )
 
-        # 🔽 🔴 重要：カードのリセットは try 内で行い、その直後に return
-        card = MatchCardState.query.filter_by(date=today_str, card_index=card_index).first()
+    # Matchレコードの作成
+    match = Match(
+        player1_id=p1_id,
+        player2_id=p2_id,
+        match_type=match_type,
+        handicap=handicap,
+        started_at=datetime.utcnow(),
+        ended_at=datetime.utcnow(),
+        is_recorded=True,
+        card_index=card_index,
+        idempotency_key=idempotency_key,
+    )
+    db.session.add(match)
+    db.session.flush()  # match.id を確定
+
+    # MatchResultレコード2件（勝敗）を作成
+    member1 = Member.query.get(p1_id)
+    member2 = Member.query.get(p2_id)
+
+    grade_at_time1 = data.get("grade_at_time1", "")
+    grade_at_time2 = data.get("grade_at_time2", "")
+
+    # ★追加：相手の棋力（未送信なら現在棋力でフォールバック）
+    p1_opponent_grade = data.get("p1_opponent_grade") or (member2.grade or "")
+    p2_opponent_grade = data.get("p2_opponent_grade") or (member1.grade or "")
+
+    result1_entry = MatchResult(
+        match_id=match.id,
+        player_id=p1_id,
+        result=result1,
+        grade_at_time=grade_at_time1,
+        opponent_name=member2.name,
+        opponent_grade=p1_opponent_grade,
+        promoted=False
+    )
+
+    result2_entry = MatchResult(
+        match_id=match.id,
+        player_id=p2_id,
+        result=result2,
+        grade_at_time=grade_at_time2,
+        opponent_name=member1.name,
+        opponent_grade=p2_opponent_grade,
+        promoted=False
+    )
+
+    # === ここから：備考の自動付与（前→後で統一） ===
+    current_grade1 = (member1.grade or "").strip()
+    current_grade2 = (member2.grade or "").strip()
+
+    result1_entry.post_grade = current_grade1
+    result2_entry.post_grade = current_grade2
+
+    def normalize_before(g: str, fallback: str) -> str:
+        """
+        g（対局前棋力）が空の場合は fallback（通常は対局後棋力＝post_grade）を使う。
+        これにより、空→未認定 と誤解して不要な「未認定→X」が付くのを防ぐ。
+        """
+        s = (g or "").strip()
+        if s:
+            return s
+        fb = (fallback or "").strip()
+        return fb or "未認定"
+
+    def set_note_and_flag(entry: MatchResult):
+        after_disp  = (entry.post_grade or "").strip()
+        if not after_disp:
+            return
+        before_disp = normalize_before(entry.grade_at_time, after_disp)
+        if before_disp != after_disp:
+            entry.note = f"{before_disp}→{after_disp}"
+            entry.promoted = True
+
+    set_note_and_flag(result1_entry)
+    set_note_and_flag(result2_entry)
+    # === ここまで：備考の自動付与 ===
+
+    db.session.add_all([result1_entry, result2_entry])
+    return match
+
+
+@app.route('/save_match_result', methods=['POST'])  # JavaScript から送られてきた勝敗データをDBに記録する役割のPOST用API
+def save_match_result():
+    data = request.get_json()
+    match_type = data.get("match_type")
+    card_index = data.get("card_index")
+    today_str = jst_today_str()  # カードの date は画面側と同じ JST 基準
+
+    # 🔽 フリー対局の場合は記録せず、カード内容をリセットのみ行って終了
+    # 指導対局は「記録する」場合があるのでここでは除外
+    if match_type in ["フリー", "フリー対局"]:
+        card = _reset_match_card(today_str, card_index)
         if card:
-            # どちらでもOK：設計に合わせて選択
-            # A) 物理削除（溜めない方針ならこちら）
-            # db.session.delete(card)
-
-            # B) 初期化（「認定戦」に戻す現行仕様を踏襲）
-            card.match_type = "認定戦"
-            card.p1_id = ""
-            card.p2_id = ""
-            card.status = "pending"
-            card.info_html = ""
-            card.original_html1 = ""
-            card.original_html2 = ""
+            db.session.commit()
+            publish_live_event("card", _card_state_dict(card), date=today_str)
+        return jsonify({"success": True, "message": f"{match_type}のため記録は保存されません。"})
+
+    try:
+        # パラメータの取得
+        p1_id = data["player1_id"]
+        p2_id = data["player2_id"]
+
+        # --- 二重記録対策：端末がカード送信ごとに振る冪等キーで判定 -------------
+        idem_key = _request_idempotency_key(data)
+        duplicate = _find_duplicate_match(idem_key, data)
+        if duplicate is None:
+            try:
+                match = _build_match_result(data, idempotency_key=idem_key)
+                db.session.commit()
+            except IntegrityError:
+                # 同じキーの別リクエストが先にコミットした
+                db.session.rollback()
+                duplicate = _find_match_by_idempotency_key(idem_key)
+                if duplicate is None:
+                    raise
+
+        if duplicate is not None:
+            # 画面のカードはリセットしたいので、既存のカードも初期化して返す
+            card = _reset_match_card(today_str, card_index)
+            if card:
+                db.session.commit()
+                publish_live_event("card", _card_state_dict(card), date=today_str)
+            return jsonify({
+                "success": True,
+                "skipped": True,
+                "match_id": duplicate.id,
+                "card": _card_state_dict(card) if card else None,
+                "message": "この対局結果はすでに記録されているため、重複保存をスキップしました。"
+            })
+        # ----------------------------------------------------------------------
+
+        # 🔽 🔴 重要：カードのリセットは try 内で行い、その直後に return
+        # （初期化＝「認定戦」に戻す現行仕様を踏襲）
+        card = _reset_match_card(today_str, card_index)
 
         db.session.commit()
-        return jsonify({"success": True})  # ✅ 必ず返す
+
+        publish_live_event("result", {
+            "match_id": match.id, "card_index": card_index,
+            "player1_id": p1_id, "player2_id": p2_id, "match_type": match_type,
+        }, date=today_str)
+        if card:
+            publish_live_event("card", _card_state_dict(card), date=today_str)
+        return jsonify({"success": True, "card": _card_state_dict(card) if card else None})  # ✅ 必ず返す
 
     except Exception as e:
         db.session.rollback()
         # エラー時はステータスコードも付けて返すとデバッグしやすい
         return jsonify({"success": False, "message": str(e)}), 500
 
+def _reset_card_if_still_seated(date, item):
+    """
+    送信待ちの項目のカードを、まだその対局のままなら初期化する（コミットは呼び出し側）。
+    カードにその2人が座っている（順不同）か、item の card_version が今の版と同じときだけ。
+    戻り値：初期化したカード（しなかったら None）
+    """
+    card = MatchCardState.query.filter_by(
+        club_id=g.current_club, date=date, room=current_room(), card_index=item.get("card_index")
+    ).first()
+    if card is None:
+        return None
+    pair = {str(item.get("player1_id") or ""), str(item.get("player2_id") or "")} - {""}
+    seated = {card.p1_id or "", card.p2_id or ""} - {""}
+    version = item.get("card_version")
+    if not ((pair and pair == seated) or (version is not None and str(version) == str(card.version))):
+        return None
+    return _reset_match_card(date, card.card_index)
+
+
+@app.route("/api/results/sync", methods=["POST"])
+def sync_queued_results():
+    """
+    端末に溜めた対局結果などをまとめて反映する（オフライン時の送信待ちキュー用）
+    入力: { date?, items: [{ client_id, kind: "result" | "promote" | "card_reset", ... }] }
+      - result     : /save_match_result と同じ項目（player1_id, result1, card_index, card_version?, ...）
+                     新しく記録できたときだけ、カードも初期化する
+      - promote    : participant_id, new_grade, reason（/api/promote_player と同じ）
+      - card_reset : card_index, player1_id?, player2_id?, card_version?
+    - カードの初期化は、カードにまだその2人が座っているか card_version が今の版と同じときだけ
+      （再送・遅れて届いた項目で、今そのカードにいる別の組を消さない）
+    - 全件を1トランザクションで処理し、1件ずつ SAVEPOINT で区切る（失敗した項目だけ取り消す）。
+      コミットは最後の1回だけで、ライブ更新（昇段級による members を含む）はそのコミットの後に流す
+      （SAVEPOINT の解放では流さない。確かめるには flask check-results-sync）
+    - client_id が同じ結果は二度記録しない（再送しても安全）
+    出力: { success, results: [{ client_id, status: applied|duplicate|skipped|error, match_id?, message? }], cards }
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get("items") or []
+    date = (data.get("date") or jst_today_str()).strip()
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify(success=False, message="items はオブジェクトの配列で指定してください"), 400
+
+    statuses = []
+    touched_cards = {}
+    recorded = []
+
+    for item in items:
+        client_id = str(item.get("client_id") or "").strip()[:64]
+        kind = item.get("kind") or "result"
+        entry = {"client_id": client_id, "kind": kind}
+        if not client_id:
+            entry.update(status="error", message="client_id がありません")
+            statuses.append(entry)
+            continue
+
+        try:
+            with db.session.begin_nested():
+                if kind == "result":
+                    if item.get("match_type") in ["フリー", "フリー対局"]:
+                        entry["status"] = "skipped"  # フリー対局は記録しない（カードは card_reset で初期化）
+                    else:
+                        existing = _find_match_by_idempotency_key(client_id)
+                        if existing:
+                            entry.update(status="duplicate", match_id=existing.id)
+                        else:
+                            match = _build_match_result(item, idempotency_key=client_id)
+                            db.session.flush()
+                            entry.update(status="applied", match_id=match.id)
+                            recorded.append((match, item))
+                    if entry["status"] == "applied":
+                        card = _reset_card_if_still_seated(date, item)
+                        if card:
+                            touched_cards[card.card_index] = card
+
+                elif kind == "promote":
+                    member = Member.query.filter_by(
+                        club_id=g.current_club, id=item.get("participant_id")
+                    ).first()
+                    new_grade = item.get("new_grade")
+                    if not member or not new_grade:
+                        entry.update(status="error", message="会員が見つかりません")
+                    elif member.grade == new_grade:
+                        entry["status"] = "duplicate"  # 反映済み（再送）
+                    else:
+                        _apply_promotion(member, new_grade, item.get("reason") or "昇段級判定")
+                        entry["status"] = "applied"
+
+                elif kind == "card_reset":
+                    guarded = any(item.get(k) not in (None, "")
+                                  for k in ("player1_id", "player2_id", "card_version"))
+                    if guarded:
+                        card = _reset_card_if_still_seated(date, item)
+                    else:
+                        card = _reset_match_card(date, item.get("card_index"))
+                    if card:
+                        touched_cards[card.card_index] = card
+                        entry["status"] = "applied"
+                    elif guarded:
+                        entry.update(status="skipped", message="カードは既に別の対局に使われています")
+                    else:
+                        entry["status"] = "applied"
+
+                else:
+                    entry.update(status="error", message=f"未対応の種別です: {kind}")
+        except IntegrityError:
+            # 同じ client_id を別リクエストが先に記録した
+            existing = _find_match_by_idempotency_key(client_id)
+            entry.update(status="duplicate", match_id=existing.id if existing else None)
+        except Exception as e:
+            entry.update(status="error", message=str(e))
+        statuses.append(entry)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify(success=False, message=str(e)), 500
+
+    for match, item in recorded:
+        publish_live_event("result", {
+            "match_id": match.id, "card_index": item.get("card_index"),
+            "player1_id": match.player1_id, "player2_id": match.player2_id,
+            "match_type": match.match_type,
+        }, date=date)
+    cards = [_card_state_dict(c) for c in touched_cards.values()]
+    for card in cards:
+        publish_live_event("card", card, date=date)
+
+    return jsonify(success=True, results=statuses, cards=cards)
+
+@app.cli.command("check-results-sync")
+@click.option("--club", "club_id", default="check_results_sync", help="確認用に一時作成するクラブID（終了時に削除）")
+def check_results_sync_command(club_id):
+    """
+    /api/results/sync の確認：失敗する項目と昇段級（promote）が混ざった1回分が、
+    コミット1回で反映され、ライブ更新（members）がそのコミットの後に1回だけ流れること
+    """
+    from models import LiveEvent
+    if Club.query.get(club_id):
+        raise click.ClickException(f"クラブ {club_id} は既に存在します（--club で別の ID を指定してください）")
+    member_id = f"{club_id}-1"
+    db.session.add(Club(id=club_id, name="同期の確認"))
+    db.session.add(Strength(club_id=club_id, name="確認初段", order=1))
+    db.session.add(Strength(club_id=club_id, name="確認二段", order=2))
+    db.session.add(Member(id=member_id, club_id=club_id, member_code="1", name="確認", kana="かくにん",
+                          grade="確認初段", member_type="正会員", is_active=True))
+    db.session.commit()
+    last_event_id = db.session.query(func.max(LiveEvent.id)).scalar() or 0   # 準備で流れた分は数えない
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["logged_in"] = True
+        sess["club_id"] = club_id
+
+    # SQL の流れを順に控える：会員の UPDATE をしたコネクションのコミットと、live_event の INSERT の前後
+    steps = []
+
+    def on_statement(conn, _cursor, statement, *_args):
+        head = statement.lstrip()[:40].upper()
+        if head.startswith("UPDATE MEMBER"):
+            steps.append(("update_member", id(conn)))
+        elif head.startswith("INSERT INTO LIVE_EVENT"):
+            steps.append(("publish", id(conn)))
+
+    def on_commit(conn):
+        steps.append(("commit", id(conn)))
+
+    event.listen(db.engine, "before_cursor_execute", on_statement)
+    event.listen(db.engine, "commit", on_commit)
+    try:
+        res = client.post("/api/results/sync", json={"items": [
+            {"client_id": "check-bad", "kind": "result", "player1_id": "(いない人)", "card_index": "x"},
+            {"client_id": "check-promote", "kind": "promote", "participant_id": member_id,
+             "new_grade": "確認二段", "reason": "確認"},
+        ]})
+    finally:
+        event.remove(db.engine, "before_cursor_execute", on_statement)
+        event.remove(db.engine, "commit", on_commit)
+
+    try:
+        statuses = [r["status"] for r in (res.get_json() or {}).get("results", [])]
+        conns = {c for step, c in steps if step == "update_member"}
+        commits = [i for i, (step, c) in enumerate(steps) if step == "commit" and c in conns]
+        publishes = [i for i, (step, _) in enumerate(steps) if step == "publish"]
+        members_events = (LiveEvent.query.filter_by(club_id=club_id, kind="members")
+                          .filter(LiveEvent.id > last_event_id).count())
+        grade = db.session.get(Member, member_id).grade
+        print(f"状態 {statuses}  会員を更新したコネクションのコミット {len(commits)}回  "
+              f"live_event {len(publishes)}件（members {members_events}件）  段級位 {grade}")
+        problems = []
+        if res.status_code != 200 or statuses != ["error", "applied"]:
+            problems.append(f"応答が想定外です（HTTP {res.status_code} {statuses}）")
+        if len(commits) != 1:
+            problems.append(f"コミットが {len(commits)} 回です（1回のはず）")
+        if members_events != 1:
+            problems.append(f"members のライブ更新が {members_events} 件です（1件のはず）")
+        if commits and publishes and min(publishes) < commits[0]:
+            problems.append("コミットの前にライブ更新が流れています")
+        if grade != "確認二段":
+            problems.append("昇段級が反映されていません")
+        if problems:
+            raise click.ClickException(" / ".join(problems))
+        print("OK")
+    finally:
+        db.session.rollback()
+        for model, col in ((LiveEvent, LiveEvent.club_id), (GradeHistory, GradeHistory.club_id),
+                           (Member, Member.club_id), (Strength, Strength.club_id), (Setting, Setting.club_id)):
+            db.session.query(model).filter(col == club_id).delete(synchronize_session=False)
+        db.session.query(Club).filter(Club.id == club_id).delete(synchronize_session=False)
+        db.session.commit()
+
+
 @app.route("/check_promotion", methods=["POST"])
 def check_promotion():
     """
@@ -2843,17 +3933,9 @@ def check_promotion():
 
 from models import InitialAssessmentResult  # ← 忘れずインポート
 
-@app.route('/api/promote_player', methods=['POST'])
-def promote_player():
-    data = request.get_json()
-    player_id = data.get('participant_id')
-    new_grade = data.get('new_grade')
-    reason = data.get('reason', '昇段級判定')
-
-    member = Member.query.get(player_id)
-    if not member:
-        return jsonify({'success': False, 'message': '会員が見つかりません'}), 404
-
+def _apply_promotion(member, new_grade, reason):
+    """昇段級を反映（履歴・ブラインド勝敗削除・初回認定記録・カウントリセット）。コミットは呼び出し側"""
+    player_id = member.id
     before = member.grade
     member.grade = new_grade
 
@@ -2888,6 +3970,19 @@ def promote_player():
     )
     db.session.add(reset_entry)
 
+
+@app.route('/api/promote_player', methods=['POST'])
+def promote_player():
+    data = request.get_json()
+    player_id = data.get('participant_id')
+    new_grade = data.get('new_grade')
+    reason = data.get('reason', '昇段級判定')
+
+    member = Member.query.get(player_id)
+    if not member:
+        return jsonify({'success': False, 'message': '会員が見つかりません'}), 404
+
+    _apply_promotion(member, new_grade, reason)
     db.session.commit()
 
     return jsonify({'success': True, 'message': f'{member.name} さんを {new_grade} に昇段級しました'})
@@ -2902,16 +3997,24 @@ def record_result():
     match_type = data["match_type"]
     handicap = data["handicap"]
 
+    # 同じ冪等キーで記録済みなら何もしない（再送・二重クリック。キーなしは30秒ガード）
+    idem_key = _request_idempotency_key(data)
+    duplicate = _find_duplicate_match(idem_key, data)
+    if duplicate is not None:
+        return jsonify({"success": True, "skipped": True, "message": "対局結果は記録済みです。"})
+
     # Match テーブルに保存
     match = Match(
         player1_id=p1_id,
         player2_id=p2_id,
         match_type=match_type,
         handicap=handicap,
-        is_recorded=True
+        is_recorded=True,
+        ended_at=datetime.utcnow(),
+        idempotency_key=idem_key,
     )
     db.session.add(match)
-    db.session.commit()  # match.id を取得するために一度commit
+    db.session.flush()  # match.id を確定（結果と同じトランザクションでコミット）
 
     # MatchResult を2件追加（勝敗）
     mr1 = MatchResult(
@@ -2927,75 +4030,521 @@ def record_result():
         grade_at_time=get_current_grade(p2_id)
     )
     db.session.add_all([mr1, mr2])
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # 同じキーの別リクエストが先にコミットした
+        db.session.rollback()
+        return jsonify({"success": True, "skipped": True, "message": "対局結果は記録済みです。"})
 
     return jsonify({"success": True, "message": "対局結果を記録しました。"})
 
-@app.route('/api/match_card_state/save', methods=['POST'])  # 単一 or 複数カード保存
-def save_match_card_state():
-    data = request.get_json()
-    date = data.get("date")
-    cards = data.get("cards", [])
+# ===== ライブ更新（SSE）: 複数タブレット間でカード/受付/結果を即時共有 =====
+# 各変更は live_event テーブルに1行書く（= ワーカー間/サーバー間のバス）。
+# 各ワーカーは1本のポーリングスレッドで新着だけを読み、自プロセス内の購読者キューへ配る。
+# ※ SSE は接続を張りっぱなしにするため、gunicorn は gthread 等のスレッドワーカーで動かす（Procfile 参照）
+import queue
+from flask import has_request_context
 
-    if not date:
-        return jsonify({"result": "ng", "message": "date is required"}), 400
+LIVE_POLL_INTERVAL = 1.0            # 秒：DBバスのポーリング間隔（ワーカーごとに1本）
+LIVE_HEARTBEAT_INTERVAL = 15        # 秒：無通信時のコメント送信（プロキシの切断防止）
+LIVE_STREAM_MAX_SECONDS = 300       # 秒：1接続の最長時間（EventSource が自動再接続する）
+LIVE_EVENT_RETENTION = timedelta(days=2)
+LIVE_POLL_LOOKBACK = 500            # 件：読み済みの最大 id からこれだけ戻って読み直す
+                                    # （同時に書かれたイベントは id 順にコミットされるとは限らないため。読んだ id は覚えて重複排除）
 
-    # 🟢 単一カード：UPSERT（当該カードだけ更新/挿入）＝他カードは消さない
-    if len(cards) == 1:
-        card = cards[0]
-        idx = card.get("index")
-        if idx is None:
-            return jsonify({"result": "ng", "message": "card.index is required"}), 400
 
-        existing = (MatchCardState.query
-                    .filter_by(club_id=g.current_club, date=date, card_index=idx)
-                    .first())
-        if existing:
-            existing.match_type    = card.get("match_type")
-            existing.p1_id         = card.get("p1_id")
-            existing.p2_id         = card.get("p2_id")
-            existing.status        = card.get("status")
-            existing.info_html     = card.get("info_html")
-            existing.original_html1= card.get("original_html1")
-            existing.original_html2= card.get("original_html2")
-        else:
-            new_card = MatchCardState(
-                club_id=g.current_club,
-                date=date,
-                card_index=idx,
-                match_type=card.get("match_type"),
-                p1_id=card.get("p1_id"),
-                p2_id=card.get("p2_id"),
-                status=card.get("status"),
-                info_html=card.get("info_html"),
-                original_html1=card.get("original_html1"),
-                original_html2=card.get("original_html2"),
-            )
-            db.session.add(new_card)
+ROOM_MAX_LEN = 20  # MatchCardState.room などの列幅
 
-        db.session.commit()
-        return jsonify({"result": "ok", "mode": "upsert-one"})
 
-    # 🟡 複数カード（「全て保存」など）：従来通り 全削除→再保存
-    MatchCardState.query.filter_by(club_id=g.current_club, date=date).delete()
+def current_room() -> str:
+    """
+    この端末の対局会場（大会日などで部屋を分けるクラブ用）。'' は会場が1つのクラブ
+    画面は URL の ?room= を覚えておき、GET は ?room=、POST は X-Room ヘッダー（URL エンコード済み）で送る
+    """
+    if not has_request_context():
+        return ""
+    from urllib.parse import unquote
+    room = (unquote(request.headers.get("X-Room") or "")
+            or request.args.get("room")
+            or (request.get_json(silent=True) or {}).get("room")
+            or "")
+    return str(room).strip()[:ROOM_MAX_LEN]
+
+
+def _card_state_dict(c: MatchCardState) -> dict:
+    """MatchCardState → API/イベント共通の dict"""
+    return {
+        "card_index": c.card_index,
+        "room": c.room or "",
+        "match_type": c.match_type,
+        "p1_id": c.p1_id,
+        "p2_id": c.p2_id,
+        "status": c.status,
+        "handicap": c.handicap or "",
+        "sente": c.sente or "",
+        "p1_grade": c.p1_grade or "",
+        "p2_grade": c.p2_grade or "",
+        "p1_next_grade": c.p1_next_grade or "",
+        "p2_next_grade": c.p2_next_grade or "",
+        "started_at": c.started_at.isoformat() if c.started_at else None,
+        "version": c.version,
+    }
+
 
-    for card in cards:
-        new_card = MatchCardState(
-            club_id=g.current_club,
-            date=date,
-            card_index=card.get("index"),
-            match_type=card.get("match_type"),
-            p1_id=card.get("p1_id"),
-            p2_id=card.get("p2_id"),
-            status=card.get("status"),
-            info_html=card.get("info_html"),
-            original_html1=card.get("original_html1"),
-            original_html2=card.get("original_html2"),
-        )
-        db.session.add(new_card)
+class LiveEventHub:
+    """プロセス内ファンアウト：(club_id, date, room) ごとの購読キューに DB バスの新着を配る"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs = {}          # (club_id, date, room) -> set[queue.Queue]
+        self._last_id = None
+        self._seen = set()       # 読み直し範囲（_last_id - LIVE_POLL_LOOKBACK より後）で配った id
+        self._thread = None
+        self._last_prune = None
+        self._listeners = []     # 新着イベントごとに呼ぶ関数（対局待ちキューの読み直しなど）
+
+    def ensure_running(self):
+        """ポーラーが止まっていれば起動（fork 後のワーカーで最初に必要になった時点で）"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="live-event-poller", daemon=True)
+                self._thread.start()
+
+    def subscribe(self, club_id, date, room=""):
+        q = queue.Queue(maxsize=500)
+        with self._lock:
+            self._subs.setdefault((club_id, date, room), set()).add(q)
+        self.ensure_running()
+        return q
+
+    def add_listener(self, fn):
+        """ポーラーが読んだ全イベントを fn(row) にも渡す（購読者がいなくても呼ばれる）"""
+        with self._lock:
+            self._listeners.append(fn)
+
+    def unsubscribe(self, club_id, date, q, room=""):
+        with self._lock:
+            subs = self._subs.get((club_id, date, room))
+            if subs:
+                subs.discard(q)
+                if not subs:
+                    self._subs.pop((club_id, date, room), None)
+
+    def _run(self):
+        from models import LiveEvent
+        t = LiveEvent.__table__
+        with app.app_context():
+            while True:
+                try:
+                    rows = []
+                    with db.engine.connect() as conn:
+                        if self._last_id is None:
+                            # 起動時点で既にあるイベントは配らない（読み直し範囲の分も読み済みにしておく）
+                            self._last_id = conn.execute(db.select(func.max(t.c.id))).scalar() or 0
+                            self._seen = set(conn.execute(
+                                db.select(t.c.id).where(t.c.id > self._last_id - LIVE_POLL_LOOKBACK)
+                            ).scalars())
+                        # 後から遅れてコミットされた小さい id も拾えるよう、少し戻った所から id だけ読む
+                        floor = self._last_id - LIVE_POLL_LOOKBACK
+                        ids = conn.execute(
+                            db.select(t.c.id).where(t.c.id > floor).order_by(t.c.id).limit(LIVE_POLL_LOOKBACK + 1000)
+                        ).scalars().all()
+                        new_ids = [i for i in ids if i not in self._seen][:1000]
+                        if new_ids:
+                            rows = conn.execute(
+                                db.select(t).where(t.c.id.in_(new_ids)).order_by(t.c.id)
+                            ).all()
+                    for row in rows:
+                        self._seen.add(row.id)
+                        self._last_id = max(self._last_id, row.id)
+                        for fn in self._listeners:
+                            try:
+                                fn(row)
+                            except Exception:
+                                app.logger.exception("live event listener failed")
+                        with self._lock:
+                            targets = list(self._subs.get((row.club_id, row.date, row.room or ""), ()))
+                        for q in targets:
+                            try:
+                                q.put_nowait(row)
+                            except queue.Full:
+                                pass  # 詰まった購読者は取りこぼし（再接続時の Last-Event-ID で回収される）
+                    floor = self._last_id - LIVE_POLL_LOOKBACK
+                    self._seen = {i for i in self._seen if i > floor}
+                except Exception:
+                    app.logger.exception("live event poll failed")
+                finally:
+                    db.session.remove()
+                time.sleep(LIVE_POLL_INTERVAL)
 
-    db.session.commit()
-    return jsonify({"result": "ok", "mode": "bulk-replace"})
+
+live_hub = LiveEventHub()
+
+_live_worker_token = secrets.token_hex(4)
+
+
+def live_worker_id():
+    """このワーカーの識別子（fork 後は pid で別になる）。自分の書いたイベントを見分けるのに使う"""
+    return f"{_live_worker_token}:{os.getpid()}"
+
+
+def publish_live_event(kind, payload, date=None, club_id=None, room=None):
+    """
+    ライブ更新イベントを DB バスへ書く（呼び出し元のコミット後に呼ぶ）。
+    届くのは同じ会場（room。未指定はこの端末の会場）を見ている端末だけ。
+    失敗しても本処理は成功扱いのまま（通知は付加機能のため）。
+    """
+    from models import LiveEvent
+    t = LiveEvent.__table__
+    club_id = club_id or getattr(g, "current_club", None)
+    date = date or jst_today_str()
+    room = current_room() if room is None else room
+    origin = (request.headers.get("X-Client-Id") or "")[:64] if has_request_context() else ""
+    now = datetime.utcnow()
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(t.insert().values(
+                club_id=club_id, date=date, room=room, kind=kind,
+                payload=json.dumps(payload, ensure_ascii=False),
+                origin=origin or None, worker=live_worker_id(), created_at=now,
+            ))
+            # 古いイベントはときどき掃除（購読者は直近分しか必要としない）
+            if live_hub._last_prune is None or now - live_hub._last_prune > timedelta(hours=1):
+                live_hub._last_prune = now
+                conn.execute(t.delete().where(t.c.created_at < now - LIVE_EVENT_RETENTION))
+    except Exception:
+        app.logger.exception("publish_live_event failed")
+
+    # 対局待ちキュー・参加者一覧（同じプロセスのメモリ）にも反映
+    try:
+        waiting_scheduler.apply_event(club_id, date, room, kind, payload)
+    except Exception:
+        app.logger.exception("waiting queue update failed")
+    if kind == "participants":
+        roster_cache.invalidate(club_id, date, room)
+
+
+def _reset_match_card(date_str, card_index):
+    """
+    対局カードを初期状態（認定戦・空席・pending）に戻す。コミットは呼び出し側。
+    戻り値：リセットしたカード（無ければ None）
+    """
+    card = MatchCardState.query.filter_by(
+        club_id=g.current_club, date=date_str, room=current_room(), card_index=card_index
+    ).first()
+    if card:
+        card.match_type = "認定戦"
+        card.p1_id = ""
+        card.p2_id = ""
+        card.status = "pending"
+        for key in CARD_DETAIL_FIELDS:
+            setattr(card, key, "")
+        card.started_at = None
+    # カードが保存される前（片側だけ座らせた段階）の確保もまとめて解放
+    _release_seat_claims(date_str, card_index=card_index)
+    return card
+
+
+def _format_sse(row, cursor=None) -> str:
+    """cursor：再接続時の Last-Event-ID にしてほしい値（送った中で最大の id。遅れて届いた小さい id で戻さない）"""
+    data = json.dumps({
+        "kind": row.kind,
+        "origin": row.origin,
+        "payload": json.loads(row.payload or "{}"),
+    }, ensure_ascii=False)
+    return f"id: {cursor or row.id}\nevent: {row.kind}\ndata: {data}\n\n"
+
+
+@app.route("/api/live/stream")
+def live_stream():
+    """
+    対局進行画面のライブ更新ストリーム（text/event-stream）
+    - date: 'YYYY-MM-DD'（未指定は JST 今日）/ room: 対局会場（その会場のイベントだけ流す）
+    - 再接続時はブラウザが Last-Event-ID を送るので、その後の取りこぼしを先に流す
+    """
+    from models import LiveEvent
+    club_id = g.current_club
+    date = (request.args.get("date") or jst_today_str()).strip()
+    room = current_room()
+    try:
+        last_id = int(request.headers.get("Last-Event-ID") or request.args.get("last_id") or 0)
+    except ValueError:
+        last_id = 0
+
+    # 先に購読してから取りこぼし分を読む（その間の新着は id で重複排除）
+    q = live_hub.subscribe(club_id, date, room)
+    backlog = []
+    if last_id:
+        backlog = (LiveEvent.query
+                   .filter(LiveEvent.club_id == club_id,
+                           LiveEvent.date == date,
+                           LiveEvent.room == room,
+                           LiveEvent.id > last_id)
+                   .order_by(LiveEvent.id)
+                   .limit(500)
+                   .all())
+    else:
+        # 初回接続：今ある最新 id から開始（過去分は bootstrap/load 側で取得済み）
+        latest = (db.session.query(func.max(LiveEvent.id))
+                  .filter(LiveEvent.club_id == club_id, LiveEvent.date == date, LiveEvent.room == room)
+                  .scalar())
+        last_id = latest or 0
+    db.session.remove()  # 長時間接続で DB コネクションを握らない
+
+    def generate():
+        # ポーラーは各イベントを1回だけ配るので、ここでは取りこぼし分と重なった id だけを除く
+        # （id の大小では捨てない：遅れてコミットされた小さい id もそのまま流す）
+        sent_ids = {row.id for row in backlog}
+        cursor = last_id
+        started = time.monotonic()
+        try:
+            yield "retry: 2000\n\n"
+            for row in backlog:
+                cursor = max(cursor, row.id)
+                yield _format_sse(row, cursor)
+            while time.monotonic() - started < LIVE_STREAM_MAX_SECONDS:
+                try:
+                    row = q.get(timeout=LIVE_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if row.id in sent_ids:
+                    continue
+                sent_ids.add(row.id)
+                cursor = max(cursor, row.id)
+                yield _format_sse(row, cursor)
+        finally:
+            live_hub.unsubscribe(club_id, date, q, room)
+
+    resp = app.response_class(generate(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # nginx 等のバッファリング無効化
+    return resp
+
+
+# カード保存で差分として受け付けるフィールド（送られてきたものだけ更新する）
+CARD_DETAIL_FIELDS = ("handicap", "sente", "p1_grade", "p2_grade", "p1_next_grade", "p2_next_grade")
+CARD_STATE_FIELDS = ("match_type", "p1_id", "p2_id", "status") + CARD_DETAIL_FIELDS
+
+
+class CardVersionConflict(Exception):
+    """expected_version がサーバー上の版と一致しない（他端末が先に更新した）"""
+
+    def __init__(self, card_index):
+        super().__init__(card_index)
+        self.card_index = card_index
+
+
+class SeatTaken(CardVersionConflict):
+    """カードに載せようとした人が、すでに別のカードに着席している（SeatClaim が先にある）"""
+
+    def __init__(self, card_index, claim):
+        super().__init__(card_index)
+        self.claim = claim
+
+
+def _seat_claim_dict(claim) -> dict:
+    return {"participant_id": claim.participant_id, "room": claim.room or "", "card_index": claim.card_index}
+
+
+def _seat_taken_message(claim) -> str:
+    m = Member.query.filter_by(club_id=g.current_club, id=claim.participant_id).first()
+    where = f"{claim.room or '既定の会場'}の" if (claim.room or "") != current_room() else ""
+    return f"{(m.name if m else claim.participant_id)}さんは{where}第{claim.card_index + 1}局にすでに着席しています"
+
+
+def _seat_lockable_ids(pids):
+    """着席を確保する対象（指導員は多面指しで複数カードに座れるので除く）"""
+    pids = {str(p) for p in pids if p}
+    if not pids:
+        return pids
+    instructors = {m.id for m in Member.query.filter(Member.club_id == g.current_club,
+                                                     Member.id.in_(pids),
+                                                     Member.member_type == "指導員")}
+    return pids - instructors
+
+
+SEAT_CLAIM_PENDING_TTL = timedelta(minutes=5)   # カードが保存されないままの確保を有効とみなす時間
+
+
+def _expire_orphan_seat_claims(date, participant_ids):
+    """
+    保存されたカードに載っていない確保のうち、古いものを消す（コミットは呼び出し側）
+    ドロップで確保した後にカードを保存せず画面を閉じた・再読み込みした場合に、
+    その人がどこにも座れなくなるのを防ぐ。戻り値：消した件数
+    """
+    from models import SeatClaim
+    pids = [str(p) for p in participant_ids if p]
+    if not pids:
+        return 0
+    stale = (SeatClaim.query
+             .filter(SeatClaim.club_id == g.current_club, SeatClaim.date == date,
+                     SeatClaim.participant_id.in_(pids),
+                     SeatClaim.claimed_at < datetime.utcnow() - SEAT_CLAIM_PENDING_TTL)
+             .all())
+    expired = 0
+    for claim in stale:
+        seated = (MatchCardState.query
+                  .filter(MatchCardState.club_id == g.current_club, MatchCardState.date == date,
+                          MatchCardState.room == (claim.room or ""),
+                          MatchCardState.card_index == claim.card_index,
+                          or_(MatchCardState.p1_id == claim.participant_id,
+                              MatchCardState.p2_id == claim.participant_id))
+                  .first())
+        if seated is None:
+            db.session.delete(claim)
+            expired += 1
+    if expired:
+        db.session.flush()
+    return expired
+
+
+def _sync_seat_claims(row):
+    """
+    カード（row）に載っている人の SeatClaim を作り、降りた人の分は消す（コミットは呼び出し側）
+    - 別のカードに確保済みの人がいれば SeatTaken
+    - 同時に2台が同じ人を確保しようとした場合は、コミット時に一意制約で片方が IntegrityError になる
+    """
+    from models import SeatClaim
+    pids = _seat_lockable_ids([row.p1_id, row.p2_id])
+    _expire_orphan_seat_claims(row.date, pids)
+    claims = (SeatClaim.query
+              .filter(SeatClaim.club_id == g.current_club, SeatClaim.date == row.date)
+              .filter(or_(SeatClaim.participant_id.in_(list(pids)),
+                          and_(SeatClaim.room == row.room, SeatClaim.card_index == row.card_index)))
+              .all())
+    for claim in claims:
+        same_card = (claim.room or "") == (row.room or "") and claim.card_index == row.card_index
+        if claim.participant_id in pids:
+            if not same_card:
+                raise SeatTaken(row.card_index, claim)
+            pids.discard(claim.participant_id)
+        elif same_card:
+            db.session.delete(claim)
+    for pid in pids:
+        db.session.add(SeatClaim(club_id=g.current_club, date=row.date, room=row.room or "",
+                                 card_index=row.card_index, participant_id=pid))
+
+
+def _release_seat_claims(date, card_index=None, participant_ids=None, room=None):
+    """SeatClaim を消す（カード単位 or 参加者単位。コミットは呼び出し側）"""
+    from models import SeatClaim
+    q = SeatClaim.query.filter(SeatClaim.club_id == g.current_club, SeatClaim.date == date)
+    if card_index is not None:
+        q = q.filter(SeatClaim.room == (current_room() if room is None else room),
+                     SeatClaim.card_index == int(card_index))
+    if participant_ids is not None:
+        q = q.filter(SeatClaim.participant_id.in_([str(p) for p in participant_ids]))
+    q.delete(synchronize_session=False)
+
+
+def _upsert_card_state(date, card):
+    """
+    1枚分の差分を適用する（コミットは呼び出し側）。
+    - card["index"] は必須。expected_version があれば楽観ロックで検証（未作成のカードは 0）
+    - CARD_STATE_FIELDS のうち、送られてきたキーだけを更新
+    """
+    idx = card.get("index")
+    expected = card.get("expected_version")
+    room = current_room()
+    row = (MatchCardState.query
+           .filter_by(club_id=g.current_club, date=date, room=room, card_index=idx)
+           .first())
+
+    if expected is not None and int(expected) != (row.version if row else 0):
+        raise CardVersionConflict(idx)
+
+    if row is None:
+        row = MatchCardState(club_id=g.current_club, date=date, room=room, card_index=idx)
+        db.session.add(row)
+    was_ongoing = row.status == "ongoing"
+    for key in CARD_STATE_FIELDS:
+        if key in card:
+            setattr(row, key, card.get(key))
+    if "p1_id" in card or "p2_id" in card:
+        _sync_seat_claims(row)
+    # 開始時刻はサーバーの時計で記録（対局中でなくなったら消す）
+    if row.status == "ongoing" and not was_ongoing:
+        row.started_at = datetime.utcnow()
+    elif row.status != "ongoing":
+        row.started_at = None
+    return row
+
+
+def _current_cards(date, indices):
+    """競合時にクライアントへ返す、サーバー上の最新状態"""
+    rows = (MatchCardState.query
+            .filter(MatchCardState.club_id == g.current_club,
+                    MatchCardState.date == date,
+                    MatchCardState.room == current_room(),
+                    MatchCardState.card_index.in_(list(indices)))
+            .all())
+    found = {r.card_index: _card_state_dict(r) for r in rows}
+    # 未作成のカードは version 0 の空状態として返す
+    return [found.get(i) or {"card_index": i, "version": 0} for i in indices]
+
+
+@app.route('/api/match_card_state/save', methods=['POST'])  # 単一 or 複数カード保存（差分＋版管理）
+def save_match_card_state():
+    """
+    入力: { date, cards: [{ index, expected_version?, <変更したフィールドのみ> }, ...] }（会場は X-Room）
+    - 1枚でも複数枚でも「カードごとの UPSERT」を1トランザクションで行う（他カードは消さない）
+    - expected_version が古ければ全体を取り消し、409 と該当カードの現在状態を返す
+    出力: { result: "ok", cards: [保存後の状態（version 付き）] }
+    """
+    data = request.get_json(silent=True) or {}
+    date = data.get("date")
+    cards = data.get("cards", [])
+
+    if not date:
+        return jsonify({"result": "ng", "message": "date is required"}), 400
+    if not isinstance(cards, list) or not all(isinstance(c, dict) for c in cards):
+        return jsonify({"result": "ng", "message": "cards must be a list of objects"}), 400
+    if any(c.get("index") is None for c in cards):
+        return jsonify({"result": "ng", "message": "card.index is required"}), 400
+    try:
+        for c in cards:
+            int(c["index"])
+            if c.get("expected_version") is not None:
+                int(c["expected_version"])
+    except (TypeError, ValueError):
+        return jsonify({"result": "ng", "message": "card.index and expected_version must be integers"}), 400
+
+    from sqlalchemy.orm.exc import StaleDataError
+    try:
+        saved = [_upsert_card_state(date, card) for card in cards]
+        db.session.commit()
+    except SeatTaken as e:
+        db.session.rollback()
+        return jsonify({
+            "result": "seat_taken",
+            "message": _seat_taken_message(e.claim),
+            "claim": _seat_claim_dict(e.claim),
+            "cards": _current_cards(date, [e.card_index]),
+        }), 409
+    except CardVersionConflict as e:
+        db.session.rollback()
+        return jsonify({
+            "result": "conflict",
+            "message": "他の端末でカードが更新されています",
+            "cards": _current_cards(date, [e.card_index]),
+        }), 409
+    except (StaleDataError, IntegrityError):
+        # 読んでからコミットするまでの間に他端末が更新/作成した
+        db.session.rollback()
+        return jsonify({
+            "result": "conflict",
+            "message": "他の端末でカードが更新されています",
+            "cards": _current_cards(date, [c.get("index") for c in cards]),
+        }), 409
+
+    saved_dicts = [_card_state_dict(c) for c in saved]
+    if len(saved_dicts) == 1:
+        publish_live_event("card", saved_dicts[0], date=date)
+    elif saved_dicts:
+        publish_live_event("cards", {"cards": saved_dicts}, date=date)
+    return jsonify({"result": "ok", "mode": "upsert", "cards": saved_dicts})
 
 @app.route('/api/match_card_state/load', methods=['GET']) # DBからカード状態を復元
 def load_match_card_state():
@@ -3003,39 +4552,91 @@ def load_match_card_state():
     if not date:
         return jsonify({"cards": []})
 
+    # この端末の会場のカードだけ（他の会場のカードは読まない）
     cards = (MatchCardState.query
-         .filter_by(club_id=g.current_club, date=date)
+         .filter_by(club_id=g.current_club, date=date, room=current_room())
          .order_by(MatchCardState.card_index)
          .all())
-    result = []
-    for c in cards:
-        result.append({
-            "card_index": c.card_index,  # ← index → card_index に統一！
-            "match_type": c.match_type,
-            "p1_id": c.p1_id,
-            "p2_id": c.p2_id,
-            "status": c.status,
-            "info_html": c.info_html,
-            "original_html1": c.original_html1,
-            "original_html2": c.original_html2
-        })
+    result = [_card_state_dict(c) for c in cards]  # ← index → card_index に統一！
 
     return jsonify({"cards": result}) 
 
+
+@app.route("/api/seat/claim", methods=["POST"])
+def claim_seat():
+    """
+    カードのスロットに参加者を座らせる前に、サーバーで着席を確保する（ドラッグ＆ドロップ時）
+    入力: { date, card_index, participant_id }（会場は X-Room）
+    出力: 確保できた { success: true, claim } / 他のカードが先 409 { success: false, message, claim: 勝ったカード }
+    """
+    from models import SeatClaim
+    data = request.get_json(silent=True) or {}
+    date = (data.get("date") or jst_today_str()).strip()
+    card_index = data.get("card_index")
+    pid = str(data.get("participant_id") or "").strip()
+    if card_index is None or not pid:
+        return jsonify(success=False, message="card_index と participant_id は必須です"), 400
+    try:
+        card_index = int(card_index)
+    except (TypeError, ValueError):
+        return jsonify(success=False, message="card_index は整数で指定してください"), 400
+    room = current_room()
+
+    if not _seat_lockable_ids([pid]):
+        # 指導員は複数カードに座れる
+        return jsonify(success=True, claim=None)
+
+    # カードを保存しないまま放置された確保は先に片付ける
+    if _expire_orphan_seat_claims(date, [pid]):
+        db.session.commit()
+
+    for _attempt in range(2):
+        claim = SeatClaim(club_id=g.current_club, date=date, room=room,
+                          card_index=card_index, participant_id=pid)
+        db.session.add(claim)
+        try:
+            db.session.commit()
+            return jsonify(success=True, claim=_seat_claim_dict(claim))
+        except IntegrityError:
+            db.session.rollback()
+
+        winner = SeatClaim.query.filter_by(club_id=g.current_club, date=date, participant_id=pid).first()
+        if winner is None:
+            continue  # 直前に解放された：もう一度だけ試す
+        if (winner.room or "") == room and winner.card_index == card_index:
+            return jsonify(success=True, claim=_seat_claim_dict(winner))  # 同じカードへの再送
+        return jsonify(success=False, message=_seat_taken_message(winner),
+                       claim=_seat_claim_dict(winner)), 409
+    return jsonify(success=False, message="着席の確保に失敗しました。もう一度お試しください。"), 409
+
+
+@app.route("/api/seat/release", methods=["POST"])
+def release_seat():
+    """
+    着席の確保を外す（カードから「戻す」とき）
+    入力: { date, card_index, participant_id? }（participant_id を省略するとそのカードの全員）
+    """
+    data = request.get_json(silent=True) or {}
+    date = (data.get("date") or jst_today_str()).strip()
+    card_index = data.get("card_index")
+    if card_index is None:
+        return jsonify(success=False, message="card_index は必須です"), 400
+    try:
+        card_index = int(card_index)
+    except (TypeError, ValueError):
+        return jsonify(success=False, message="card_index は整数で指定してください"), 400
+    pid = data.get("participant_id")
+    _release_seat_claims(date, card_index=card_index, participant_ids=[pid] if pid else None)
+    db.session.commit()
+    return jsonify(success=True)
+
 # ✅ 追加するFlask APIルート：DB保存型の参加者管理
-from models import TodayParticipant
 
 @app.route("/admin/qr_tokens/init", methods=["POST", "GET"])
 def admin_qr_tokens_init():
     # GETで試したときも動くように（ブラウザ直アクセス可）
-    updated = 0
-    for m in Member.query.all():
-        if not m.qr_token:
-            token = _issue_token(16)
-            while Member.query.filter_by(club_id=g.current_club, qr_token=token).first():
-                token = _issue_token(16)
-            m.qr_token = token
-            updated += 1
+    # ★クラブ境界：このクラブの未発行分だけ（全クラブ分は flask issue-qr-tokens）
+    updated = issue_missing_qr_tokens(g.current_club)
     db.session.commit()
 
     # GETなら簡易ページ、POSTならJSONを返す
@@ -3043,109 +4644,739 @@ def admin_qr_tokens_init():
         return f"発行完了：{updated}件"
     return jsonify({"success": True, "updated": updated})
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+# ===== QRカードのZIP一括作成（別プロセスで並列に描画 → 一時ファイルのZIPへ → 完成したらダウンロード） =====
+# 描画はリクエストのスレッドでは行わない（300人分を直列で描くと gunicorn のタイムアウトに掛かるため）
+QR_ZIP_WORKERS = max(1, min(4, os.cpu_count() or 1))
+QR_ZIP_CHUNK = 20                      # 子プロセスに1回で渡す枚数（プロセス間のやりとりを減らす）
+QR_ZIP_TTL = timedelta(minutes=30)     # 完成したZIPを置いておく時間
+QR_ZIP_POOL_IDLE = 60                  # 作成中のZIPが無くなってからプロセスプールを閉じるまでの秒数
+
+# ジョブの状態（club_id, total, done, path, ...）は状態ファイル "qr_zip"（どのワーカーからも進捗・ダウンロードできる）
+_qr_zip_lock = threading.Lock()
+_qr_zip_pool = None
+_qr_zip_running = 0        # このワーカーで作成中のZIPの数（0 のまましばらく経ったらプールを閉じる）
+
+
+def _get_qr_zip_pool():
+    """描画用のプロセスプール（最初に使うときに作る）。子は qr_render だけを読み込む spawn で起動"""
+    global _qr_zip_pool
+    with _qr_zip_lock:
+        if _qr_zip_pool is None:
+            _qr_zip_pool = ProcessPoolExecutor(max_workers=QR_ZIP_WORKERS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+        return _qr_zip_pool
+
+
+def _discard_qr_zip_pool(pool):
+    global _qr_zip_pool
+    with _qr_zip_lock:
+        if _qr_zip_pool is pool:
+            _qr_zip_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _close_idle_qr_zip_pool():
+    """作成中のZIPが無いままなら子プロセス（最大 QR_ZIP_WORKERS 個）を終わらせる。次のZIPでまた作る"""
+    with _qr_zip_lock:
+        pool = _qr_zip_pool if _qr_zip_running == 0 else None
+    if pool is not None:
+        _discard_qr_zip_pool(pool)
+
+
+def _qr_zip_job_finished():
+    global _qr_zip_running
+    with _qr_zip_lock:
+        _qr_zip_running -= 1
+        idle = _qr_zip_running == 0 and _qr_zip_pool is not None
+    if idle:
+        timer = threading.Timer(QR_ZIP_POOL_IDLE, _close_idle_qr_zip_pool)
+        timer.daemon = True
+        timer.start()
+
+
+def _prune_qr_zip_jobs():
+    for state in prune_job_states("qr_zip", QR_ZIP_TTL):
+        try:
+            os.remove(state["path"])
+        except (OSError, KeyError, TypeError):
+            pass
+
+
+def _update_qr_zip_job(job_id, **fields):
+    update_job_state("qr_zip", job_id, **fields)
+
+
+def qr_zip_entries(members):
+    """ZIPに入れる (ファイル名, QRトークン, 名前) の並び。トークン未発行の人は除く"""
+    return [(f"{getattr(m, 'member_code', None) or m.id}_{m.name}.png", m.qr_token, m.name)
+            for m in members if m.qr_token]
+
+
+def start_qr_zip_job(club_id, entries, download_name):
+    """
+    QRカードのZIP作成を裏で始めて job_id を返す（進捗は /api/qr/zip_jobs/<job_id>）。
+    entries は qr_zip_entries() の戻り値。描画はプロセスプールで並列、ZIPは一時ファイルに書く
+    """
+    _prune_qr_zip_jobs()
+    job_id = secrets.token_urlsafe(12)
+    fd, path = tempfile.mkstemp(prefix="qr_zip_", suffix=".zip")
+    os.close(fd)
+    write_job_state("qr_zip", job_id, {"club_id": club_id, "total": len(entries), "done": 0, "path": path,
+                                       "download_name": download_name, "finished": False, "error": None})
+    global _qr_zip_running
+    with _qr_zip_lock:
+        _qr_zip_running += 1
+    threading.Thread(target=_run_qr_zip_job, args=(job_id, path, entries), daemon=True).start()
+    return job_id
+
+
+def _run_qr_zip_job(job_id, path, entries):
+    chunks = [entries[i:i + QR_ZIP_CHUNK] for i in range(0, len(entries), QR_ZIP_CHUNK)]
+    payloads = [[(token, name) for _, token, name in chunk] for chunk in chunks]
+    pool = None
+    futures = []
+    try:
+        pool = _get_qr_zip_pool()
+        futures = [pool.submit(render_qr_labels, p) for p in payloads]
+    except Exception as e:
+        # 子プロセスを起こせない環境では、このスレッドで順に描く
+        app.logger.warning(f"[QR-ZIP] process pool unavailable, rendering in thread ({e})")
+        if pool is not None:
+            _discard_qr_zip_pool(pool)
+        futures = []
+
+    done = 0
+    try:
+        # PNG はもう圧縮済みなので、ZIP では縮めずに格納だけ
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zf:
+            for i, chunk in enumerate(chunks):
+                try:
+                    pngs = futures[i].result() if futures else render_qr_labels(payloads[i])
+                except BrokenProcessPool:
+                    _discard_qr_zip_pool(pool)
+                    futures = []
+                    pngs = render_qr_labels(payloads[i])
+                for (filename, _, _), png in zip(chunk, pngs):
+                    zf.writestr(filename, png)
+                done += len(chunk)
+                _update_qr_zip_job(job_id, done=done)
+        _update_qr_zip_job(job_id, finished=True)
+    except Exception as e:
+        app.logger.exception(f"[QR-ZIP] job {job_id} failed")
+        for f in futures:
+            f.cancel()
+        _update_qr_zip_job(job_id, finished=True, error=str(e))
+    finally:
+        _qr_zip_job_finished()
+
+
+def _get_qr_zip_job(job_id):
+    entry = read_job_state("qr_zip", job_id)
+    if not entry or entry.get("club_id") != g.current_club:
+        return None
+    return entry
+
+
+def _render_qr_zip_progress(job_id, total, back_url):
+    return render_template("qr_zip_progress.html", job_id=job_id, total=total, back_url=back_url)
+
+
+@app.get('/api/qr/zip_jobs/<job_id>')
+def qr_zip_job_progress(job_id):
+    """ZIP作成の進捗（描き終えた枚数）。画面が0.5秒ごとに問い合わせる"""
+    entry = _get_qr_zip_job(job_id)
+    if entry is None:
+        return jsonify(success=False, message="作成中のZIPが見つかりません"), 404
+    return jsonify(success=True, done=entry["done"], total=entry["total"],
+                   finished=entry["finished"], error=entry["error"],
+                   download_url=url_for("qr_zip_job_download", job_id=job_id))
+
+
+@app.get('/qr/zip_jobs/<job_id>/download')
+def qr_zip_job_download(job_id):
+    """できあがったZIPを一時ファイルからそのまま送る（メモリに載せない）"""
+    entry = _get_qr_zip_job(job_id)
+    if entry is None:
+        return "ZIPが見つかりません（期限切れの可能性があります）。もう一度作成してください。", 404
+    if not entry["finished"]:
+        return "ZIPを作成中です。しばらくしてからもう一度お試しください。", 409
+    if entry["error"]:
+        return f"ZIPの作成に失敗しました：{entry['error']}", 500
+    return send_file(entry["path"], as_attachment=True, download_name=entry["download_name"],
+                     mimetype="application/zip", max_age=0)
+
+
 @app.get("/admin/qr_tokens/zip")
 def admin_qr_tokens_zip():
     if qrcode is None:
         return "qrcode ライブラリが未インストールです。`pip install qrcode[pil]` を実行してください。", 500
 
-    # 出力: メモリ上ZIP
-    mem_zip = BytesIO()
-    with zipfile.ZipFile(mem_zip, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for m in Member.query.filter(Member.is_active.is_(True)).all():
-            if not m.qr_token:
+    # ★クラブ境界：このクラブの在籍者だけ
+    members = (Member.query
+               .filter(Member.is_active.is_(True), Member.club_id == g.current_club)
+               .order_by(member_code_order())
+               .all())
+    entries = qr_zip_entries(members)
+    job_id = start_qr_zip_job(g.current_club, entries, "qr_tokens.zip")
+    return _render_qr_zip_progress(job_id, len(entries), url_for("index"))
+
+@app.cli.command("bench-qr-labels")
+@click.option("--labels", default=500, help="描くカードの枚数")
+def bench_qr_labels_command(labels):
+    """
+    QRカードの名前欄の計測（DB は使わない）
+    - 従来：サイズを変えるたびにフォントを探し直して作り、収まるまで2pxずつ縮める
+    - 今回：フォントはプロセスで1回だけ探してサイズごとに使い回し、サイズは二分探索
+    名前欄だけの時間と、QR・PNG化まで含めた1枚の時間を出す
+    """
+    import qr_render
+    if qrcode is None:
+        raise click.ClickException("qrcode ライブラリが未インストールです")
+
+    # 短い名前が多く、ときどき長い名前（縮める必要があるもの）が混ざる
+    samples = ["山田太郎", "佐藤花子", "鈴木一郎", "高橋 美咲", "長谷川 太郎左衛門",
+               "Alexander Konstantinovich", "勅使河原 三郎（ジュニア）", "伊藤"]
+    names = [f"{samples[i % len(samples)]}{i}" for i in range(labels)]
+    max_w = qrcode.make("x" * QR_TOKEN_LENGTH).size[0] - qr_render.LABEL_MARGIN * 2
+    loads = [0]
+
+    def legacy_fit(text):
+        font_size = qr_render.LABEL_FONT_MAX
+        while True:
+            loads[0] += 1
+            font = qr_render._open_font(qr_render._resolve_font_source(), font_size)
+            bbox = font.getbbox(text)
+            if bbox[2] - bbox[0] <= max_w or font_size <= qr_render.LABEL_FONT_MIN:
+                return font
+            font_size -= 2
+
+    def cached_fit(text):
+        return qr_render.fit_label_font(text, max_w)
+
+    def report(label, fit):
+        qr_render.logger.disabled = True   # 従来方式は1回ごとにフォント探しのログが出るので止める
+        try:
+            t0 = time.perf_counter()
+            for name in names:
+                fit(name)
+            elapsed = (time.perf_counter() - t0) * 1000
+        finally:
+            qr_render.logger.disabled = False
+        print(f"{label:<6} labels={labels}  名前欄 {elapsed:.0f} ms（1枚 {elapsed / labels:.2f} ms）")
+
+    report("従来", legacy_fit)
+    print(f"       フォント生成 {loads[0]}回")
+    qr_render.get_jp_font(qr_render.LABEL_FONT_MAX)  # 最初のフォント探しは除外
+    before = len(qr_render._font_cache)
+    report("今回", cached_fit)
+    print(f"       フォント生成 {len(qr_render._font_cache) - before}回（キャッシュ {len(qr_render._font_cache)}サイズ）")
+
+    t0 = time.perf_counter()
+    render_qr_labels([(_issue_token(QR_TOKEN_LENGTH), name) for name in names])
+    elapsed = (time.perf_counter() - t0) * 1000
+    print(f"カード全体（QR・PNG化込み） {elapsed:.0f} ms（1枚 {elapsed / labels:.2f} ms）")
+
+# ===== 来場記録（Attendance：追記のみ。本日の参加者は在席中の行で、部分索引 uq_attendance_open で引く） =====
+ATTENDANCE_RETENTION_KEY = "attendance_retention_days"   # クラブ設定：来場記録の保存日数（0 は無期限）
+
+
+def _open_attendance_filter(date, member_ids=None):
+    """在席中（終了も取消もしていない）の来場記録の条件"""
+    from models import Attendance
+    conds = [Attendance.club_id == g.current_club, Attendance.date == date,
+             Attendance.left_at.is_(None), Attendance.cancelled_at.is_(None)]
+    if member_ids is not None:
+        conds.append(Attendance.member_id.in_([str(i) for i in member_ids]))
+    return conds
+
+
+def _record_attendance(date, member_ids, room=""):
+    """
+    受付した人の来場記録を足す（在席中の記録がある人はそのまま）。コミットは呼び出し側
+    人数によらず SELECT 1回＋INSERT 1文。既存の行は書き換えない。戻り値：新しく受付した会員ID
+    同時に他の端末が同じ人を受付すると、コミット前の INSERT が一意制約（uq_attendance_open）で IntegrityError になる
+    """
+    from models import Attendance
+    ids = [str(i) for i in member_ids]
+    if not ids:
+        return []
+    t = Attendance.__table__
+    open_ids = {mid for (mid,) in db.session.query(Attendance.member_id)
+                .filter(*_open_attendance_filter(date, ids))}
+    now = datetime.utcnow()
+    new_ids = [mid for mid in dict.fromkeys(ids) if mid not in open_ids]
+    if new_ids:
+        db.session.execute(t.insert().values([{
+            "club_id": g.current_club, "date": date, "member_id": mid,
+            "room": room, "checked_in_at": now,
+        } for mid in new_ids]))
+    return new_ids
+
+
+def _cancel_attendance(date, member_id):
+    """
+    受付の取消（間違えて受付した）では在席中の来場記録に取消時刻を入れる（行は残す）。コミットは呼び出し側
+    戻り値：受付していた会場（在席中の記録がなければ None）
+    """
+    from models import Attendance
+    entry = (db.session.query(Attendance.id, Attendance.room)
+             .filter(*_open_attendance_filter(date, [member_id]))
+             .first())
+    if not entry:
+        return None
+    (db.session.query(Attendance)
+     .filter(Attendance.id == entry.id)
+     .update({Attendance.cancelled_at: datetime.utcnow()}, synchronize_session=False))
+    return entry.room or ""
+
+
+def _attendance_retention_days(club_id) -> int:
+    s = Setting.query.filter_by(club_id=club_id, key=ATTENDANCE_RETENTION_KEY).first()
+    return int(s.value) if (s and (s.value or "").isdigit()) else 0
+
+
+def _prune_attendance(club_id, today=None) -> int:
+    """保存日数を過ぎた来場記録を消す（0 は無期限）。コミットは呼び出し側。戻り値：削除件数"""
+    from models import Attendance
+    days = _attendance_retention_days(club_id)
+    if days <= 0:
+        return 0
+    today = today or jst_today_str()
+    cutoff = (datetime.strptime(today, "%Y-%m-%d") - timedelta(days=days)).strftime("%Y-%m-%d")
+    return (Attendance.query
+            .filter(Attendance.club_id == club_id, Attendance.date < cutoff)
+            .delete(synchronize_session=False))
+
+
+# ===== QR トークン → 会員 の索引（クラブごと・ワーカーのメモリ） =====
+# 受付開始時に QR スキャンが集中するので、トークン解決は DB を引かずにメモリで行う
+# 会員の追加・編集・トークン再発行はコミット時に自プロセスの索引を捨て、ライブイベント（members）で他ワーカーにも伝える
+MEMBER_INDEX_TTL = 300  # 秒：他ワーカーでの変更を取りこぼしても、この時間で作り直す（会員検索の索引も同じ）
+
+
+class QrTokenIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clubs = {}        # club_id -> {token: SimpleNamespace(会員の受付に要る項目)}
+        self._built_at = {}     # club_id -> 作った時刻（time.monotonic）
+        self._generation = {}   # club_id -> 捨てた回数（作り直し中に捨てられた索引を保存しないため）
+
+    @staticmethod
+    def _snapshot(m):
+        return SimpleNamespace(id=m.id, member_code=m.member_code, name=m.name, kana=m.kana,
+                               grade=m.grade, member_type=m.member_type)
+
+    def _build(self, club_id):
+        rows = (db.session.query(Member.id, Member.member_code, Member.name, Member.kana,
+                                 Member.grade, Member.member_type, Member.qr_token)
+                .filter(Member.club_id == club_id, Member.qr_token.isnot(None))
+                .all())
+        return {r.qr_token: self._snapshot(r) for r in rows if r.qr_token}
+
+    def lookup(self, club_id, token):
+        with self._lock:
+            index = self._clubs.get(club_id)
+            if index is not None and time.monotonic() - self._built_at[club_id] > MEMBER_INDEX_TTL:
+                index = None
+            generation = self._generation.get(club_id, 0)
+        if index is None:
+            live_hub.ensure_running()  # 他ワーカーでの変更を受け取るため
+            built_at = time.monotonic()
+            index = self._build(club_id)
+            with self._lock:
+                if self._generation.get(club_id, 0) == generation:
+                    self._clubs[club_id] = index
+                    self._built_at[club_id] = built_at
+        member = index.get(token)
+        if member is None:
+            # 他ワーカーで発行した直後のトークンかもしれないので DB でも確認し、あれば索引に足す
+            row = Member.query.filter_by(club_id=club_id, qr_token=token).first()
+            if row:
+                member = self._snapshot(row)
+                index[token] = member
+        return member
+
+    def invalidate(self, club_id):
+        with self._lock:
+            self._clubs.pop(club_id, None)
+            self._generation[club_id] = self._generation.get(club_id, 0) + 1
+
+    def on_bus_event(self, row):
+        if row.kind == "members":
+            self.invalidate(row.club_id)
+
+
+qr_token_index = QrTokenIndex()
+live_hub.add_listener(qr_token_index.on_bus_event)
+
+
+# ===== 会員の前方一致検索（会員選択の入力補完用。クラブごとにワーカーのメモリに持つ） =====
+# 会員プルダウンに全会員を書き出す代わりに、入力のたびに候補だけを返す
+# 「よみがな・名前・会員ID」それぞれの正規化済みキーを並べておき、二分探索で前方一致の範囲を取る
+import bisect
+import unicodedata
+
+MEMBER_SEARCH_LIMIT = 20       # 既定の候補数
+MEMBER_SEARCH_LIMIT_MAX = 50
+
+
+def normalize_search_text(text):
+    """
+    検索用に正規化：全角/半角をそろえ（NFKC）、カタカナ→ひらがな、英字は小文字、空白は除く
+    例）'ｶﾄｳ' / 'カトウ' / 'かとう ' → 'かとう'
+    """
+    s = unicodedata.normalize("NFKC", str(text or "")).lower()
+    s = "".join(s.split())
+    return "".join(chr(ord(ch) - 0x60) if "ァ" <= ch <= "ヶ" else ch for ch in s)
+
+
+class MemberSearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clubs = {}        # club_id -> {"members": [...], "keys": [(正規化キー, 会員の位置), ...], "built_at"}
+        self._generation = {}   # club_id -> 捨てた回数（作り直し中に捨てられた索引を保存しないため）
+
+    def _build(self, club_id):
+        rows = (db.session.query(Member.id, Member.member_code, Member.name, Member.kana,
+                                 Member.grade, Member.member_type, Member.is_active)
+                .filter(Member.club_id == club_id)
+                .order_by(Member.kana, member_code_order())   # 候補は「かな順」で返す
+                .all())
+        members = [{
+            "id": r.id,
+            "member_code": r.member_code or r.id,
+            "name": r.name,
+            "kana": r.kana,
+            "grade": r.grade,
+            "member_type": r.member_type,
+            "is_active": bool(r.is_active),
+        } for r in rows]
+        keys = []
+        for i, m in enumerate(members):
+            for text in {normalize_search_text(m["kana"]), normalize_search_text(m["name"]),
+                         normalize_search_text(m["member_code"])}:
+                if text:
+                    keys.append((text, i))
+        keys.sort()
+        return {"members": members, "keys": keys, "built_at": time.monotonic()}
+
+    def _index(self, club_id):
+        with self._lock:
+            index = self._clubs.get(club_id)
+            if index is not None and time.monotonic() - index["built_at"] > MEMBER_INDEX_TTL:
+                index = None
+            generation = self._generation.get(club_id, 0)
+        if index is None:
+            live_hub.ensure_running()  # 他ワーカーでの変更を受け取るため
+            index = self._build(club_id)
+            with self._lock:
+                if self._generation.get(club_id, 0) == generation:
+                    self._clubs[club_id] = index
+        return index
+
+    def search(self, club_id, query, limit=MEMBER_SEARCH_LIMIT, include_inactive=False, exclude=()):
+        """前方一致する会員（かな順）。query が空なら空リスト"""
+        prefix = normalize_search_text(query)
+        if not prefix:
+            return []
+        index = self._index(club_id)
+        members, keys = index["members"], index["keys"]
+        hits = set()
+        pos = bisect.bisect_left(keys, (prefix, -1))
+        while pos < len(keys) and keys[pos][0].startswith(prefix):
+            hits.add(keys[pos][1])
+            pos += 1
+        result = []
+        for i in sorted(hits):   # 位置＝かな順
+            m = members[i]
+            if (not include_inactive and not m["is_active"]) or m["id"] in exclude:
                 continue
+            result.append(m)
+            if len(result) >= limit:
+                break
+        return result
 
-            # 1) QR本体生成
-            img = qrcode.make(m.qr_token).convert("RGB")
+    def invalidate(self, club_id):
+        with self._lock:
+            self._clubs.pop(club_id, None)
+            self._generation[club_id] = self._generation.get(club_id, 0) + 1
 
-            # 2) 上部に名前用の白帯を追加（QRを壊さない）
-            header_h = 56  # ここを増減すると帯の高さを調整できます
-            w, h = img.size
-            canvas = Image.new("RGB", (w, h + header_h), "white")
-            canvas.paste(img, (0, header_h))
+    def on_bus_event(self, row):
+        if row.kind == "members":
+            self.invalidate(row.club_id)
 
-            # 3) 左上に会員名を描画（日本語フォントを確実に当てる）
-            draw = ImageDraw.Draw(canvas)
 
-            # 推奨：少し大きめから始めて、長い名前は自動で縮める
-            name_text = f"{m.name}"
-            font_size = 28
-            font = _get_jp_font(font_size)
+member_search_index = MemberSearchIndex()
+live_hub.add_listener(member_search_index.on_bus_event)
+
+
+@app.get("/api/members/search")
+def api_member_search():
+    """
+    会員選択の入力補完：?q=（よみがな・名前・会員IDの前方一致。カタカナ・半角も可）
+      &limit=（既定20・最大50）&inactive=1（退会者も含める）&exclude=ID,ID（除外）
+    戻り値：[{id, member_code, name, kana, grade, member_type, is_active}, ...]（かな順）
+    """
+    try:
+        limit = int(request.args.get("limit") or MEMBER_SEARCH_LIMIT)
+    except ValueError:
+        limit = MEMBER_SEARCH_LIMIT
+    limit = max(1, min(limit, MEMBER_SEARCH_LIMIT_MAX))
+    exclude = {x for x in (request.args.get("exclude") or "").split(",") if x}
+    rows = member_search_index.search(
+        g.current_club, request.args.get("q", ""), limit=limit,
+        include_inactive=request.args.get("inactive") == "1", exclude=exclude)
+    return jsonify(rows)
+
+
+@event.listens_for(Member, "after_insert")
+@event.listens_for(Member, "after_update")
+@event.listens_for(Member, "after_delete")
+@event.listens_for(Strength, "after_insert")
+@event.listens_for(Strength, "after_update")
+@event.listens_for(Strength, "after_delete")
+def _mark_member_changed(mapper, connection, target):
+    """会員（トークン・棋力など）や棋力の並びが変わった：コミット時に索引・参加者一覧を捨てる"""
+    session = object_session(target) or db.session()
+    session.info.setdefault("changed_member_clubs", set()).add(target.club_id)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_qr_token_index(session):
+    # SAVEPOINT の解放でも after_commit が来る。外側がまだコミットしていないので、ここでは捨てず・流さない
+    if session.in_nested_transaction():
+        return
+    clubs = session.info.pop("changed_member_clubs", None)
+    for club_id in clubs or ():
+        if not club_id:
+            continue
+        qr_token_index.invalidate(club_id)
+        member_search_index.invalidate(club_id)
+        roster_cache.invalidate(club_id)
+        # 他ワーカーへ（会場・日付に関係なく届くよう room=''・今日で流す。画面側は members を購読しない）
+        publish_live_event("members", {}, date=jst_today_str(), club_id=club_id, room="")
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_member_changes(session):
+    # SAVEPOINT だけの巻き戻しでは外側の変更が残るので忘れない（余分に捨てる分には害がない）
+    if session.in_nested_transaction():
+        return
+    session.info.pop("changed_member_clubs", None)
 
-            # 幅に収まらない場合は2pxずつ縮める
-            max_w = w - 16  # 左右8pxの余白を見込む
-            while True:
-                bbox = draw.textbbox((0, 0), name_text, font=font)
-                text_w = bbox[2] - bbox[0]
-                if text_w <= max_w or font_size <= 12:
-                    break
-                font_size -= 2
-                font = _get_jp_font(font_size)
-
-            draw.text((8, 8), name_text, fill=(0, 0, 0), font=font)
-
-            # 4) 保存
-            display_code = getattr(m, "member_code", None) or m.id
-            filename = f"{display_code}_{m.name}.png"
-            buf = BytesIO()
-            canvas.save(buf, format="PNG")
-            buf.seek(0)
-            zf.writestr(filename, buf.read())
-    mem_zip.seek(0)
-    return send_file(mem_zip, as_attachment=True, download_name="qr_tokens.zip",
-                     mimetype="application/zip")
 
 @app.post("/api/scan_checkin")
 def api_scan_checkin():
     """
     入力: { "token": "xxxx" }
-    動作: token→Member解決 → TodayParticipantに本日分を登録（重複は無視）
+    動作: token→Member解決（メモリの索引）→ 来場記録に本日分を INSERT
+          既受付は在席中の行の一意制約 uq_attendance_open (club_id, date, member_id) で判定する（先に SELECT しない）
     出力: { success, message, participant?: {...} }
     """
+    from models import Attendance
     data = request.get_json(silent=True) or {}
     token = (data.get("token") or "").strip()
     if not token:
         return jsonify(success=False, message="QRコードが空です"), 400
 
     today = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d")
+    room = current_room()  # 読み取った端末の会場で受付
+
+    member = qr_token_index.lookup(g.current_club, token)
+    if not member:
+        return jsonify(success=False, message="QRコードが登録されていません"), 404
+
+    participant = {
+        "id": member.id, "member_code": (member.member_code or member.id),
+        "name": member.name, "kana": member.kana,
+        "grade": member.grade, "member_type": member.member_type
+    }
+
+    # 新規受付を登録（club_id を必ず保存）
+    db.session.add(Attendance(club_id=g.current_club, date=today, member_id=member.id,
+                              room=room, checked_in_at=datetime.utcnow()))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # 既受付か判定（クラブ境界を付与）
+        exists = (db.session.query(Attendance.room)
+                  .filter(*_open_attendance_filter(today, [member.id]))
+                  .first())
+        if exists:
+            if (exists.room or "") != room:
+                return jsonify(success=False,
+                    message=f"{member.name} さんは別の会場（{exists.room or '既定'}）で受付済みです"), 409
+            return jsonify(success=True,
+                message=f"{member.name} さんはすでに受付済みです",
+                participant=participant
+            )
+        # 判定の間に本日の終了・取消で受付が閉じた。在席中のものがなければ足す
+        _record_attendance(today, [member.id], room)
+        db.session.commit()
+    publish_live_event("participants", {"added": [member.id]}, date=today)
 
-    member = Member.query.filter_by(club_id=g.current_club, qr_token=token).first()
-    if not member:
-        return jsonify(success=False, message="QRコードが登録されていません"), 404
+    # ★ 名前入りメッセージ
+    return jsonify(success=True, message=f"{member.name} さんの参加を受け付けました", participant=participant)
 
-    # 既受付か判定（クラブ境界を付与）
-    exists = TodayParticipant.query.filter_by(
-        club_id=g.current_club, date=today, participant_id=member.id
-    ).first()
-    if exists:
-        return jsonify(success=True,
-            message=f"{member.name} さんはすでに受付済みです",
-            participant={
-                "id": member.id, "member_code": (member.member_code or member.id),
-                "name": member.name, "kana": member.kana,
-                "grade": member.grade, "member_type": member.member_type
-            }
-        )
 
-    # 新規受付を登録（club_id を必ず保存）
-    entry = TodayParticipant(
-        club_id=g.current_club,
-        date=today,
-        participant_id=member.id,
-        name=member.name,
-        kana=member.kana,
-        grade=member.grade,
-        member_type=member.member_type
-    )
-    db.session.add(entry)
+@app.cli.command("bench-checkin")
+@click.option("--scans", default=50, help="続けて読み取る人数（開場直後の集中を想定）")
+@click.option("--club", "club_id", default="bench_checkin", help="計測用に一時作成するクラブID（終了時に削除）")
+def bench_checkin_command(scans, club_id):
+    """
+    QR受付の集中を一時クラブで再現し、1件あたりの時間と SQL 数を計測する
+    - 索引あり：メモリの索引でトークンを解決（通常の動作）
+    - 索引なし：毎回索引を捨てて DB から引き直す（従来の「毎回 SELECT」に相当）
+    - 再スキャン：受付済みの人がもう一度読み取った場合
+    """
+    from models import Attendance, LiveEvent, WaitingQueueEntry
+    if Club.query.get(club_id):
+        raise click.ClickException(f"クラブ {club_id} は既に存在します（--club で別の ID を指定してください）")
+
+    db.session.add(Club(id=club_id, name="受付ベンチマーク"))
+    tokens = []
+    for i in range(scans * 2 + 1):
+        token = _issue_token(16)
+        db.session.add(Member(id=f"{club_id}-{i}", club_id=club_id, member_code=str(i + 1),
+                              name=f"会員{i + 1}", kana="かいいん", grade="初段",
+                              member_type="正会員", is_active=True, qr_token=token))
+        tokens.append(token)
     db.session.commit()
 
-    # ★ 名前入りメッセージ
-    return jsonify(success=True, message=f"{member.name} さんの参加を受け付けました", participant={
-        "id": member.id, "member_code": (member.member_code or member.id),
-        "name": member.name, "kana": member.kana,
-        "grade": member.grade, "member_type": member.member_type
-    })
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["logged_in"] = True
+        sess["club_id"] = club_id
+
+    statements = [0]
+
+    def count_statement(*_args):
+        statements[0] += 1
+
+    def run(label, batch, cold=False):
+        timings, counts = [], []
+        for token in batch:
+            if cold:
+                qr_token_index.invalidate(club_id)
+            n0, t0 = statements[0], time.perf_counter()
+            res = client.post("/api/scan_checkin", json={"token": token})
+            timings.append((time.perf_counter() - t0) * 1000)
+            counts.append(statements[0] - n0)
+            if res.status_code != 200:
+                raise click.ClickException(f"{label}: HTTP {res.status_code} {res.get_json()}")
+        total = sum(timings)
+        timings.sort()
+        counts.sort()
+        print(f"{label:<10} scans={len(batch)}  {len(batch) / (total / 1000):.0f} scans/s  "
+              f"median {timings[len(timings) // 2]:.1f} ms / p95 {timings[int(len(timings) * 0.95) - 1]:.1f} ms"
+              f" / max {timings[-1]:.1f} ms  SQL/scan median {counts[len(counts) // 2]}")
+
+    event.listen(db.engine, "before_cursor_execute", count_statement)
+    try:
+        # 最初の1回（索引作成・ライブ更新の受信スレッド起動など）は計測から除く
+        client.post("/api/scan_checkin", json={"token": tokens.pop()})
+        run("索引あり", tokens[:scans])
+        run("索引なし", tokens[scans:], cold=True)
+        run("再スキャン", tokens[:scans])
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count_statement)
+        for model, col in ((Attendance, Attendance.club_id),
+                           (LiveEvent, LiveEvent.club_id), (WaitingQueueEntry, WaitingQueueEntry.club_id),
+                           (Setting, Setting.club_id), (Member, Member.club_id)):
+            db.session.query(model).filter(col == club_id).delete(synchronize_session=False)
+        db.session.query(Club).filter(Club.id == club_id).delete(synchronize_session=False)
+        db.session.commit()
+        qr_token_index.invalidate(club_id)
+
+# ===== 本日の参加者一覧のスナップショット（クラブ×日×会場ごと・ワーカーのメモリ） =====
+# 一覧は受付・取消のたびに全タブレットが取り直すので、DB から組み立てるのは変化があった時だけにする
+# 受付・取消・本日の終了は publish_live_event（participants）、会員・棋力の変更はコミット時に捨てる
+ROSTER_SNAPSHOT_TTL = 300  # 秒：他ワーカーでの変更を取りこぼしても、この時間で作り直す
+
+
+class RosterCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snaps = {}        # (club_id, date, room) -> {"rows", "sorted", "built_at"}
+        self._generation = 0    # 作り直し中に捨てられたスナップショットを保存しないため
+
+    def _build(self, club_id, date, room):
+        from models import Attendance
+        # 棋力順はこのクラブの設定だけ（他クラブの同名の棋力と混ざらないように）
+        strength_map = {name: order for name, order in
+                        db.session.query(Strength.name, Strength.order).filter(Strength.club_id == club_id)}
+        # 参加者はこの会場の在席中の来場記録（部分索引 uq_attendance_open で当日の行だけを引く）
+        members = (db.session.query(Member.id, Member.member_code, Member.name, Member.kana,
+                                    Member.grade, Member.member_type, Member.qr_token)
+                   .join(Attendance,
+                         (Member.id == Attendance.member_id)
+                         & (Attendance.club_id == club_id))
+                   .filter(Member.club_id == club_id,
+                           Attendance.date == date,
+                           Attendance.room == room,
+                           Attendance.left_at.is_(None),
+                           Attendance.cancelled_at.is_(None))
+                   .order_by(member_code_order(), Member.id)
+                   .all())
+        # 元の並び（同順位のときの順）は取得順＝会員IDの自然順で固定
+        rows = [{
+            "id": m.id,
+            "member_code": m.member_code or m.id,
+            "name": m.name,
+            "kana": m.kana,
+            "grade": m.grade,
+            "member_type": m.member_type,
+            "grade_order": strength_map.get(m.grade, -1),
+            "qr_token": m.qr_token,
+        } for m in members]
+        return {"rows": rows, "sorted": {}, "built_at": time.monotonic()}
+
+    def rows(self, club_id, date, room, sort_key="member_code", order="asc"):
+        """並べ替え済みの一覧（呼び出し側で書き換えないこと）"""
+        key = (club_id, date, room)
+        with self._lock:
+            snap = self._snaps.get(key)
+            generation = self._generation
+        if snap is None or time.monotonic() - snap["built_at"] > ROSTER_SNAPSHOT_TTL:
+            live_hub.ensure_running()  # 他ワーカーでの受付を受け取るため
+            snap = self._build(club_id, date, room)
+            with self._lock:
+                if self._generation == generation:
+                    # 同じクラブ・会場の別の日は捨てる
+                    for k in [k for k in self._snaps if k[0] == club_id and k[2] == room]:
+                        self._snaps.pop(k, None)
+                    self._snaps[key] = snap
+        # 並べ方は決まった数だけ（知らないキーは member_code 順）。sorted の控えが増え続けないように
+        if sort_key not in PARTICIPANT_SORT_KEYS:
+            sort_key = "member_code"
+        order = "desc" if order == "desc" else "asc"
+        ordered = snap["sorted"].get((sort_key, order))
+        if ordered is None:
+            ordered = snap["sorted"][(sort_key, order)] = _sort_participant_rows(list(snap["rows"]), sort_key, order)
+        return ordered
+
+    def invalidate(self, club_id, date=None, room=None):
+        with self._lock:
+            self._generation += 1
+            for k in [k for k in self._snaps
+                      if k[0] == club_id and (date is None or k[1] == date) and (room is None or k[2] == room)]:
+                self._snaps.pop(k, None)
+
+    def on_bus_event(self, row):
+        if row.kind == "participants":
+            self.invalidate(row.club_id, row.date, row.room or "")
+        elif row.kind == "members":
+            self.invalidate(row.club_id)
+
+
+roster_cache = RosterCache()
+live_hub.add_listener(roster_cache.on_bus_event)
+
 
 # 1. 取得：本日の参加者一覧
 @app.route('/api/participants')
@@ -3158,84 +5389,33 @@ def get_today_participants():
         # JST の今日に置換
         date = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d")
 
-    # StrengthとのJOINで棋力順を取るため、Memberから取得
-    strength_alias = aliased(Strength)
-
-    # ✅ ここだけでJOIN条件を定義（重複定義なし）
-    subquery = (
-        db.session.query(Member)
-        .filter(Member.club_id == g.current_club)  # ★クラブ境界（Member側）
-        .outerjoin(
-            TodayParticipant,
-            (Member.id == TodayParticipant.participant_id)
-            & (TodayParticipant.club_id == g.current_club)  # ★クラブ境界（TodayParticipant側）
-        )
-        .filter(TodayParticipant.date == date)
-    )
-
-    if sort_key == "grade":
-        subquery = subquery.outerjoin(strength_alias, Member.grade == strength_alias.name)
-        sort_column = case(
-            (strength_alias.order == None, -1),
-            else_=strength_alias.order,
-            value=None,
-        ).label("grade_order").cast(Integer)  # ✅ cast明示
-        order_column = sort_column.asc() if sort_order == 'asc' else sort_column.desc()
-
-    elif sort_key == "member_type":
-        member_type_order = case(
-            (Member.member_type == '正会員', 1),
-            (Member.member_type == '臨時会員', 2),
-            (Member.member_type == '指導員', 3),
-            (Member.member_type == 'スタッフ', 4),
-            else_=5
-        )
-        order_column = member_type_order.asc() if sort_order == "asc" else member_type_order.desc()
-    else:
-        col = getattr(Member, sort_key, Member.id)
-        order_column = col.asc() if sort_order == "asc" else col.desc()
-
-    members = subquery.order_by(order_column).all()
-
-    # ここでクラブを必ず絞る
-    club_strengths = (
-        Strength.query
-        .filter_by(club_id=g.current_club)
-        .order_by(Strength.order)
-        .all()
-    )
-    strength_map = {s.name: s.order for s in club_strengths}
+    # 並べ替えはスナップショット側で1か所だけ（member_code は数値優先の自然順、grade は棋力順）
+    result = roster_cache.rows(g.current_club, date, current_room(), sort_key, sort_order)
 
-    result = []
-    for m in members:
-        result.append({
-            "id": m.id,
-            "member_code": getattr(m, "member_code", None) or m.id,
-            "name": m.name,
-            "kana": m.kana,
-            "grade": m.grade,
-            "member_type": m.member_type,
-            "grade_order": strength_map.get(m.grade, -1),
-            "qr_token": m.qr_token  # ← 追加
-        })
+    # 画面は受付・結果保存のたびに取り直すので、変化がなければ 304 で本文なし
+    resp = jsonify(result)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.add_etag()
+    return resp.make_conditional(request)
 
-    # ▼ 追加：member_code を自然順（数値優先）で並べ替え
-    order = request.args.get("order", "asc")
-    sort_key = request.args.get("sort", "member_code")
 
-    def _code_key(val: str):
-        s = str(val or "")
-        is_num = s.isdigit()
-        return (not is_num, int(s) if is_num else 0, s)
+# 参加者一覧で受け付ける並べ替えキー（画面の列見出しと同じ）
+PARTICIPANT_SORT_KEYS = ("member_code", "grade", "name", "kana", "member_type")
 
-    if sort_key == "member_code":
-        result.sort(key=lambda r: _code_key(r.get("member_code")), reverse=(order == "desc"))
-    elif sort_key == "grade":
-        result.sort(key=lambda r: r.get("grade_order", -1), reverse=(order == "desc"))
-    elif sort_key in ["name", "kana", "member_type"]:
-        result.sort(key=lambda r: (r.get(sort_key) or ""), reverse=(order == "desc"))
 
-    return jsonify(result)
+def _sort_participant_rows(rows, sort_key, order):
+    """
+    参加者 dict のリストを画面の並び順に並べ替える（画面側 sortParticipantRows と同じ）。
+    rows は member_code の自然順（member_code_order）で取得したものを渡す：member_code 順は並べ直さない
+    sort_key は PARTICIPANT_SORT_KEYS のどれか（それ以外は member_code 順のまま）
+    """
+    if sort_key == "grade":
+        rows.sort(key=lambda r: r.get("grade_order", -1), reverse=(order == "desc"))
+    elif sort_key in ("name", "kana", "member_type"):
+        rows.sort(key=lambda r: (r.get(sort_key) or ""), reverse=(order == "desc"))
+    elif order == "desc":
+        rows.reverse()
+    return rows
 
 # 2. 追加：複数会員を参加者として登録
 @app.route('/api/participants', methods=['POST'])
@@ -3256,34 +5436,35 @@ def add_today_participants():
     if not ids:
         return jsonify({"success": False, "message": "不正な入力（idsなし）"}), 400
 
-    added = []
-    for pid in ids:
-        exists = TodayParticipant.query.filter_by(
-            club_id=g.current_club, date=date, participant_id=pid
-        ).first()
-        if exists:
-            continue
-
-        member = Member.query.filter_by(club_id=g.current_club, id=pid).first()
-        if member:
-            entry = TodayParticipant(
-                club_id=g.current_club,
-                date=date,
-                participant_id=member.id,
-                name=member.name,
-                kana=member.kana,
-                grade=member.grade,
-                member_type=member.member_type
-            )
-            db.session.add(entry)
-            added.append(entry)
+    # 人数によらず往復回数は一定：会員と受付済みを IN で1回ずつ読み、まとめて1文で INSERT
+    ids = list(dict.fromkeys(str(pid) for pid in ids))
+    room = current_room()
+    for _attempt in range(2):
+        members = (db.session.query(Member.id, Member.member_code, Member.name, Member.kana,
+                                    Member.grade, Member.member_type)
+                   .filter(Member.club_id == g.current_club, Member.id.in_(ids))
+                   .all())
+        by_id = {m.id: m for m in members}
+        try:
+            # 別の会場で受付済みの人もそのまま（会場の移動は取消→再登録で）
+            added = [by_id[pid] for pid in _record_attendance(date, [pid for pid in ids if pid in by_id], room)]
+            if not added:
+                break
+            db.session.commit()
+            break
+        except IntegrityError:
+            # 同時に他の端末が同じ人を受付した：一意制約で弾かれたので読み直してもう1回
+            db.session.rollback()
+    else:
+        return jsonify({"success": False, "message": "他の端末の受付と重なりました。もう一度お試しください。"}), 409
 
-    db.session.commit()
+    if added:
+        publish_live_event("participants", {"added": [m.id for m in added]}, date=date)
     return jsonify({"success": True, "participants": [
-        {"id": e.participant_id,
-         "member_code": (Member.query.get(e.participant_id).member_code or e.participant_id),
-         "name": e.name, "kana": e.kana, "grade": e.grade, "member_type": e.member_type}
-        for e in added
+        {"id": m.id,
+         "member_code": (m.member_code or m.id),
+         "name": m.name, "kana": m.kana, "grade": m.grade, "member_type": m.member_type}
+        for m in added
     ]})
 
 # 3. 削除：指定IDの参加者を削除
@@ -3292,13 +5473,12 @@ def remove_today_participant(participant_id):
     date = request.args.get("date")
     print(f"🟡 DELETE 受信: id={participant_id}, date={date}")  # ← 確認ポイント
 
-    entry = TodayParticipant.query.filter_by(
-        club_id=g.current_club, date=date, participant_id=participant_id
-    ).first()
-    if entry:
+    room = _cancel_attendance(date, participant_id)
+    if room is not None:
         print("✅ 該当エントリあり、削除実行")
-        db.session.delete(entry)
+        _release_seat_claims(date, participant_ids=[participant_id])
         db.session.commit()
+        publish_live_event("participants", {"removed": [participant_id]}, date=date, room=room)
         return jsonify({"success": True})
     else:
         print("❌ 該当エントリなし、削除せず")
@@ -3322,6 +5502,64 @@ def get_handicap_rules():
         for rule in rules
     ])
 
+@app.route("/api/match_play/bootstrap")
+def match_play_bootstrap():
+    """
+    対局進行画面の初期表示に必要なものを1回で返す（クエリ数は固定の5本。参加者・カードは room の会場分だけ）
+    - card_count / participants（grade_order 付き・並べ替え済み）/ handicap_rules / handicap_list
+      / strength_order_map / cards
+    - ETag 付き。内容が変わっていなければ If-None-Match に 304 で応える
+    """
+    date = (request.args.get("date") or jst_today_str()).strip()
+    room = current_room()
+    sort_key = request.args.get("sort", "member_code")
+    sort_order = request.args.get("order", "asc")
+
+    # 1) 既定カード枚数
+    setting = Setting.query.filter_by(club_id=g.current_club, key="default_card_count").first()
+    card_count = int(setting.value) if (setting and (setting.value or "").isdigit()) else 5
+
+    # 2) 棋力順
+    strengths = (Strength.query
+                 .filter_by(club_id=g.current_club)
+                 .order_by(Strength.order)
+                 .all())
+    strength_order_map = {s.name: s.order for s in strengths}
+
+    # 3) 駒落ちルール
+    rules = (HandicapRule.query
+             .filter_by(club_id=g.current_club)
+             .order_by(HandicapRule.grade_diff)
+             .all())
+    handicap_list = sorted(set(r.handicap for r in rules))
+    for extra in ("指導", "認定"):
+        if extra not in handicap_list:
+            handicap_list.append(extra)
+
+    # 4) 本日の参加者（/api/participants と同じスナップショットから）
+    participants = roster_cache.rows(g.current_club, date, room, sort_key, sort_order)
+
+    # 5) 対局カード
+    cards = (MatchCardState.query
+             .filter_by(club_id=g.current_club, date=date, room=room)
+             .order_by(MatchCardState.card_index)
+             .all())
+
+    resp = jsonify({
+        "date": date,
+        "room": room,
+        "card_count": card_count,
+        "participants": participants,
+        "handicap_rules": [{"grade_diff": r.grade_diff, "handicap": r.handicap} for r in rules],
+        "handicap_list": handicap_list,
+        "strength_order_map": strength_order_map,
+        "cards": [_card_state_dict(c) for c in cards],
+    })
+    # 毎回再検証させる（変化がなければ 304 で本文なし）
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.add_etag()
+    return resp.make_conditional(request)
+
 @app.route("/end_match", methods=["POST"])
 def end_match():
     data = request.get_json()
@@ -3337,6 +5575,12 @@ def end_match():
     if not all([p1_id, p2_id, result1, result2, match_type]):
         return jsonify(success=False, message="必要なデータが不足しています"), 400
 
+    # 同じ冪等キーで記録済みなら何もしない（再送・二重クリック。キーなしは30秒ガード）
+    idem_key = _request_idempotency_key(data)
+    duplicate = _find_duplicate_match(idem_key, data)
+    if duplicate is not None:
+        return jsonify(success=True, skipped=True, match_id=duplicate.id)
+
     try:
         match = Match(
             player1_id=p1_id,
@@ -3344,10 +5588,11 @@ def end_match():
             match_type=match_type,
             handicap=handicap,
             card_index=card_index,
-            ended_at=datetime.utcnow()
+            ended_at=datetime.utcnow(),
+            idempotency_key=idem_key,
         )
         db.session.add(match)
-        db.session.commit()  # match.id を確定させるために先にコミット
+        db.session.flush()  # match.id を確定（結果と同じトランザクションでコミット）
 
         # 🔽 対局者の情報を取得
         member1 = db.session.get(Member, p1_id)
@@ -3377,7 +5622,7 @@ def end_match():
         if match_type in ["認定戦", "初回認定"]:
             # プレイヤー1の昇段級判定
             if result1 == "○":
-                new_grade = check_promotion(p1_id, member1.grade, match.ended_at)
+                new_grade = evaluate_promotion(p1_id, member1.grade, match.ended_at)
                 print(f"[DEBUG] {p1_id}の昇段級チェック結果: {new_grade}")
                 if new_grade and new_grade != member1.grade:
                     old_grade = member1.grade  # 🔸更新前の段級を記録
@@ -3393,7 +5638,7 @@ def end_match():
 
             # プレイヤー2の昇段級判定
             if result2 == "○":
-                new_grade = check_promotion(p2_id, member2.grade, match.ended_at)
+                new_grade = evaluate_promotion(p2_id, member2.grade, match.ended_at)
                 print(f"[DEBUG] {p2_id}の昇段級チェック結果: {new_grade}")
                 if new_grade and new_grade != member2.grade:
                     old_grade = member2.grade  # 🔸更新前の段級を記録
@@ -3412,19 +5657,26 @@ def end_match():
 
         # 🔽 対応するMatchCardStateの内容を初期化（カードリセット）
         today = jst_today_str()
-        card = MatchCardState.query.filter_by(date=today, card_index=card_index).first()
+        card = _reset_match_card(today, card_index)
         if card:
-            card.match_type = "認定戦"
-            card.p1_id = ""
-            card.p2_id = ""
-            card.status = "pending"
-            card.info_html = ""
-            card.original_html1 = ""
-            card.original_html2 = ""
             db.session.commit()
 
+        publish_live_event("result", {
+            "match_id": match.id, "card_index": card_index,
+            "player1_id": p1_id, "player2_id": p2_id, "match_type": match_type,
+        }, date=today)
+        if card:
+            publish_live_event("card", _card_state_dict(card), date=today)
         return jsonify(success=True)
 
+    except IntegrityError:
+        # 同じ冪等キーの別リクエストが先にコミットした
+        db.session.rollback()
+        duplicate = _find_match_by_idempotency_key(idem_key)
+        if duplicate is not None:
+            return jsonify(success=True, skipped=True, match_id=duplicate.id)
+        return jsonify(success=False, message="対局結果の保存に失敗しました"), 500
+
     except Exception as e:
         db.session.rollback()
         return jsonify(success=False, message=str(e)), 500
@@ -3563,19 +5815,11 @@ def clear_match_card_state():
         return jsonify({"success": False, "message": "dateまたはindexが不正です"}), 400
 
     try:
-        card = MatchCardState.query.filter_by(
-            club_id=g.current_club, date=date, card_index=index
-        ).first()
+        card = _reset_match_card(date, index)
         if card:
-            card.match_type = "認定戦"
-            card.p1_id = ""
-            card.p2_id = ""
-            card.info_html = ""
-            card.original_html1 = ""
-            card.original_html2 = ""
-            card.status = "pending"
             db.session.commit()
-        return jsonify({"success": True})
+            publish_live_event("card", _card_state_dict(card), date=date)
+        return jsonify({"success": True, "card": _card_state_dict(card) if card else None})
     except Exception as e:
         db.session.rollback()
         return jsonify({"success": False, "message": str(e)}), 500
@@ -3588,12 +5832,13 @@ def update_match_type():
     today = jst_today_str()
 
     card = MatchCardState.query.filter_by(
-        club_id=g.current_club, date=today, card_index=index
+        club_id=g.current_club, date=today, room=current_room(), card_index=index
     ).first()
     if card:
         card.match_type = new_type
         db.session.commit()
-        return jsonify({"success": True})
+        publish_live_event("card", _card_state_dict(card), date=today)
+        return jsonify({"success": True, "card": _card_state_dict(card)})
     return jsonify({"success": False, "message": "カードが見つかりませんでした"}), 404
 
 # 本日の終了処理 API
@@ -3606,12 +5851,20 @@ def end_today():
         if not req_date:
             now_jst = datetime.now(ZoneInfo("Asia/Tokyo"))
             req_date = now_jst.strftime("%Y-%m-%d")
-
-        # 1) 本日の参加者＆過去日の参加者を削除（<= 指定日）
-        db.session.query(TodayParticipant).filter(
-            TodayParticipant.club_id == g.current_club,
-            TodayParticipant.date <= req_date
-        ).delete(synchronize_session=False)
+        # 指定日の分はこの端末の会場だけ終える（他の会場は対局を続けられる）
+        room = current_room()
+
+        # 0) 本日の参加者（この会場）＆過去日の参加者（全会場）は来場記録に終了時刻を入れて一覧から外す
+        #    行は消さずに残す（保存日数を過ぎた記録だけ整理）
+        from models import Attendance
+        db.session.query(Attendance).filter(
+            Attendance.club_id == g.current_club,
+            Attendance.left_at.is_(None),
+            Attendance.cancelled_at.is_(None),
+            or_(Attendance.date < req_date,
+                and_(Attendance.date == req_date, Attendance.room == room)),
+        ).update({Attendance.left_at: datetime.utcnow()}, synchronize_session=False)
+        pruned = _prune_attendance(g.current_club, req_date)
 
         # 2) 過去日の対局カードを削除（＜ 指定日）※当日分は残す
         db.session.query(MatchCardState).filter(
@@ -3619,18 +5872,90 @@ def end_today():
             MatchCardState.date < req_date
         ).delete(synchronize_session=False)
 
+        # 3) 着席の確保：過去日（全会場）と、指定日のこの会場の分を解放
+        from models import SeatClaim
+        db.session.query(SeatClaim).filter(
+            SeatClaim.club_id == g.current_club,
+            or_(SeatClaim.date < req_date,
+                and_(SeatClaim.date == req_date, SeatClaim.room == room))
+        ).delete(synchronize_session=False)
+
         db.session.commit()
+        publish_live_event("participants", {"reset": True}, date=req_date, room=room)
         return jsonify({
             "success": True,
+            "room": room,
             "deleted": {
-                "today_participant": f"<= {req_date}",
-                "match_card_state": f"< {req_date}"
+                "match_card_state": f"< {req_date}",
+                "attendance": pruned,
             }
         })
     except Exception as e:
         db.session.rollback()
         return jsonify({"success": False, "message": str(e)}), 500
 
+@app.route("/api/attendance/stats")
+def attendance_stats():
+    """
+    来場の集計（Attendance から）
+    入力: ?start=YYYY-MM-DD&end=YYYY-MM-DD（JST・両端含む。未指定は直近30日）
+    出力: { success, days: [{date, count}], members: [{member_id, name, visits, last_date}] }
+    """
+    from models import Attendance
+    end = (request.args.get("end") or jst_today_str()).strip()
+    start = (request.args.get("start") or "").strip()
+    if not start:
+        try:
+            start = (datetime.strptime(end, "%Y-%m-%d") - timedelta(days=29)).strftime("%Y-%m-%d")
+        except ValueError:
+            start = ""
+    if jst_date_range_to_utc_naive(start, end) == (None, None) or not start:
+        return jsonify(success=False, message="start / end が不正です"), 400
+
+    # 取り消した受付は数えない。同じ日に2回受付した人も1日1回として数える
+    base = (db.session.query(Attendance)
+            .filter(Attendance.club_id == g.current_club,
+                    Attendance.date >= start,
+                    Attendance.date <= end,
+                    Attendance.cancelled_at.is_(None)))
+    days = (base.with_entities(Attendance.date, func.count(func.distinct(Attendance.member_id)))
+            .group_by(Attendance.date)
+            .order_by(Attendance.date)
+            .all())
+    per_member = (base.with_entities(Attendance.member_id, func.count(func.distinct(Attendance.date)),
+                                     func.max(Attendance.date))
+                  .group_by(Attendance.member_id)
+                  .all())
+    names = {m.id: m.name for m in Member.query.filter(
+        Member.club_id == g.current_club,
+        Member.id.in_([r[0] for r in per_member]))} if per_member else {}
+    members = sorted(({"member_id": mid, "name": names.get(mid, ""), "visits": n, "last_date": last}
+                      for mid, n, last in per_member),
+                     key=lambda r: (-r["visits"], r["member_id"]))
+    return jsonify(success=True, start=start, end=end,
+                   days=[{"date": d, "count": n} for d, n in days],
+                   members=members)
+
+
+@app.cli.command("issue-qr-tokens")
+@click.option("--club", "club_id", default=None, help="対象クラブID（省略時は全クラブ）")
+def issue_qr_tokens_command(club_id):
+    """QRトークン未発行の会員にまとめて発行する"""
+    issued = issue_missing_qr_tokens(club_id)
+    db.session.commit()
+    print(f"issued qr tokens: {issued}")
+
+
+@app.cli.command("prune-attendance")
+def prune_attendance_command():
+    """各クラブの来場記録のうち、保存日数（設定 attendance_retention_days）を過ぎたものを消す"""
+    total = 0
+    for club in Club.query.all():
+        total += _prune_attendance(club.id)
+    db.session.commit()
+    print(f"deleted attendance rows: {total}")
+
+
 @app.route("/api/player_stats_since_reset") # リセット日以降の勝敗カウントを取得する
 def player_stats_since_reset():
     player_id = request.args.get("player_id")
@@ -3667,6 +5992,62 @@ def player_stats_since_reset():
 
     return jsonify(success=True, wins=wins, losses=losses)
 
+def _pair_key(a, b) -> str:
+    """対局ペアのキー（順不同）。画面側の pairKey() と同じ形式"""
+    x, y = sorted([str(a), str(b)])
+    return f"{x}|{y}"
+
+
+def _today_pair_rows(date, club_id=None, room=None):
+    """
+    指定日（JST）の記録済み対局を (p1, p2, 種別) ごとに集計した行（クラブ内）
+    room を渡すと、その会場で受付した2人の対局だけ（会場をまたぐペアはその会場では組まれない）
+    行: (player1_id, player2_id, match_type, 回数, 最後の終了時刻 UTC)。date が不正なら None
+    """
+    club_id = club_id or g.current_club
+    start_utc, _ = jst_date_range_to_utc_naive(date, None)
+    if start_utc is None:
+        return None
+    end_utc = start_utc + timedelta(days=1)
+    q = (db.session.query(Match.player1_id, Match.player2_id, Match.match_type,
+                          func.count(Match.id), func.max(Match.ended_at))
+         .filter(Match.club_id == club_id,
+                 Match.is_recorded.is_(True),
+                 Match.ended_at >= start_utc,
+                 Match.ended_at < end_utc))
+    if room is not None:
+        from models import Attendance
+        roster = (db.session.query(Attendance.member_id)
+                  .filter(Attendance.club_id == club_id,
+                          Attendance.date == date,
+                          Attendance.room == room,
+                          Attendance.left_at.is_(None),
+                          Attendance.cancelled_at.is_(None)))
+        q = q.filter(Match.player1_id.in_(roster), Match.player2_id.in_(roster))
+    return (q.group_by(Match.player1_id, Match.player2_id, Match.match_type)
+            .all())
+
+
+@app.route("/api/today_pair_counts")
+def today_pair_counts():
+    """
+    本日（JST）すでに対局したペアの一覧を対局種別ごとの回数で返す（記録済みのみ・room の会場の参加者どうし）
+    出力: { success, date, pairs: { "<id>|<id>": { "認定戦": 1, "初回認定": 0, ... } } }
+    画面側はこれを1回取得し、以降は結果保存のたびに手元で加算する
+    """
+    date = (request.args.get("date") or jst_today_str()).strip()
+    rows = _today_pair_rows(date, room=current_room())
+    if rows is None:
+        return jsonify(success=False, message="date が不正です"), 400
+
+    pairs = {}
+    for p1, p2, match_type, count, _last in rows:
+        by_type = pairs.setdefault(_pair_key(p1, p2), {})
+        by_type[match_type] = by_type.get(match_type, 0) + count
+
+    return jsonify(success=True, date=date, pairs=pairs)
+
+
 # 🔽 本日(JST)の認定系で当該ペアが何回対局済みかを返すAPI
 @app.route("/api/today_pair_count")
 def today_pair_count():
@@ -3687,6 +6068,7 @@ def today_pair_count():
 
         # 認定戦／初回認定 かつ 記録済み かつ 本日(JST)内 かつ ペア順不同
         q = db.session.query(Match).filter(
+            Match.club_id == g.current_club,
             Match.is_recorded.is_(True),
             Match.match_type.in_(["認定戦", "初回認定"]),
             Match.ended_at >= start_utc,
@@ -3705,6 +6087,560 @@ def today_pair_count():
         print(traceback.format_exc())
         return jsonify(success=False, message=f"today_pair_count エラー: {str(e)}"), 500
 
+# ===== 自動組み合わせ（空きカードをまとめて埋める） =====
+# コストは「小さいほど良い」。重みはクラブ運営の感覚に合わせて調整する
+PAIRING_GAP_WEIGHT = 10        # 棋力差 d に対して d² × この値
+PAIRING_REMATCH_WEIGHT = 300   # 本日すでに認定系で当たった回数 × この値
+PAIRING_WAIT_WEIGHT = 5        # 待たせたままにする人の待ち時間（分）× この値
+PAIRING_WINDOW = 3             # 棋力順に並べて何人先までを相手候補にするか
+PAIRING_SLACK = 4              # 座れる人数より何人多く候補に入れるか（誰を待たせるかも最適化する）
+RATED_MATCH_TYPES = ("認定戦", "初回認定")
+
+
+def _pairing_cost(a, b, rematches, handicap_by_diff):
+    """2人を組んだときのコスト（棋力差・同日再戦）"""
+    diff = abs(a["order"] - b["order"])
+    cost = PAIRING_GAP_WEIGHT * diff * diff
+    if handicap_by_diff and diff > max(handicap_by_diff):
+        cost += PAIRING_GAP_WEIGHT * 100  # 駒落ち表にない差は実質組ませない
+    return cost + PAIRING_REMATCH_WEIGHT * rematches.get(_pair_key(a["id"], b["id"]), 0)
+
+
+def solve_pairing(players, slots, rematches=None, handicap_by_diff=None):
+    """
+    最小コストの組み合わせを返す（DBには触らない純粋関数）
+    - players: [{id, order, wait_minutes, games}]（order は Strength.order）
+    - slots: 空きカード数
+    - rematches: {_pair_key: 本日の認定系対局回数}
+    - 戻り値: (pairs=[(a, b, cost), ...], waiting=[player, ...])
+
+    厳密な一般グラフのマッチングは重いので、棋力順に並べて PAIRING_WINDOW 人先までを
+    相手候補にした上で「どこまで使用済みか」のビットマスクで DP する（O(n × 2^W × W)）。
+    誰を待たせるかも DP で選ぶ（待たせる人には待ち時間ぶんのコストが乗る）。
+    """
+    rematches = rematches or {}
+    handicap_by_diff = handicap_by_diff or {}
+    W = PAIRING_WINDOW
+
+    # 対局数が少なく、長く待っている人から候補に入れる
+    by_priority = sorted(players, key=lambda p: (p["games"], -p["wait_minutes"]))
+    n_pairs = min(slots, len(by_priority) // 2)
+    if n_pairs <= 0:
+        return [], by_priority
+    pool = by_priority[:2 * n_pairs + PAIRING_SLACK]
+    waiting = by_priority[len(pool):]
+    need_skips = len(pool) - 2 * n_pairs
+
+    pool.sort(key=lambda p: (p["order"], str(p["id"])))
+    n = len(pool)
+    skip_cost = [PAIRING_WAIT_WEIGHT * (1 + p["wait_minutes"]) for p in pool]
+
+    # states: (mask, skips) -> cost。mask の bit k は「位置 i+k は組み済み」
+    states = {(0, 0): 0}
+    back = []  # back[i][(mask, skips)] = (前の状態, 相手の位置 or None=待ち or -1=組み済み)
+    for i in range(n):
+        nxt, choice = {}, {}
+
+        def relax(key, cost, prev, how):
+            if key not in nxt or cost < nxt[key]:
+                nxt[key] = cost
+                choice[key] = (prev, how)
+
+        for (mask, skips), cost in states.items():
+            if mask & 1:
+                relax((mask >> 1, skips), cost, (mask, skips), -1)
+                continue
+            if skips < need_skips:
+                relax((mask >> 1, skips + 1), cost + skip_cost[i], (mask, skips), None)
+            for d in range(1, W + 1):
+                j = i + d
+                if j >= n or mask & (1 << d):
+                    continue
+                c = _pairing_cost(pool[i], pool[j], rematches, handicap_by_diff)
+                relax(((mask | (1 << d)) >> 1, skips), cost + c, (mask, skips), j)
+        states = nxt
+        back.append(choice)
+
+    final = (0, need_skips)
+    if final not in states:
+        return [], by_priority  # 起こらないはず（隣同士で必ず組める）
+
+    pairs, key = [], final
+    for i in range(n - 1, -1, -1):
+        prev, how = back[i][key]
+        if how is None:
+            waiting.append(pool[i])
+        elif how >= 0:
+            pairs.append((pool[i], pool[how], _pairing_cost(pool[i], pool[how], rematches, handicap_by_diff)))
+        key = prev
+    pairs.reverse()
+    return pairs, waiting
+
+
+def _handicap_for(order1, order2, handicap_by_diff):
+    """画面側 calcHandicap() と同じ：差に対応する駒落ち、なければ平手"""
+    return handicap_by_diff.get(abs(order1 - order2), "平手")
+
+
+def _pairing_rules():
+    """(棋力名→order, 棋力差→駒落ち) をクラブ内の設定から"""
+    strength_order = {s.name: s.order for s in Strength.query.filter_by(club_id=g.current_club)}
+    handicap_by_diff = {r.grade_diff: r.handicap for r in
+                        HandicapRule.query.filter_by(club_id=g.current_club)}
+    return strength_order, handicap_by_diff
+
+
+def _pairing_candidates(waiting_rows, strength_order):
+    """
+    待ち行列の行 → solve_pairing 用の players（待ち行列の順を保つ）
+    未認定（棋力順に無い）・指導員は手で組むので除外。棋力は昇段級直後でも正しいよう Member から
+    """
+    ids = [r["id"] for r in waiting_rows]
+    members = {m.id: m for m in Member.query.filter(Member.club_id == g.current_club,
+                                                    Member.id.in_(ids))} if ids else {}
+    players = []
+    for r in waiting_rows:
+        m = members.get(r["id"])
+        if not m or m.member_type == "指導員" or m.grade not in strength_order:
+            continue
+        players.append({**r, "order": strength_order[m.grade]})
+    return players
+
+
+@app.route("/api/pairing/auto", methods=["POST"])
+def pairing_auto():
+    """
+    空きカードを本日の待機中参加者でまとめて埋める
+    入力: { date, card_indices?: [画面に出ている空きカード番号], dry_run?: bool }
+    - 対象は「カードに載っていない」「未認定・指導員ではない」参加者（この2つは手で組む）
+    - 棋力差・本日の同一ペア再戦・待ち時間をコストにした最小コストの組み合わせ
+    - dry_run でなければカードに保存（楽観ロック付き）し、他端末へ配信する
+    出力: { success, pairs: [{card_index, p1_id, p2_id, handicap, rematches}], waiting: [id], cards }
+    """
+    data = request.get_json(silent=True) or {}
+    date = (data.get("date") or jst_today_str()).strip()
+    dry_run = bool(data.get("dry_run"))
+    room = current_room()
+    if jst_date_range_to_utc_naive(date, None)[0] is None:
+        return jsonify(success=False, message="date が不正です"), 400
+
+    # 空きカード：画面から来た番号（無ければ既定枚数＋保存済み）のうち、誰も載っていないもの（この会場）
+    card_rows = {c.card_index: c for c in
+                 MatchCardState.query.filter_by(club_id=g.current_club, date=date, room=room).all()}
+    indices = data.get("card_indices")
+    if indices is None:
+        setting = Setting.query.filter_by(club_id=g.current_club, key="default_card_count").first()
+        card_count = int(setting.value) if (setting and (setting.value or "").isdigit()) else 5
+        indices = sorted(set(range(card_count)) | set(card_rows))
+    free_cards = []
+    for idx in indices:
+        c = card_rows.get(int(idx))
+        if c is None or (not c.p1_id and not c.p2_id and c.status != "ongoing"):
+            free_cards.append(int(idx))
+
+    # 待ち行列（メモリ上）から、着席していない人の対局数・待ち時間・再戦回数を取る
+    waiting_rows, rematches = waiting_scheduler.snapshot(g.current_club, date, room)
+    strength_order, handicap_by_diff = _pairing_rules()
+    players = _pairing_candidates(waiting_rows, strength_order)
+
+    pairs, waiting = solve_pairing(players, len(free_cards), rematches, handicap_by_diff)
+
+    proposal = []
+    for card_index, (a, b, _cost) in zip(free_cards, pairs):
+        proposal.append({
+            "card_index": card_index,
+            "p1_id": a["id"],
+            "p2_id": b["id"],
+            "handicap": _handicap_for(a["order"], b["order"], handicap_by_diff),
+            "rematches": rematches.get(_pair_key(a["id"], b["id"]), 0),
+        })
+    waiting_ids = [p["id"] for p in waiting]
+
+    if dry_run or not proposal:
+        return jsonify(success=True, pairs=proposal, waiting=waiting_ids, cards=[])
+
+    from sqlalchemy.orm.exc import StaleDataError
+    try:
+        saved = []
+        for item in proposal:
+            row = card_rows.get(item["card_index"])
+            saved.append(_upsert_card_state(date, {
+                "index": item["card_index"],
+                "expected_version": row.version if row else 0,
+                "match_type": "認定戦",
+                "p1_id": item["p1_id"],
+                "p2_id": item["p2_id"],
+                "status": "pending",
+                **{key: "" for key in CARD_DETAIL_FIELDS},
+                "handicap": item["handicap"],
+            }))
+        db.session.commit()
+    except (CardVersionConflict, StaleDataError, IntegrityError):
+        db.session.rollback()
+        return jsonify(success=False, message="他の端末でカードが更新されています。もう一度お試しください。",
+                       cards=_current_cards(date, [p["card_index"] for p in proposal])), 409
+
+    cards = [_card_state_dict(c) for c in saved]
+    publish_live_event("cards", {"cards": cards}, date=date)
+    return jsonify(success=True, pairs=proposal, waiting=waiting_ids, cards=cards)
+
+
+# ===== 対局待ちキュー（クラブ×日×会場ごと。メモリ上で保持し、WaitingQueueEntry に控える） =====
+# 並び順：本日の対局数が少ない → 長く待っている → 先に受付した
+# 受付・取消・カード更新・結果保存はすべて publish_live_event を通るので、そこで反映する
+PROPOSE_LOOKAHEAD = 12    # 次の対局の候補として見る待ち行列の先頭人数
+
+
+class _DayQueue:
+    """1クラブ×1日×1会場ぶんの待ち行列"""
+
+    def __init__(self):
+        self.entries = {}     # participant_id -> {"checked_in_at", "waiting_since", "games"}
+        self.seats = {}       # card_index -> (p1_id, p2_id)（カードに載っている人）
+        self.rematches = {}   # _pair_key -> 本日の認定系対局回数
+
+    def waiting(self):
+        seated = {pid for pair in self.seats.values() for pid in pair if pid}
+        rows = [(pid, e) for pid, e in self.entries.items() if pid not in seated]
+        rows.sort(key=lambda r: (r[1]["games"], r[1]["waiting_since"], r[1]["checked_in_at"]))
+        return rows
+
+
+class WaitingScheduler:
+    """
+    対局待ちキューの管理（ワーカーごとのメモリ＋DB控え）
+    - 参照は来場記録 / Match を読まずにメモリから返す（初回と他ワーカーの更新後だけ DB から読み直す）
+    - 自プロセスの更新は publish_live_event 経由で反映、他ワーカーの更新はライブイベントを見て読み直し
+    - ロックはメモリの読み書きだけ。DB の読み込み・控えの書き込みはロックの外で行う
+      （全クラブ・全会場で1つのロックなので、DB を待つ間ほかのリクエストを止めない）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._days = {}             # (club_id, date, room) -> _DayQueue
+        self._generation = 0        # 他ワーカーの更新で読み直すたびに増える（読み込み中に古くなった分は置かない）
+
+    # --- 読み込み ---
+    def _get(self, club_id, date, room):
+        key = (club_id, date, room)
+        with self._lock:
+            day = self._days.get(key)
+            generation = self._generation
+        if day is not None:
+            return day
+        live_hub.ensure_running()  # 他ワーカーの更新を受け取るため
+        loaded = self._load(club_id, date, room)
+        with self._lock:
+            day = self._days.get(key)
+            if day is not None:
+                return day  # 他のスレッドが先に読み込んだ：そちらを使う
+            if self._generation == generation:
+                # 同じクラブ・会場の別の日は捨てる（当日分だけ持てば十分）
+                for k in [k for k in self._days if k[0] == club_id and k[2] == room]:
+                    self._days.pop(k, None)
+                self._days[key] = loaded
+        return loaded
+
+    def _load(self, club_id, date, room):
+        from models import WaitingQueueEntry
+        day = _DayQueue()
+        rows = _today_pair_rows(date, club_id, room) or []
+        for p1, p2, match_type, count, _last in rows:
+            if match_type in RATED_MATCH_TYPES:
+                key = _pair_key(p1, p2)
+                day.rematches[key] = day.rematches.get(key, 0) + count
+
+        entries = WaitingQueueEntry.query.filter_by(club_id=club_id, date=date, room=room).all()
+        if not entries:
+            entries = self._seed(club_id, date, room, rows)
+        for e in entries:
+            day.entries[e.participant_id] = {
+                "checked_in_at": e.checked_in_at,
+                "waiting_since": e.waiting_since,
+                "games": e.games or 0,
+            }
+
+        for c in MatchCardState.query.filter_by(club_id=club_id, date=date, room=room):
+            if c.p1_id or c.p2_id:
+                day.seats[c.card_index] = (c.p1_id, c.p2_id)
+        return day
+
+    def _seed(self, club_id, date, room, rows):
+        """控えが無い日（導入前に受付済みなど）は本日の参加者と対局記録から作る"""
+        games, last_end = {}, {}
+        for p1, p2, _type, count, last in rows:
+            for pid in (p1, p2):
+                games[pid] = games.get(pid, 0) + count
+                if last and (pid not in last_end or last > last_end[pid]):
+                    last_end[pid] = last
+        from models import Attendance
+        now = datetime.utcnow()
+        entries = []
+        for i, (pid,) in enumerate(db.session.query(Attendance.member_id)
+                                   .filter(Attendance.club_id == club_id,
+                                           Attendance.date == date,
+                                           Attendance.room == room,
+                                           Attendance.left_at.is_(None),
+                                           Attendance.cancelled_at.is_(None))
+                                   .order_by(Attendance.id)):
+            checked_in = now + timedelta(microseconds=i)  # 受付順を保つ
+            entries.append(SimpleNamespace(
+                participant_id=pid, checked_in_at=checked_in,
+                waiting_since=last_end.get(pid) or checked_in,
+                games=games.get(pid, 0),
+            ))
+        self._persist_insert(club_id, date, room, entries)
+        return entries
+
+    # --- DB 控え（本処理のコミット後に別トランザクションで書く） ---
+    def _persist_insert(self, club_id, date, room, entries):
+        from models import WaitingQueueEntry
+        t = WaitingQueueEntry.__table__
+        rows = [{
+            "club_id": club_id, "date": date, "room": room, "participant_id": e.participant_id,
+            "checked_in_at": e.checked_in_at, "waiting_since": e.waiting_since, "games": e.games,
+        } for e in entries]
+        if not rows:
+            return
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(t.insert().values(rows))  # まとめて1文
+            return
+        except IntegrityError:
+            pass  # 一部を他ワーカーが先に登録済み：1行ずつ入れ直す
+        for row in rows:
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(t.insert().values(**row))
+            except IntegrityError:
+                pass  # 他ワーカーが先に登録済み
+
+    def _persist_result(self, club_id, date, room, pids, ended_at):
+        """対局が1局終わった人：games を1増やし、待ち始めを終局時刻に（加算なので書く順番が前後しても狂わない）"""
+        from models import WaitingQueueEntry
+        t = WaitingQueueEntry.__table__
+        with db.engine.begin() as conn:
+            conn.execute(t.update()
+                         .where(t.c.club_id == club_id, t.c.date == date, t.c.room == room,
+                                t.c.participant_id.in_(list(pids)))
+                         .values(games=func.coalesce(t.c.games, 0) + 1, waiting_since=ended_at))
+
+    def _persist_delete(self, club_id, date, room, pids=None):
+        from models import WaitingQueueEntry
+        t = WaitingQueueEntry.__table__
+        stmt = t.delete().where(t.c.club_id == club_id, t.c.date == date, t.c.room == room)
+        if pids is not None:
+            stmt = stmt.where(t.c.participant_id.in_(list(pids)))
+        with db.engine.begin() as conn:
+            conn.execute(stmt)
+
+    # --- ライブイベントからの反映 ---
+    def apply_event(self, club_id, date, room, kind, payload):
+        """自プロセスで publish したイベントを反映（本処理のコミット後に呼ばれる）"""
+        if kind not in ("participants", "card", "cards", "result"):
+            return
+
+        if kind == "participants" and payload.get("reset"):
+            with self._lock:
+                self._days.pop((club_id, date, room), None)
+            self._persist_delete(club_id, date, room)
+            return
+
+        day = self._get(club_id, date, room)
+        now = datetime.utcnow()
+        writes = []   # DB の控え（ロックを外してから書く）
+        with self._lock:
+            if kind == "participants":
+                added = [SimpleNamespace(participant_id=str(pid), checked_in_at=now,
+                                         waiting_since=now, games=0)
+                         for pid in payload.get("added", []) if str(pid) not in day.entries]
+                for e in added:
+                    day.entries[e.participant_id] = {
+                        "checked_in_at": e.checked_in_at, "waiting_since": e.waiting_since, "games": 0,
+                    }
+                if added:
+                    writes.append(lambda: self._persist_insert(club_id, date, room, added))
+                removed = [str(pid) for pid in payload.get("removed", [])]
+                if removed:
+                    for pid in removed:
+                        day.entries.pop(pid, None)
+                    writes.append(lambda: self._persist_delete(club_id, date, room, removed))
+
+            elif kind in ("card", "cards"):
+                for card in (payload.get("cards") if kind == "cards" else [payload]):
+                    idx = card.get("card_index")
+                    if card.get("p1_id") or card.get("p2_id"):
+                        day.seats[idx] = (card.get("p1_id"), card.get("p2_id"))
+                    else:
+                        day.seats.pop(idx, None)  # 空いたカードの2人は待ち時間を保ったまま行列に戻る
+
+            elif kind == "result":
+                p1, p2 = payload.get("player1_id"), payload.get("player2_id")
+                finished = []
+                for pid in (p1, p2):
+                    entry = day.entries.get(pid)
+                    if entry:
+                        entry["games"] += 1
+                        entry["waiting_since"] = now
+                        finished.append(pid)
+                if finished:
+                    writes.append(lambda: self._persist_result(club_id, date, room, finished, now))
+                if payload.get("match_type") in RATED_MATCH_TYPES:
+                    key = _pair_key(p1, p2)
+                    day.rematches[key] = day.rematches.get(key, 0) + 1
+
+        for write in writes:
+            write()
+
+    def on_bus_event(self, row):
+        """ライブイベントのポーラーから：他ワーカーの更新なら読み直す（自プロセスの分は apply_event で反映済み）"""
+        if row.kind not in ("participants", "card", "cards", "result"):
+            return
+        if row.worker == live_worker_id():
+            return
+        with self._lock:
+            self._generation += 1
+            self._days.pop((row.club_id, row.date, row.room or ""), None)
+
+    # --- 参照 ---
+    def snapshot(self, club_id, date, room=""):
+        """着席していない人を行列順に [{id, games, wait_minutes}] と、再戦回数の写し"""
+        now = datetime.utcnow()
+        day = self._get(club_id, date, room)
+        with self._lock:
+            waiting = [{
+                "id": pid,
+                "games": e["games"],
+                "wait_minutes": max(0, int((now - e["waiting_since"]).total_seconds() // 60)),
+            } for pid, e in day.waiting()]
+            return waiting, dict(day.rematches)
+
+    def propose(self, club_id, date, room=""):
+        """
+        行列の先頭の人と、その後ろ PROPOSE_LOOKAHEAD 人から最もコストの低い相手を組む
+        戻り値: {p1_id, p2_id, handicap, rematches} / 組めなければ None
+        """
+        waiting_rows, rematches = self.snapshot(club_id, date, room)
+        strength_order, handicap_by_diff = _pairing_rules()
+        players = _pairing_candidates(waiting_rows[:PROPOSE_LOOKAHEAD], strength_order)
+        if len(players) < 2:
+            return None
+        head = players[0]
+        partner = min(players[1:], key=lambda b: _pairing_cost(head, b, rematches, handicap_by_diff))
+        return {
+            "p1_id": head["id"],
+            "p2_id": partner["id"],
+            "handicap": _handicap_for(head["order"], partner["order"], handicap_by_diff),
+            "rematches": rematches.get(_pair_key(head["id"], partner["id"]), 0),
+        }
+
+
+waiting_scheduler = WaitingScheduler()
+live_hub.add_listener(waiting_scheduler.on_bus_event)
+
+
+@app.route("/api/waiting_queue")
+def waiting_queue():
+    """
+    対局待ちの行列（着席していない人を順番どおり）と、次の組み合わせ案
+    出力: { success, waiting: [{id, games, wait_minutes}], next: {p1_id, p2_id, handicap, rematches} | null }
+    """
+    date = (request.args.get("date") or jst_today_str()).strip()
+    room = current_room()
+    if jst_date_range_to_utc_naive(date, None)[0] is None:
+        return jsonify(success=False, message="date が不正です"), 400
+    waiting, _ = waiting_scheduler.snapshot(g.current_club, date, room)
+    return jsonify(success=True, waiting=waiting, next=waiting_scheduler.propose(g.current_club, date, room))
+
+
+@app.route("/api/waiting_queue/seat", methods=["POST"])
+def waiting_queue_seat():
+    """
+    空いたカードに次の組み合わせを着席させる
+    入力: { date, card_index, p1_id?, p2_id? }（p1/p2 を省略すると行列の提案どおり）
+    出力: { success, pair, card }
+    """
+    data = request.get_json(silent=True) or {}
+    date = (data.get("date") or jst_today_str()).strip()
+    card_index = data.get("card_index")
+    room = current_room()
+    if card_index is None or jst_date_range_to_utc_naive(date, None)[0] is None:
+        return jsonify(success=False, message="date と card_index は必須です"), 400
+    try:
+        card_index = int(card_index)
+    except (TypeError, ValueError):
+        return jsonify(success=False, message="card_index は整数で指定してください"), 400
+
+    if data.get("p1_id") and data.get("p2_id"):
+        # 画面で確認した組み合わせ：その2人がまだ待っていることだけ確かめる
+        waiting, rematches = waiting_scheduler.snapshot(g.current_club, date, room)
+        waiting_ids = {r["id"] for r in waiting}
+        p1_id, p2_id = str(data["p1_id"]), str(data["p2_id"])
+        if p1_id not in waiting_ids or p2_id not in waiting_ids:
+            return jsonify(success=False, message="どちらかの対局者がすでに着席しています"), 409
+        pair = {"p1_id": p1_id, "p2_id": p2_id, "handicap": "",
+                "rematches": rematches.get(_pair_key(p1_id, p2_id), 0)}
+        strength_order, handicap_by_diff = _pairing_rules()
+        seated = _pairing_candidates([{"id": p1_id}, {"id": p2_id}], strength_order)
+        if len(seated) == 2:
+            pair["handicap"] = _handicap_for(seated[0]["order"], seated[1]["order"], handicap_by_diff)
+    else:
+        pair = waiting_scheduler.propose(g.current_club, date, room)
+        if not pair:
+            return jsonify(success=False, message="組める対局者が待っていません"), 404
+
+    row = MatchCardState.query.filter_by(club_id=g.current_club, date=date, room=room, card_index=card_index).first()
+    if row and (row.p1_id or row.p2_id or row.status == "ongoing"):
+        return jsonify(success=False, message="このカードはすでに使われています",
+                       cards=[_card_state_dict(row)]), 409
+
+    from sqlalchemy.orm.exc import StaleDataError
+    try:
+        card = _upsert_card_state(date, {
+            "index": card_index,
+            "expected_version": row.version if row else 0,
+            "match_type": "認定戦",
+            "p1_id": pair["p1_id"],
+            "p2_id": pair["p2_id"],
+            "status": "pending",
+            **{key: "" for key in CARD_DETAIL_FIELDS},
+            "handicap": pair.get("handicap") or "",
+        })
+        db.session.commit()
+    except (CardVersionConflict, StaleDataError, IntegrityError):
+        db.session.rollback()
+        return jsonify(success=False, message="他の端末でカードが更新されています",
+                       cards=_current_cards(date, [card_index])), 409
+
+    card_dict = _card_state_dict(card)
+    publish_live_event("card", card_dict, date=date)
+    return jsonify(success=True, pair=pair, card=card_dict)
+
+
+@app.cli.command("bench-pairing")
+@click.option("--players", default=200, help="待機中の参加者数")
+@click.option("--cards", default=40, help="空きカード数")
+@click.option("--repeat", default=20, help="計測回数")
+def bench_pairing_command(players, cards, repeat):
+    """自動組み合わせ（solve_pairing）の計算時間を合成データで計測する"""
+    import random
+    rng = random.Random(0)
+    roster = [{"id": f"m{i}", "order": rng.randint(1, 40),
+               "games": rng.randint(0, 4), "wait_minutes": rng.randint(0, 90)}
+              for i in range(players)]
+    rematches = {_pair_key(f"m{rng.randrange(players)}", f"m{rng.randrange(players)}"): 1
+                 for _ in range(players)}
+    handicap_by_diff = {d: f"{d}段差" for d in range(0, 10)}
+
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        pairs, waiting = solve_pairing(roster, cards, rematches, handicap_by_diff)
+        timings.append((time.perf_counter() - t0) * 1000)
+    timings.sort()
+    print(f"players={players} cards={cards} pairs={len(pairs)} waiting={len(waiting)}")
+    print(f"median {timings[len(timings) // 2]:.1f} ms / max {timings[-1]:.1f} ms")
+
 # ...（前略）
 
 @app.route("/member/<member_id>/recent")
@@ -3805,27 +6741,34 @@ def results_edit_index():
     start_dt, end_dt = jst_date_range_to_utc_naive(start_str, end_str)
 
     # 対象Matchを期間で抽出（古い順）★クラブ境界を必ず付与
-    q = db.session.query(Match).options(
-        joinedload(Match.results)
-    ).filter(Match.club_id == g.current_club)
+    q = db.session.query(Match).filter(Match.club_id == g.current_club)
     if start_dt:
         q = q.filter(Match.ended_at >= start_dt)
     if end_dt:
         q = q.filter(Match.ended_at <= end_dt)
 
-    matches = q.order_by(Match.ended_at.asc(), Match.id.asc()).all()
+    # 1ページ分だけ読む（期間が長くても一定時間）
+    page = keyset_paginate(q, [(Match.ended_at, False, True), (Match.id, False, False)], Match.id)
+    matches = page.rows
+
+    # 結果・会員名はこのページの分だけまとめて読む
+    results_by_match = {}
+    for r in MatchResult.query.filter(MatchResult.match_id.in_([m.id for m in matches])):
+        results_by_match.setdefault(r.match_id, []).append(r)
+    player_ids = {pid for m in matches for pid in (m.player1_id, m.player2_id) if pid}
+    members_by_id = {mb.id: mb for mb in Member.query.filter(Member.id.in_(player_ids))}
 
     # 表示用に整形
     rows = []
     for m in matches:
         # 結果は2件の想定（プレイヤーごと）だが、順序は保証されないので player_id で突き合わせる
-        r_by_pid = {r.player_id: r for r in (m.results or [])}
+        r_by_pid = {r.player_id: r for r in results_by_match.get(m.id, [])}
         r1 = r_by_pid.get(m.player1_id)
         r2 = r_by_pid.get(m.player2_id)
 
         # 名前は Member を優先、なければ相手名をフォールバック
-        p1 = Member.query.get(m.player1_id)
-        p2 = Member.query.get(m.player2_id)
+        p1 = members_by_id.get(m.player1_id)
+        p2 = members_by_id.get(m.player2_id)
         p1_name = p1.name if p1 else (r2.opponent_name if r2 else "")
         p2_name = p2.name if p2 else (r1.opponent_name if r1 else "")
         ended = format_utc_naive_to_local_display(m.ended_at)
@@ -3843,7 +6786,7 @@ def results_edit_index():
 
     # テンプレートがあれば使う（次ターンで実装）
     if _template_exists("results_edit.html"):
-        return render_template("results_edit.html", rows=rows, start=start_str, end=end_str)
+        return render_template("results_edit.html", rows=rows, page=page, start=start_str, end=end_str)
 
     # フォールバックの簡易表
     html = ["<table><thead><tr>",
@@ -3964,9 +6907,11 @@ def grade_history_index():
     if end_dt:
         q = q.filter(GradeHistory.changed_at <= end_dt)
 
-    rows = q.order_by(GradeHistory.changed_at.desc()).all()
+    # 新しい順に1ページ分だけ（同時刻は id の新しい順）
+    page = keyset_paginate(q, [(GradeHistory.changed_at, True, True), (GradeHistory.id, True, False)],
+                           GradeHistory.id)
 
-    return render_template("grade_history.html", rows=rows, start=start_str or "", end=end_str or "")
+    return render_template("grade_history.html", rows=page.rows, page=page, start=start_str or "", end=end_str or "")
 
 # === 昇段級履歴：CSV出力 ===
 @app.route("/grade_history/export")
@@ -4136,7 +7081,10 @@ def results_edit_detail(match_id: int):
         # 対局者
         p1_id = (request.form.get("player1_id") or "").strip()
         p2_id = (request.form.get("player2_id") or "").strip()
-        if p1_id and p2_id and p1_id != p2_id:
+        # ★クラブ境界：検索で選んだ会員がこのクラブの会員か
+        in_club = {mid for (mid,) in db.session.query(Member.id)
+                   .filter(Member.club_id == g.current_club, Member.id.in_([p1_id, p2_id]))}
+        if p1_id and p2_id and p1_id != p2_id and {p1_id, p2_id} <= in_club:
             m.player1_id = p1_id
             m.player2_id = p2_id
 
@@ -4235,8 +7183,11 @@ def results_edit_detail(match_id: int):
     )
     strength_names = ["未認定"] + [s.name for s in strengths]  # 未認定を最弱で先頭に
 
-    # ★会員プルダウンをクラブ内に限定（現役のみで良ければ .filter(Member.is_active.is_(True)) を追加）
-    members = Member.query.filter_by(club_id=g.current_club).order_by(Member.kana).all()
+    # ★会員プルダウンは現在の対局者だけ（ほかの会員は画面で検索して選ぶ：/api/members/search）
+    members = (Member.query
+               .filter(Member.club_id == g.current_club,
+                       Member.id.in_([pid for pid in (m.player1_id, m.player2_id) if pid]))
+               .all())
 
     # ★ 他クラブの選択肢混入を避けるため、クラブで絞る
     handicap_options = [h.handicap for h in HandicapRule.query
@@ -4336,6 +7287,13 @@ def results_edit_new():
         if not p1_id or not p2_id or p1_id == p2_id:
             return "対局者の指定が不正です（空または同一）", 400
 
+        # --- 二重送信（フォームの再送信）は一覧へ戻すだけ ---
+        idem_key = _request_idempotency_key()
+        if _find_match_by_idempotency_key(idem_key) is not None:
+            return redirect(url_for("results_edit_index",
+                                    start=request.args.get("start"),
+                                    end=request.args.get("end")))
+
         # --- Match 作成 ---
         match = Match(
             player1_id=p1_id,
@@ -4344,10 +7302,11 @@ def results_edit_new():
             handicap=handicap,
             started_at=ended_at,   # 編集画面では started/ended を同値で保存
             ended_at=ended_at,
-            is_recorded=True
+            is_recorded=True,
+            idempotency_key=idem_key,
         )
         db.session.add(match)
-        db.session.commit()  # match.id 確定
+        db.session.flush()  # match.id 確定（結果・昇段級と同じトランザクションでコミット）
 
         # 対局者情報
         m1 = Member.query.get(p1_id)
@@ -4412,7 +7371,11 @@ def results_edit_new():
             before = m2.grade if m2 else ""
             apply_promotion(m2, before, new_grade_p2, reset_p2, r2)
 
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 同じキーの送信が並行して先にコミットされた
+            db.session.rollback()
 
         # 一覧に戻る（期間パラメータを引き継ぎ）
         return redirect(url_for("results_edit_index",
@@ -4460,7 +7423,9 @@ def results_edit_new():
         handicap_options=handicap_options,
         ended_at_input=format_utc_naive_to_local_input(match.ended_at),
         # ★ テンプレに club を渡す（比較で使われる）
-        club=club
+        club=club,
+        # 二重送信防止キー（フォーム表示ごとに発行）
+        idempotency_key=secrets.token_hex(16),
     )
 
 @app.route("/outside/new", methods=["GET", "POST"])
@@ -4469,8 +7434,8 @@ def outside_new():
     活動外成績入力フォーム：会員・日付・備考を入力。
     チェックONなら昇段級（新段級）も反映して GradeHistory を追加。
     """
-    # 会員一覧（かな順）を作成
-    members = Member.query.filter_by(club_id=g.current_club, is_active=True).order_by(Member.kana).all()
+    # 会員は画面で検索して選ぶ（/api/members/search）。全会員のプルダウンは書き出さない
+    members = []
 
     if request.method == "POST":
         member_id = (request.form.get("member_id") or "").strip()
@@ -4479,8 +7444,14 @@ def outside_new():
         do_promote = (request.form.get("do_promote") == "on")
         new_grade = (request.form.get("new_grade") or "").strip()
 
-        if not member_id or not note:
-            return render_template("outside_form.html", members=members, error="会員と備考は必須です。")
+        # ★クラブ境界：選ばれた会員がこのクラブの現役会員か
+        member = (Member.query.filter_by(id=member_id, club_id=g.current_club, is_active=True).first()
+                  if member_id else None)
+        if member:
+            members = [member]   # エラーで戻ったときも選択を残す
+        if not member or not note:
+            return render_template("outside_form.html", members=members, selected_id=member_id,
+                                   error="会員と備考は必須です。")
 
         # 日付 → datetime（JST 00:00 として保存）
         try:
@@ -4543,40 +7514,32 @@ def outside_new():
 def require_login():
     path = request.path or "/"
 
+    # 0) 静的ファイルはセッションにもDBにも触れずに素通し（セッションは初めて読んだ時に読み込むため）
+    if path.startswith("/static/"):
+        return
+    # 公開URLは未ログイン想定：クラブは URL 上の club_id で決め、セッションは読まない
+    if path.startswith("/public/") or (path.startswith("/c/") and "/public/" in path):
+        parts = path.split("/", 3)
+        g.current_club = parts[2] if path.startswith("/c/") and len(parts) >= 3 and parts[2] else "default_club"
+        return
+
     # 1) URL で /c/<club_id>/. が来たら、その club_id を最優先で採用
     if path.startswith("/c/"):
         parts = path.split("/", 3)
         if len(parts) >= 3 and parts[2]:
             session["club_id"] = parts[2]
 
-    club_id = session.get("impersonate_club_id") or session.get("club_id") or "default_club"
-    g.current_club = club_id
-    g.current_club_obj = Club.query.get(club_id)
-
-    ensure_default_admin_for_club()
-    ensure_default_owner()
-
     # 2) 代行ログイン中はそのクラブを最優先。なければ session['club_id']、最後の最後に default_club
     club_id = session.get("impersonate_club_id") or session.get("club_id") or "default_club"
 
     # 3) 以降は "ID文字列" を g.current_club に保持（全クエリの club_id 比較が安定）
     g.current_club = club_id
-    # テンプレ注入や表示用にオブジェクトは別スロットへ
-    g.current_club_obj = Club.query.get(club_id)
+    # テンプレ注入や表示用のオブジェクトは current_club_obj() で使うときに読む
 
-    # 4) 認証初期値の保証（最初の1回だけ実行されればOK）
+    # 4) 認証初期値の保証（クラブ・ワーカーごとに最初の1回だけ DB を見る）
     ensure_default_admin_for_club()  # ← クラブ別のadmin初期値
     ensure_default_owner()           # ← オーナー認証の初期化（従来通りグローバル）
 
-    # 5) 静的・公開は素通し
-    if path.startswith("/static/"):
-        return
-    if path.startswith("/public/"):
-        return
-    # ★追加：クラブ付きの公開URLも素通し
-    if path.startswith("/c/") and "/public/" in path:
-        return
-
     if path.startswith("/owner/"):
         if path == "/owner/login":
             return
@@ -4630,8 +7593,8 @@ def login():
         username = (request.form.get("username") or "").strip()
         password = (request.form.get("password") or "")
 
-        # 1) まずは現在の g.current_club_obj を採用
-        target_club = getattr(g, "current_club_obj", None)
+        # 1) まずは現在のクラブを採用
+        target_club = current_club_obj()
 
         # 2) もしフォームの club_id が空、または現在のクラブIDと username が不一致なら、
         #    username を club.id とみなしてクラブを自動特定する
@@ -4657,6 +7620,7 @@ def login():
 
             # パスワード検証
             if target_club.admin_password_hash and check_password_hash(target_club.admin_password_hash, password):
+                regenerate_session_id()
                 session["logged_in"] = True
                 session["login_user"] = username
                 session["club_id"] = target_club.id
@@ -4693,6 +7657,7 @@ def owner_login():
         owner = Owner.query.filter_by(username=username).first()
         ok = owner and check_password_hash(owner.password_hash, password)
         if ok:
+            regenerate_session_id()
             session["owner_logged_in"] = True
             session["owner_login_user"] = owner.username
             session.pop("impersonate_club_id", None)  # 念のため
@@ -4754,6 +7719,7 @@ def owner_auth_update():
 @app.route("/logout")
 def logout():
     session.clear()
+    regenerate_session_id()
     flash("ログアウトしました。", "info")
     return redirect(url_for("login"))
 
@@ -4767,7 +7733,7 @@ def update_auth():
     new_password = request.form.get("new_password") or ""
 
     # ★ 参照は Club のみ（ID=club.id 固定。IDの更新はここでは行わない）
-    club_obj = getattr(g, "current_club_obj", None)
+    club_obj = current_club_obj()
     if not club_obj or not club_obj.admin_password_hash or not check_password_hash(club_obj.admin_password_hash, current_password):
         flash("現在のパスワードが正しくありません。", "error")
         return redirect(url_for("index"))
@@ -4804,23 +7770,13 @@ def update_auth():
 # QR選択画面 ---
 @app.route("/qr/select", methods=["GET"])
 def qr_select():
-    # 「数字だけ」判定と「安全な数値値」をヘルパで取得（方言対応）
-    is_numeric = case((expr_member_code_is_numeric(), 1), else_=0)
-    num_value  = expr_member_code_numeric_value()
-
+    # 会員ID（member_code）の自然順：保存済みの並び順キーで
     members = (Member.query
                .filter(
                    Member.left_at.is_(None),
                    Member.club_id == g.current_club
                )
-               .order_by(
-                   # 数字のみ(1)を先に
-                   is_numeric.desc(),
-                   # 数字グループは数値昇順、非数値はNULL→後ろ
-                   num_value.asc(),
-                   # 最後に文字列で安定化
-                   Member.member_code.asc()
-               )
+               .order_by(member_code_order())
                .all())
     return render_template("qr_select.html", members=members)
 
@@ -4840,6 +7796,7 @@ def qr_batch_zip():
                 Member.left_at.is_(None),
                 Member.club_id == g.current_club   # ← クラブ境界を強制
             )
+            .order_by(member_code_order())
             .all())
 
     targets = [m for m in targets if getattr(m, "qr_token", None)]
@@ -4848,55 +7805,12 @@ def qr_batch_zip():
         flash("選択された会員に有効なQRトークンがありません。", "warning")
         return redirect(url_for("qr_select"))
 
-    # メモリ上でZIPを作る
-    mem = BytesIO()
-    with zipfile.ZipFile(mem, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for m in targets:
-            # --- QR本体生成（RGBへ変換しておく） ---
-            import qrcode
-            from PIL import Image, ImageDraw
-            import io
-
-            qr_img = qrcode.make(m.qr_token).convert("RGB")
-            w, h = qr_img.size
-
-            # --- 上部に白帯追加＆左上に名前を描画 ---
-            header_h = 56  # 白帯の高さ。必要に応じて調整OK
-            canvas = Image.new("RGB", (w, h + header_h), "white")
-            canvas.paste(qr_img, (0, header_h))
-
-            draw = ImageDraw.Draw(canvas)
-            name_text = f"{m.name}"
-            font_size = 28
-            font = _get_jp_font(font_size)
-
-            # 帯の左右8pxマージンで収まるようにフォント縮小
-            max_w = w - 16
-            while True:
-                bbox = draw.textbbox((0, 0), name_text, font=font)
-                text_w = bbox[2] - bbox[0]
-                if text_w <= max_w or font_size <= 12:
-                    break
-                font_size -= 2
-                font = _get_jp_font(font_size)
-
-            draw.text((8, 8), name_text, fill=(0, 0, 0), font=font)
-
-            # --- ZIPへ書き出し ---
-            display_code = getattr(m, "member_code", None) or m.id
-            filename = f"{display_code}_{m.name}.png"
-            buf = io.BytesIO()
-            canvas.save(buf, format="PNG")
-            buf.seek(0)
-            zf.writestr(filename, buf.read())
+    if qrcode is None:
+        return "qrcode ライブラリが未インストールです。`pip install qrcode[pil]` を実行してください。", 500
 
-    mem.seek(0)
-    return send_file(
-        mem,
-        mimetype="application/zip",
-        as_attachment=True,
-        download_name="selected_qr_codes.zip",
-    )
+    entries = qr_zip_entries(targets)
+    job_id = start_qr_zip_job(g.current_club, entries, "selected_qr_codes.zip")
+    return _render_qr_zip_progress(job_id, len(entries), url_for("qr_select"))
 
 # --- 追加：選択した会員の「QRトークン付き個人成績URL」をCSV出力 ---
 @app.post("/qr/token_urls_csv")
@@ -4907,10 +7821,6 @@ def qr_token_urls_csv():
         flash("会員が選択されていません。", "warning")
         return redirect(url_for("qr_select"))
 
-    # ▼ 並び替え用の式（数値だけ→先頭、その中は数値昇順／非数値は文字列昇順）
-    is_numeric_flag = case((expr_member_code_is_numeric(), 0), else_=1)
-    num_value       = expr_member_code_numeric_value()
-
     # 退会者を除外し、QRトークン未発行はスキップしつつ、会員ID順で取得
     targets = (
         Member.query
@@ -4920,9 +7830,7 @@ def qr_token_urls_csv():
             Member.club_id == g.current_club   # ← クラブ境界
         )
         .order_by(
-            is_numeric_flag.asc(),           # 数字コード(0)が先
-            num_value.asc(),                 # 数字だけの中は実数値で昇順
-            Member.member_code.asc(),        # 英字混じりは文字列昇順
+            member_code_order(),             # 数字コードが先（数値昇順）、英字混じりは文字列昇順
             Member.id.asc()                  # 念のため安定化
         )
         .all()
@@ -4967,15 +7875,8 @@ def api_regenerate_qr_token(member_id: str):
     if not m or m.left_at is not None:
         return jsonify(success=False, message="対象会員が見つからないか、退会済みです"), 404
 
-    # 既存の _issue_token を使用して重複のないトークンを作る
-    # ※_issue_token は app.py 内に既存（英数16桁）であることを前提
-    #   念のため重複チェックをループでガード
-    for _ in range(5):
-        new_token = _issue_token(16)
-        if not Member.query.filter_by(qr_token=new_token).first():
-            break
-    else:
-        return jsonify(success=False, message="トークン生成に失敗しました。再度お試しください"), 500
+    # 重複のないトークンを作る（全クラブで一意。重複確認は1回の問い合わせ）
+    new_token = _issue_unique_values(1, QR_TOKEN_LENGTH, set(), Member.qr_token)[0]
 
     # 更新して保存
     m.qr_token = new_token
@@ -4986,21 +7887,11 @@ def api_regenerate_qr_token(member_id: str):
 
 @app.get("/blind_counts")
 def blind_counts_index():
-    # 方言対応ヘルパを使用
-    is_numeric_flag = case((expr_member_code_is_numeric(), 0), else_=1)
-    num_value       = expr_member_code_numeric_value()
-
+    # 会員ID（member_code）の自然順：保存済みの並び順キーで
     members = (Member.query
                .filter(Member.left_at.is_(None),
                        Member.club_id == g.current_club)
-               .order_by(
-                   # 数字だけ(0)を先、その後に英字混じり(1)
-                   is_numeric_flag.asc(),
-                   # 数字グループのみ値が入り昇順、非数値はNULLで後ろ
-                   num_value.asc(),
-                   # 最後に文字列で安定化
-                   Member.member_code.asc()
-               )
+               .order_by(member_code_order())
                .all())
 
     # 既存データを member_id -> {counted_from, symbols[]} に整形
@@ -5389,8 +8280,9 @@ def owner_clubs_purge(club_id):
         MatchCardState.query.filter_by(club_id=club_id).delete(synchronize_session=False)
         Match.query.filter_by(club_id=club_id).delete(synchronize_session=False)
 
-        # --- 参加者・設定・各種マスタ ---
-        TodayParticipant.query.filter_by(club_id=club_id).delete(synchronize_session=False)
+        # --- 参加者（来場記録）・設定・各種マスタ ---
+        from models import Attendance
+        Attendance.query.filter_by(club_id=club_id).delete(synchronize_session=False)
         Setting.query.filter_by(club_id=club_id).delete(synchronize_session=False)
         DefaultCardCount.query.filter_by(club_id=club_id).delete(synchronize_session=False)
         PromotionRule.query.filter_by(club_id=club_id).delete(synchronize_session=False)
@@ -5683,47 +8575,38 @@ def export_today_participants_csv():
     """
     today_jst = datetime.now(ZoneInfo("Asia/Tokyo")).strftime("%Y-%m-%d")
 
-    # TodayParticipant と Member をJOINして member_code を取得
+    # 在席中の来場記録（全会場）と Member をJOINして member_code などを取得
+    from models import Attendance
     q = (
-        db.session.query(TodayParticipant, Member.member_code)
+        db.session.query(Member.id, Member.member_code, Member.name, Member.kana,
+                         Member.grade, Member.member_type)
         .join(
-            Member,
-            (Member.id == TodayParticipant.participant_id)
-            & (Member.club_id == g.current_club)
+            Attendance,
+            (Member.id == Attendance.member_id)
+            & (Attendance.club_id == g.current_club)
         )
-        .filter(
-            TodayParticipant.club_id == g.current_club,
-            TodayParticipant.date == today_jst,
-        )
-        # DB側の order_by は使わず、Python 側で自然順ソートする
+        .filter(Member.club_id == g.current_club, *_open_attendance_filter(today_jst))
+        # member_code の「数字優先の自然順」は保存済みの並び順キーで
+        .order_by(member_code_order(), Member.id)
     )
 
     rows = q.all()
 
-    # --- member_code を「数字優先の自然順」でソート ---
-    def code_sort_key(code: str, fallback: str):
-        s = (code or fallback or "")
-        if s.isdigit():
-            return (0, int(s), "")   # 数字グループ → 数値昇順
-        return (1, s)                # 非数字グループ → 文字列昇順
-
-    rows.sort(key=lambda r: code_sort_key(r[1], r[0].participant_id))  # r=(tp, member_code)
-
     output = io.StringIO()
     w = csv.writer(output)
 
     # ヘッダ
     w.writerow(["date", "member_code", "name", "kana", "grade", "member_type"])
 
-    for tp, member_code in rows:
-        display_code = (member_code or tp.participant_id) or ""
+    for m in rows:
+        display_code = (m.member_code or m.id) or ""
         w.writerow([
             today_jst,
             display_code,
-            tp.name or "",
-            tp.kana or "",
-            tp.grade or "",
-            tp.member_type or "",
+            m.name or "",
+            m.kana or "",
+            m.grade or "",
+            m.member_type or "",
         ])
 
     output.seek(0)
@@ -81,6 +81,20 @@ class DefaultCardCountForm(FlaskForm):
         ]
     )
 
+# ------------------------------------------------------------
+# 来場記録の保存日数（0 は無期限）
+#   - /settings/attendance で使用
+# ------------------------------------------------------------
+class AttendanceRetentionForm(FlaskForm):
+    days = StringField(
+        '来場記録の保存日数',
+        validators=[
+            DataRequired(message='日数は必須です'),
+            Regexp(r'^\d+$', message='半角数字で入力してください'),
+            Length(min=1, max=4, message='0〜3650の範囲で入力してください'),
+        ]
+    )
+
 # ------------------------------------------------------------
 # 棋力マスタ名入力フォーム
 #   - /settings/strengths/names で使用
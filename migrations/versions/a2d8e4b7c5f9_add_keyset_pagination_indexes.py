@@ -0,0 +1,32 @@
+"""add indexes for keyset pagination of results edit and grade history
+
+Revision ID: a2d8e4b7c5f9
+Revises: f7a3c6e1b9d4
+Create Date: 2026-10-20 13:47:09.226581
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a2d8e4b7c5f9'
+down_revision = 'f7a3c6e1b9d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('match', schema=None) as batch_op:
+        batch_op.create_index('ix_match_club_ended_id', ['club_id', 'ended_at', 'id'], unique=False)
+
+    with op.batch_alter_table('grade_history', schema=None) as batch_op:
+        batch_op.create_index('ix_grade_history_club_changed_id', ['club_id', 'changed_at', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('grade_history', schema=None) as batch_op:
+        batch_op.drop_index('ix_grade_history_club_changed_id')
+
+    with op.batch_alter_table('match', schema=None) as batch_op:
+        batch_op.drop_index('ix_match_club_ended_id')
@@ -0,0 +1,87 @@
+"""structured match_card_state fields instead of stored html
+
+Revision ID: a7d4e9c2b6f0
+Revises: f3b9d1c7a2e8
+Create Date: 2026-10-19 20:11:38.552104
+
+"""
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7d4e9c2b6f0'
+down_revision = 'f3b9d1c7a2e8'
+branch_labels = None
+depends_on = None
+
+
+# info_html の中の駒落ち：<select> の選択肢 or 初回認定の固定表示
+_SELECTED_RE = re.compile(r'<option value="([^"]*)"\s+selected')
+_FIXED_RE = re.compile(r'駒落ち：<strong>([^<]*)</strong>')
+
+
+def _handicap_from_html(html):
+    if not html:
+        return None
+    m = _SELECTED_RE.search(html) or _FIXED_RE.search(html)
+    return m.group(1).strip() if m else None
+
+
+def upgrade():
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('handicap', sa.String(length=50), nullable=True))
+        batch_op.add_column(sa.Column('sente', sa.String(length=2), nullable=True))
+        batch_op.add_column(sa.Column('p1_grade', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('p2_grade', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('p1_next_grade', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('p2_next_grade', sa.String(length=20), nullable=True))
+        batch_op.add_column(sa.Column('started_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    # 既存行：info_html から駒落ちを取り出して移す（先手・昇段級の見込みは次の表示時に計算し直される）
+    bind = op.get_bind()
+    t = sa.table('match_card_state',
+                 sa.column('id', sa.Integer),
+                 sa.column('info_html', sa.Text),
+                 sa.column('handicap', sa.String))
+    rows = bind.execute(sa.select(t.c.id, t.c.info_html).where(t.c.info_html.isnot(None))).all()
+    for row_id, html in rows:
+        handicap = _handicap_from_html(html)
+        if handicap:
+            bind.execute(t.update().where(t.c.id == row_id).values(handicap=handicap))
+
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.drop_column('original_html2')
+        batch_op.drop_column('original_html1')
+        batch_op.drop_column('info_html')
+
+
+def downgrade():
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('info_html', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('original_html1', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('original_html2', sa.Text(), nullable=True))
+
+    # 駒落ちだけは固定表示の形で戻す（画面は両者が揃った時点で作り直す）
+    bind = op.get_bind()
+    t = sa.table('match_card_state',
+                 sa.column('id', sa.Integer),
+                 sa.column('info_html', sa.Text),
+                 sa.column('handicap', sa.String))
+    rows = bind.execute(sa.select(t.c.id, t.c.handicap).where(t.c.handicap.isnot(None))).all()
+    for row_id, handicap in rows:
+        bind.execute(t.update().where(t.c.id == row_id)
+                     .values(info_html=f'駒落ち：<strong>{handicap}</strong>'))
+
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+        batch_op.drop_column('started_at')
+        batch_op.drop_column('p2_next_grade')
+        batch_op.drop_column('p1_next_grade')
+        batch_op.drop_column('p2_grade')
+        batch_op.drop_column('p1_grade')
+        batch_op.drop_column('sente')
+        batch_op.drop_column('handicap')
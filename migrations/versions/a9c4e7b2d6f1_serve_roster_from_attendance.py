@@ -0,0 +1,101 @@
+"""serve today's roster from attendance open visits, drop today_participant
+
+Revision ID: a9c4e7b2d6f1
+Revises: e3c7a9d5b1f8
+Create Date: 2026-10-21 10:12:37.604918
+
+"""
+from datetime import datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9c4e7b2d6f1'
+down_revision = 'e3c7a9d5b1f8'
+branch_labels = None
+depends_on = None
+
+OPEN_VISIT = 'left_at IS NULL AND cancelled_at IS NULL'
+
+
+def upgrade():
+    bind = op.get_bind()
+    tp = sa.table('today_participant',
+                  sa.column('club_id', sa.String), sa.column('date', sa.String),
+                  sa.column('room', sa.String), sa.column('participant_id', sa.String))
+    att = sa.table('attendance',
+                   sa.column('id', sa.Integer), sa.column('club_id', sa.String),
+                   sa.column('date', sa.String), sa.column('member_id', sa.String),
+                   sa.column('room', sa.String), sa.column('checked_in_at', sa.DateTime),
+                   sa.column('left_at', sa.DateTime), sa.column('cancelled_at', sa.DateTime))
+    is_open = sa.and_(att.c.left_at.is_(None), att.c.cancelled_at.is_(None))
+
+    # 同じ日に在席中の行が2つある人は最初の1行を残し、ほかは取消扱いにする
+    keep = (sa.select(sa.func.min(att.c.id))
+            .where(is_open)
+            .group_by(att.c.club_id, att.c.date, att.c.member_id)
+            .scalar_subquery())
+    bind.execute(att.update().where(is_open, att.c.id.notin_(keep))
+                 .values(cancelled_at=datetime.utcnow()))
+
+    # 受付中の参加者で在席中の来場記録がない人は、その日の JST 0:00 に受付したことにして足す
+    open_keys = {(r.club_id, r.date, r.member_id)
+                 for r in bind.execute(sa.select(att.c.club_id, att.c.date, att.c.member_id).where(is_open))}
+    for r in bind.execute(sa.select(tp)).all():
+        key = (r.club_id, r.date, r.participant_id)
+        if r.club_id is None or key in open_keys:
+            continue
+        open_keys.add(key)
+        try:
+            midnight = datetime.strptime(r.date, '%Y-%m-%d') - timedelta(hours=9)
+        except (TypeError, ValueError):
+            continue
+        bind.execute(att.insert().values(
+            club_id=r.club_id, date=r.date, member_id=r.participant_id, room=r.room or '',
+            checked_in_at=midnight))
+
+    with op.batch_alter_table('attendance', schema=None) as batch_op:
+        batch_op.create_index('uq_attendance_open', ['club_id', 'date', 'member_id'], unique=True,
+                              postgresql_where=sa.text(OPEN_VISIT),
+                              sqlite_where=sa.text(OPEN_VISIT))
+
+    with op.batch_alter_table('today_participant', schema=None) as batch_op:
+        batch_op.drop_index('ix_today_participant_club_date_room')
+        batch_op.drop_index('ix_today_participant_club_date_pid')
+        batch_op.drop_index(batch_op.f('ix_today_participant_club_id'))
+
+    op.drop_table('today_participant')
+
+
+def downgrade():
+    op.create_table('today_participant',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.String(), nullable=False),
+    sa.Column('room', sa.String(length=20), server_default='', nullable=False),
+    sa.Column('participant_id', sa.String(length=20), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('kana', sa.String(), nullable=True),
+    sa.Column('grade', sa.String(), nullable=True),
+    sa.Column('member_type', sa.String(), nullable=True),
+    sa.Column('club_id', sa.String(length=32), nullable=True),
+    sa.ForeignKeyConstraint(['club_id'], ['club.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('today_participant', schema=None) as batch_op:
+        batch_op.create_index('ix_today_participant_club_date_pid', ['club_id', 'date', 'participant_id'], unique=True)
+        batch_op.create_index('ix_today_participant_club_date_room', ['club_id', 'date', 'room'], unique=False)
+        batch_op.create_index(batch_op.f('ix_today_participant_club_id'), ['club_id'], unique=False)
+
+    # 在席中の来場記録を受付中の参加者に戻す（名前などは会員の今の値）
+    op.execute(
+        "INSERT INTO today_participant (date, room, participant_id, name, kana, grade, member_type, club_id) "
+        "SELECT a.date, a.room, a.member_id, m.name, m.kana, m.grade, m.member_type, a.club_id "
+        "FROM attendance a JOIN member m ON m.id = a.member_id AND m.club_id = a.club_id "
+        "WHERE a.left_at IS NULL AND a.cancelled_at IS NULL "
+        "ORDER BY a.id"
+    )
+
+    with op.batch_alter_table('attendance', schema=None) as batch_op:
+        batch_op.drop_index('uq_attendance_open', sqlite_where=sa.text(OPEN_VISIT))
@@ -0,0 +1,58 @@
+"""add room (match floor) to cards, participants, live events and waiting queue
+
+Revision ID: b1e6f3a8d2c4
+Revises: a7d4e9c2b6f0
+Create Date: 2026-10-19 21:02:17.318640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b1e6f3a8d2c4'
+down_revision = 'a7d4e9c2b6f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 既存行は会場 ''（会場が1つのクラブ）として扱う
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('room', sa.String(length=20), nullable=False, server_default=''))
+        batch_op.drop_index('ix_match_card_state_club_date_card')
+        batch_op.create_index('ix_match_card_state_club_date_room_card',
+                              ['club_id', 'date', 'room', 'card_index'], unique=True)
+
+    with op.batch_alter_table('today_participant', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('room', sa.String(length=20), nullable=False, server_default=''))
+        batch_op.create_index('ix_today_participant_club_date_room', ['club_id', 'date', 'room'], unique=False)
+
+    with op.batch_alter_table('live_event', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('room', sa.String(length=20), nullable=False, server_default=''))
+        batch_op.drop_index('ix_live_event_club_date_id')
+        batch_op.create_index('ix_live_event_club_date_room_id', ['club_id', 'date', 'room', 'id'], unique=False)
+
+    with op.batch_alter_table('waiting_queue_entry', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('room', sa.String(length=20), nullable=False, server_default=''))
+
+
+def downgrade():
+    with op.batch_alter_table('waiting_queue_entry', schema=None) as batch_op:
+        batch_op.drop_column('room')
+
+    with op.batch_alter_table('live_event', schema=None) as batch_op:
+        batch_op.drop_index('ix_live_event_club_date_room_id')
+        batch_op.create_index('ix_live_event_club_date_id', ['club_id', 'date', 'id'], unique=False)
+        batch_op.drop_column('room')
+
+    with op.batch_alter_table('today_participant', schema=None) as batch_op:
+        batch_op.drop_index('ix_today_participant_club_date_room')
+        batch_op.drop_column('room')
+
+    # 会場をまたいで同じカード番号があると一意索引を戻せないので、会場 '' 以外のカードは捨てる
+    op.execute("DELETE FROM match_card_state WHERE room <> ''")
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.drop_index('ix_match_card_state_club_date_room_card')
+        batch_op.create_index('ix_match_card_state_club_date_card', ['club_id', 'date', 'card_index'], unique=True)
+        batch_op.drop_column('room')
@@ -0,0 +1,26 @@
+"""add worker to live_event (skip a worker's own events on the bus)
+
+Revision ID: b6e1f4c9d2a7
+Revises: a2d8e4b7c5f9
+Create Date: 2026-10-20 15:21:47.803164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e1f4c9d2a7'
+down_revision = 'a2d8e4b7c5f9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('live_event', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('worker', sa.String(length=32), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('live_event', schema=None) as batch_op:
+        batch_op.drop_column('worker')
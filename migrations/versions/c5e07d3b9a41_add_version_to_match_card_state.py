@@ -0,0 +1,41 @@
+"""add version to match_card_state and make (club_id, date, card_index) unique
+
+Revision ID: c5e07d3b9a41
+Revises: 8b4d2f6a1c93
+Create Date: 2026-10-19 16:40:52.117309
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e07d3b9a41'
+down_revision = '8b4d2f6a1c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+    # 旧「全削除→再保存」の競合で重複行が残っている場合は、最新（id最大）だけ残す
+    op.execute(
+        "DELETE FROM match_card_state WHERE id NOT IN ("
+        " SELECT keep_id FROM ("
+        "  SELECT MAX(id) AS keep_id FROM match_card_state GROUP BY club_id, date, card_index"
+        " ) AS latest"
+        ")"
+    )
+
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.drop_index('ix_match_card_state_club_date_card')
+        batch_op.create_index('ix_match_card_state_club_date_card', ['club_id', 'date', 'card_index'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('match_card_state', schema=None) as batch_op:
+        batch_op.drop_index('ix_match_card_state_club_date_card')
+        batch_op.create_index('ix_match_card_state_club_date_card', ['club_id', 'date', 'card_index'], unique=False)
+        batch_op.drop_column('version')
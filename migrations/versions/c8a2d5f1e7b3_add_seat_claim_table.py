@@ -0,0 +1,67 @@
+"""add seat_claim table (one active card per participant per day)
+
+Revision ID: c8a2d5f1e7b3
+Revises: b1e6f3a8d2c4
+Create Date: 2026-10-19 21:48:05.614229
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8a2d5f1e7b3'
+down_revision = 'b1e6f3a8d2c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('seat_claim',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('club_id', sa.String(length=32), nullable=False),
+    sa.Column('date', sa.String(length=10), nullable=False),
+    sa.Column('room', sa.String(length=20), server_default='', nullable=False),
+    sa.Column('card_index', sa.Integer(), nullable=False),
+    sa.Column('participant_id', sa.String(length=20), nullable=False),
+    sa.Column('claimed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('club_id', 'date', 'participant_id', name='uq_seat_claim_club_date_participant')
+    )
+    with op.batch_alter_table('seat_claim', schema=None) as batch_op:
+        batch_op.create_index('ix_seat_claim_club_date_room_card', ['club_id', 'date', 'room', 'card_index'], unique=False)
+
+    # 既存カードに載っている人の分を作る（同じ人が複数カードにいたら先の1枚だけ。指導員は対象外）
+    bind = op.get_bind()
+    cards = sa.table('match_card_state',
+                     sa.column('club_id', sa.String), sa.column('date', sa.String),
+                     sa.column('room', sa.String), sa.column('card_index', sa.Integer),
+                     sa.column('p1_id', sa.String), sa.column('p2_id', sa.String))
+    members = sa.table('member',
+                       sa.column('id', sa.String), sa.column('member_type', sa.String))
+    claims = sa.table('seat_claim',
+                      sa.column('club_id', sa.String), sa.column('date', sa.String),
+                      sa.column('room', sa.String), sa.column('card_index', sa.Integer),
+                      sa.column('participant_id', sa.String), sa.column('claimed_at', sa.DateTime))
+    instructors = {r[0] for r in bind.execute(
+        sa.select(members.c.id).where(members.c.member_type == '指導員'))}
+    seen = set()
+    now = datetime.utcnow()
+    rows = bind.execute(sa.select(cards).order_by(cards.c.club_id, cards.c.date, cards.c.room, cards.c.card_index)).all()
+    for club_id, date, room, card_index, p1_id, p2_id in rows:
+        for pid in (p1_id, p2_id):
+            if not pid or pid in instructors or (club_id, date, pid) in seen:
+                continue
+            seen.add((club_id, date, pid))
+            bind.execute(claims.insert().values(
+                club_id=club_id, date=date, room=room or '', card_index=card_index,
+                participant_id=pid, claimed_at=now))
+
+
+def downgrade():
+    with op.batch_alter_table('seat_claim', schema=None) as batch_op:
+        batch_op.drop_index('ix_seat_claim_club_date_room_card')
+
+    op.drop_table('seat_claim')
@@ -0,0 +1,74 @@
+"""add attendance table (append-only check-in log)
+
+Revision ID: d4f7b2e9a6c1
+Revises: c8a2d5f1e7b3
+Create Date: 2026-10-19 22:31:44.902117
+
+"""
+from datetime import datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4f7b2e9a6c1'
+down_revision = 'c8a2d5f1e7b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('attendance',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('club_id', sa.String(length=32), nullable=False),
+    sa.Column('date', sa.String(length=10), nullable=False),
+    sa.Column('member_id', sa.String(length=20), nullable=False),
+    sa.Column('room', sa.String(length=20), server_default='', nullable=False),
+    sa.Column('checked_in_at', sa.DateTime(), nullable=False),
+    sa.Column('left_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('club_id', 'date', 'member_id', name='uq_attendance_club_date_member')
+    )
+    with op.batch_alter_table('attendance', schema=None) as batch_op:
+        batch_op.create_index('ix_attendance_club_member_date', ['club_id', 'member_id', 'date'], unique=False)
+        batch_op.create_index('ix_attendance_open', ['club_id', 'date'], unique=False,
+                              postgresql_where=sa.text('left_at IS NULL'),
+                              sqlite_where=sa.text('left_at IS NULL'))
+
+    # 受付中の参加者（today_participant）を在席として移す。受付時刻は対局待ちキューの控えがあればそれ、
+    # なければその日の JST 0:00（UTC では前日 15:00）
+    bind = op.get_bind()
+    tp = sa.table('today_participant',
+                  sa.column('club_id', sa.String), sa.column('date', sa.String),
+                  sa.column('room', sa.String), sa.column('participant_id', sa.String))
+    wq = sa.table('waiting_queue_entry',
+                  sa.column('club_id', sa.String), sa.column('date', sa.String),
+                  sa.column('participant_id', sa.String), sa.column('checked_in_at', sa.DateTime))
+    att = sa.table('attendance',
+                   sa.column('club_id', sa.String), sa.column('date', sa.String),
+                   sa.column('member_id', sa.String), sa.column('room', sa.String),
+                   sa.column('checked_in_at', sa.DateTime))
+    checked_in = {(r.club_id, r.date, r.participant_id): r.checked_in_at
+                  for r in bind.execute(sa.select(wq))}
+    seen = set()
+    for r in bind.execute(sa.select(tp)).all():
+        key = (r.club_id, r.date, r.participant_id)
+        if r.club_id is None or key in seen:
+            continue
+        seen.add(key)
+        try:
+            midnight = datetime.strptime(r.date, '%Y-%m-%d') - timedelta(hours=9)
+        except (TypeError, ValueError):
+            continue
+        bind.execute(att.insert().values(
+            club_id=r.club_id, date=r.date, member_id=r.participant_id, room=r.room or '',
+            checked_in_at=checked_in.get(key) or midnight))
+
+
+def downgrade():
+    with op.batch_alter_table('attendance', schema=None) as batch_op:
+        batch_op.drop_index('ix_attendance_open', sqlite_where=sa.text('left_at IS NULL'))
+        batch_op.drop_index('ix_attendance_club_member_date')
+
+    op.drop_table('attendance')
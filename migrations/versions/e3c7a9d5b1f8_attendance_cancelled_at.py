@@ -0,0 +1,44 @@
+"""attendance: record cancels as cancelled_at, allow several visits a day
+
+Revision ID: e3c7a9d5b1f8
+Revises: b6e1f4c9d2a7
+Create Date: 2026-10-20 17:04:12.518330
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3c7a9d5b1f8'
+down_revision = 'b6e1f4c9d2a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('attendance', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('cancelled_at', sa.DateTime(), nullable=True))
+        batch_op.drop_constraint('uq_attendance_club_date_member', type_='unique')
+        batch_op.drop_index('ix_attendance_open', sqlite_where=sa.text('left_at IS NULL'))
+
+
+def downgrade():
+    # 一意制約を戻す前に、取り消した行と同じ日の2回目以降の来場を消す（最初の有効な1行を残す）
+    bind = op.get_bind()
+    att = sa.table('attendance',
+                   sa.column('id', sa.Integer), sa.column('club_id', sa.String),
+                   sa.column('date', sa.String), sa.column('member_id', sa.String),
+                   sa.column('cancelled_at', sa.DateTime))
+    bind.execute(att.delete().where(att.c.cancelled_at.isnot(None)))
+    keep = (sa.select(sa.func.min(att.c.id))
+            .group_by(att.c.club_id, att.c.date, att.c.member_id)
+            .scalar_subquery())
+    bind.execute(att.delete().where(att.c.id.notin_(keep)))
+
+    with op.batch_alter_table('attendance', schema=None) as batch_op:
+        batch_op.create_index('ix_attendance_open', ['club_id', 'date'], unique=False,
+                              postgresql_where=sa.text('left_at IS NULL'),
+                              sqlite_where=sa.text('left_at IS NULL'))
+        batch_op.create_unique_constraint('uq_attendance_club_date_member', ['club_id', 'date', 'member_id'])
+        batch_op.drop_column('cancelled_at')
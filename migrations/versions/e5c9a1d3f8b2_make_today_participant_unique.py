@@ -0,0 +1,36 @@
+"""make today_participant (club_id, date, participant_id) unique
+
+Revision ID: e5c9a1d3f8b2
+Revises: d4f7b2e9a6c1
+Create Date: 2026-10-19 23:05:12.447820
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5c9a1d3f8b2'
+down_revision = 'd4f7b2e9a6c1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 同じ人の重複受付は最初の1行だけ残す
+    op.execute(
+        "DELETE FROM today_participant WHERE id NOT IN ("
+        "  SELECT keep_id FROM ("
+        "    SELECT MIN(id) AS keep_id FROM today_participant GROUP BY club_id, date, participant_id"
+        "  ) AS keep"
+        ")"
+    )
+    with op.batch_alter_table('today_participant', schema=None) as batch_op:
+        batch_op.drop_index('ix_today_participant_club_date_pid')
+        batch_op.create_index('ix_today_participant_club_date_pid', ['club_id', 'date', 'participant_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('today_participant', schema=None) as batch_op:
+        batch_op.drop_index('ix_today_participant_club_date_pid')
+        batch_op.create_index('ix_today_participant_club_date_pid', ['club_id', 'date', 'participant_id'], unique=False)
@@ -0,0 +1,51 @@
+"""add member_code_sort (stored natural-sort key for member_code)
+
+Revision ID: f7a3c6e1b9d4
+Revises: e5c9a1d3f8b2
+Create Date: 2026-10-20 10:12:38.540217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7a3c6e1b9d4'
+down_revision = 'e5c9a1d3f8b2'
+branch_labels = None
+depends_on = None
+
+
+def _sort_key(code):
+    # models.member_code_sort_key と同じ（マイグレーション時点の定義を固定で持つ）
+    s = str(code or '')
+    if not s:
+        return '2'
+    if s.isascii() and s.isdigit():
+        return '0' + s.rjust(32, '0') + s
+    return '1' + s
+
+
+def upgrade():
+    with op.batch_alter_table('member', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('member_code_sort', sa.String(length=80), nullable=True))
+        batch_op.create_index('ix_member_club_code_sort', ['club_id', 'member_code_sort'], unique=False)
+
+    # 既存会員の並び順キーを埋める
+    bind = op.get_bind()
+    member = sa.table('member',
+                      sa.column('id', sa.String), sa.column('member_code', sa.String),
+                      sa.column('member_code_sort', sa.String))
+    params = [{'_id': r.id, '_key': _sort_key(r.member_code)}
+              for r in bind.execute(sa.select(member.c.id, member.c.member_code))]
+    if params:
+        bind.execute(member.update()
+                     .where(member.c.id == sa.bindparam('_id'))
+                     .values(member_code_sort=sa.bindparam('_key')),
+                     params)
+
+
+def downgrade():
+    with op.batch_alter_table('member', schema=None) as batch_op:
+        batch_op.drop_index('ix_member_club_code_sort')
+        batch_op.drop_column('member_code_sort')
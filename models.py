@@ -1,9 +1,26 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import UniqueConstraint, event
 
 db = SQLAlchemy()
 
+MEMBER_CODE_SORT_WIDTH = 32  # member_code の最大長（数字だけのコードはこの桁までゼロ埋め）
+
+
+def member_code_sort_key(code):
+    """
+    member_code の自然順キー（文字列として比べるだけで自然順になる）
+      - 数字だけ：'0' + ゼロ埋めした数字 + 元の文字列（'7' と '007' の順も決まる）→ 数値昇順で先
+      - 英字混じり：'1' + 元の文字列 → 文字列昇順
+      - 未設定：'2'（最後）
+    """
+    s = str(code or "")
+    if not s:
+        return "2"
+    if s.isascii() and s.isdigit():
+        return "0" + s.rjust(MEMBER_CODE_SORT_WIDTH, "0") + s
+    return "1" + s
+
 # --- Multi-tenant: Club ---
 class Club(db.Model):
     __tablename__ = "club"
@@ -27,11 +44,20 @@ class Member(db.Model):
     qr_token = db.Column(db.String(32), unique=True, index=True, nullable=True)
     club_id = db.Column(db.String(32), db.ForeignKey("club.id"), index=True, nullable=True)
     member_code = db.Column(db.String(32), nullable=True)  # クラブ内で一意にする補助コード
+    member_code_sort = db.Column(db.String(80), nullable=True)  # 自然順キー（member_code_sort_key。保存時に自動で入る）
 
     __table_args__ = (
         db.UniqueConstraint("club_id", "member_code", name="uq_member_club_id_member_code"),
+        db.Index("ix_member_club_code_sort", "club_id", "member_code_sort"),
     )
 
+
+@event.listens_for(Member, "before_insert")
+@event.listens_for(Member, "before_update")
+def _fill_member_code_sort(mapper, connection, target):
+    # 追加・編集・CSV取込のどこで member_code が変わっても並び順キーを合わせる
+    target.member_code_sort = member_code_sort_key(target.member_code)
+
 class Strength(db.Model):
     __tablename__ = 'strength'
 
@@ -100,6 +126,12 @@ class Match(db.Model):
     is_recorded = db.Column(db.Boolean, default=False)
     card_index = db.Column(db.Integer)
     club_id = db.Column(db.String(32), db.ForeignKey("club.id"), index=True, nullable=True)
+    idempotency_key = db.Column(db.String(64))  # 端末が送信ごとに振るID（再送・二重送信の判定用）
+
+    __table_args__ = (
+        UniqueConstraint("club_id", "idempotency_key", name="uq_match_club_idempotency_key"),
+        db.Index("ix_match_club_ended_id", "club_id", "ended_at", "id"),  # 成績編集のページ送り
+    )
 
 class MatchResult(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -129,6 +161,10 @@ class GradeHistory(db.Model):
     )
     club_id = db.Column(db.String(32), db.ForeignKey("club.id"), index=True, nullable=True)
 
+    __table_args__ = (
+        db.Index("ix_grade_history_club_changed_id", "club_id", "changed_at", "id"),  # 履歴一覧のページ送り
+    )
+
 class InitialAssessmentResult(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     member_id = db.Column(db.String(20), db.ForeignKey('member.id'), nullable=False)
@@ -146,32 +182,31 @@ class MatchMemo(db.Model):
 
 class MatchCardState(db.Model):
     __table_args__ = (
-        db.Index("ix_match_card_state_club_date_card", "club_id", "date", "card_index"),
+        # 同じクラブ・日・会場・カード番号は1行だけ（同時保存で重複行ができないように）
+        db.Index("ix_match_card_state_club_date_room_card", "club_id", "date", "room", "card_index", unique=True),
     )
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.String(20), nullable=False)  # 例: '2025-07-22'
+    room = db.Column(db.String(20), nullable=False, default="", server_default="")  # 対局会場（'' は会場が1つのクラブ）
     card_index = db.Column(db.Integer, nullable=False)  # カード番号（0, 1, 2, ...）
     match_type = db.Column(db.String(20))
     p1_id = db.Column(db.String(20))
     p2_id = db.Column(db.String(20))
     status = db.Column(db.String(20))  # '', 'ongoing', 'finished'など
-    info_html = db.Column(db.Text)     # 駒落ちや先後のHTML（復元用）
-    original_html1 = db.Column(db.Text)
-    original_html2 = db.Column(db.Text)
+    # ▼ 表示はこれらの項目から画面側で組み立てる（HTML は保存しない）
+    handicap = db.Column(db.String(50))        # 駒落ち（例：'香落ち'・'平手（下位先手）'・'指導'）
+    sente = db.Column(db.String(2))            # 先手：'p1' / 'p2' / ''（振り駒など未定）
+    p1_grade = db.Column(db.String(20))        # 対局開始時点の棋力（昇段級前の控え）
+    p2_grade = db.Column(db.String(20))
+    p1_next_grade = db.Column(db.String(20))   # 勝てば昇段級する先（なければ空）
+    p2_next_grade = db.Column(db.String(20))
+    started_at = db.Column(db.DateTime)        # 対局開始（UTC）
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     club_id = db.Column(db.String(32), db.ForeignKey("club.id"), index=True, nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")  # 楽観ロック用（更新ごとに+1）
 
-class TodayParticipant(db.Model):
-    __table_args__ = (
-        db.Index("ix_today_participant_club_date_pid", "club_id", "date", "participant_id"),
-    )
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.String, nullable=False)
-    participant_id = db.Column(db.String(20), nullable=False)  # ← 文字列IDに統一（Member.idに合わせる）
-    name = db.Column(db.String)
-    kana = db.Column(db.String)
-    grade = db.Column(db.String)
-    member_type = db.Column(db.String)
-    club_id = db.Column(db.String(32), db.ForeignKey("club.id"), index=True, nullable=True)
+    # ORM の UPDATE は「WHERE version = 読んだ時の値」で行われ、他端末が先に更新していれば StaleDataError
+    __mapper_args__ = {"version_id_col": version}
 
 class PromotionCounterReset(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -215,3 +250,99 @@ class Owner(db.Model):
     username = db.Column(db.String(50), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ServerSession(db.Model):
+    """
+    サーバーサイド・セッション（Cookie には不透明な sid だけを載せる）
+    - data は JSON 文字列（参加者IDリスト等、Cookie に載せると肥大化するもの）
+    - expires_at を過ぎた行は定期的に掃除する
+    """
+    __tablename__ = "server_session"
+    sid = db.Column(db.String(64), primary_key=True)             # Cookie に入る不透明ID
+    data = db.Column(db.Text, nullable=False, default="{}")      # JSON 文字列
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)  # naive UTC
+
+class LiveEvent(db.Model):
+    """
+    対局進行画面のライブ更新イベント（SSE配信用のDBバス）
+    - 複数ワーカー/複数台の間でカード更新・受付・結果保存を共有する
+    - 各ワーカーは新しい id を（遅れてコミットされた分も拾えるよう少し戻って）ポーリングし、自プロセスの購読者に配る
+    """
+    __tablename__ = "live_event"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    club_id = db.Column(db.String(32), nullable=False)
+    date = db.Column(db.String(10), nullable=False)        # 'YYYY-MM-DD'（JST）
+    room = db.Column(db.String(20), nullable=False, default="", server_default="")  # 会場（購読はこの単位）
+    kind = db.Column(db.String(32), nullable=False)        # card / participants / result など
+    payload = db.Column(db.Text, nullable=False, default="{}")  # JSON 文字列（小さな差分）
+    origin = db.Column(db.String(64))                      # 送信元タブレットの clientId（自分のエコーを無視する用）
+    worker = db.Column(db.String(32))                      # 書いたワーカー（自プロセスのイベントを読み直さない用）
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index("ix_live_event_club_date_room_id", "club_id", "date", "room", "id"),
+    )
+
+class WaitingQueueEntry(db.Model):
+    """
+    対局待ちキュー（クラブ×日×会場ごと）の永続化。
+    - 実際の並び替え・参照はアプリ側のメモリ上で行い、ここは再起動・別ワーカー用の控え
+    - 着席中かどうかは対局カード（MatchCardState）から復元するので持たない
+    """
+    __tablename__ = "waiting_queue_entry"
+    __table_args__ = (
+        db.UniqueConstraint("club_id", "date", "participant_id", name="uq_waiting_queue_club_date_participant"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    club_id = db.Column(db.String(32), nullable=False)
+    date = db.Column(db.String(10), nullable=False)              # 'YYYY-MM-DD'（JST）
+    room = db.Column(db.String(20), nullable=False, default="", server_default="")  # 受付した会場
+    participant_id = db.Column(db.String(20), nullable=False)
+    checked_in_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)   # 受付時刻（UTC）
+    waiting_since = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)   # 最後に対局を終えた（or 受付した）時刻
+    games = db.Column(db.Integer, nullable=False, default=0, server_default="0")      # 本日の対局数
+
+class SeatClaim(db.Model):
+    """
+    対局カードへの着席の確保（1人は同じ日に1枚のカードにしか座れない）。
+    - (club_id, date, participant_id) の一意制約で、2台のタブレットが同時に同じ人を座らせても片方だけが通る
+    - カードの初期化・参加取消・結果保存で消える（指導員は多面指しがあるので確保しない）
+    - 保存されたカードに載らないまま一定時間たった確保は、次に同じ人を座らせるときに捨てる
+    """
+    __tablename__ = "seat_claim"
+    __table_args__ = (
+        db.UniqueConstraint("club_id", "date", "participant_id", name="uq_seat_claim_club_date_participant"),
+        db.Index("ix_seat_claim_club_date_room_card", "club_id", "date", "room", "card_index"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    club_id = db.Column(db.String(32), nullable=False)
+    date = db.Column(db.String(10), nullable=False)              # 'YYYY-MM-DD'（JST）
+    room = db.Column(db.String(20), nullable=False, default="", server_default="")
+    card_index = db.Column(db.Integer, nullable=False)
+    participant_id = db.Column(db.String(20), nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class Attendance(db.Model):
+    """
+    来場記録（追記のみ）。受付のたびに1行足す小さな行で、出席の集計・履歴に使う。
+    - 受付で作り、「本日の終了」で left_at を入れる。本日の参加者一覧は在席中（left_at も cancelled_at も NULL）の行
+    - 受付の取消は行を消さずに cancelled_at を入れる（集計からは外れる）
+    - 本日の終了後にもう一度受付したら別の行になる（前の行の時刻・会場は書き換えない）
+    - 古い行はクラブ設定 attendance_retention_days（0 は無期限）を過ぎたら消す
+    """
+    __tablename__ = "attendance"
+    __table_args__ = (
+        db.Index("ix_attendance_club_member_date", "club_id", "member_id", "date"),
+        # 在席中の行だけの部分索引：当日の一覧はこれで引き、同じ日の二重受付はこの一意制約で弾く
+        db.Index("uq_attendance_open", "club_id", "date", "member_id", unique=True,
+                 postgresql_where=db.text("left_at IS NULL AND cancelled_at IS NULL"),
+                 sqlite_where=db.text("left_at IS NULL AND cancelled_at IS NULL")),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    club_id = db.Column(db.String(32), nullable=False)
+    date = db.Column(db.String(10), nullable=False)              # 'YYYY-MM-DD'（JST）
+    member_id = db.Column(db.String(20), nullable=False)
+    room = db.Column(db.String(20), nullable=False, default="", server_default="")
+    checked_in_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # 受付時刻（UTC）
+    left_at = db.Column(db.DateTime)                             # 本日の終了時刻（UTC）。在席中は NULL
+    cancelled_at = db.Column(db.DateTime)                        # 受付を取り消した時刻（UTC）。有効な来場は NULL
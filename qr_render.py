@@ -0,0 +1,149 @@
+"""
+QRカード（上に会員名の白帯＋QR本体）の描画。
+
+ZIP一括ダウンロードは別プロセスで並列に描くので、ここは Flask アプリや DB を読み込まずに
+import できるようにしておく（子プロセスはこのモジュールだけを読み込む）
+"""
+import io
+import logging
+import os
+import threading
+from pathlib import Path
+
+from PIL import Image, ImageDraw, ImageFont
+try:
+    import qrcode
+except Exception:
+    qrcode = None  # ライブラリ未導入でもアプリが落ちないように
+
+logger = logging.getLogger(__name__)
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+LABEL_HEADER_H = 56     # 名前用の白帯の高さ（QRを壊さないよう上に足す）
+LABEL_MARGIN = 8        # 名前の左右・上の余白
+LABEL_FONT_MAX = 28     # 少し大きめから始めて、長い名前は自動で縮める
+LABEL_FONT_MIN = 12
+
+
+FONT_CANDIDATES = [
+    Path(os.path.join(basedir, "static", "fonts", "NotoSansJP-Regular.ttf")),
+    Path("/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc"),
+    Path("/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc"),
+    Path("/usr/share/fonts/opentype/noto/NotoSansCJKjp-Regular.otf"),
+    Path("/usr/share/fonts/truetype/noto/NotoSansCJKjp-Regular.otf"),
+    Path("C:/Windows/Fonts/meiryo.ttc"),
+    Path("C:/Windows/Fonts/msgothic.ttc"),
+    Path("C:/Windows/Fonts/msmincho.ttc"),
+]
+
+# ★フォントはプロセスごとに1回だけ探し、サイズごとに作ったものを使い回す
+#   （ZIPの子プロセスもそれぞれ最初の1枚で探すだけ）
+_font_lock = threading.Lock()
+_font_source = None     # 使うフォントの読み込み方（_resolve_font_source の戻り値）。未解決なら None
+_font_cache = {}        # size -> ImageFont
+
+
+def _open_font(source, size):
+    kind, target = source
+    if kind == "ttc":
+        return ImageFont.truetype(target, size, index=0)
+    if kind == "path":
+        return ImageFont.truetype(target, size)
+    if kind == "bytes":
+        return ImageFont.truetype(io.BytesIO(target), size)
+    return ImageFont.load_default()
+
+
+def _resolve_font_source():
+    """
+    日本語表示可能なフォントを順に試す（どれを掴んだかログ出力）。
+    1) <プロジェクト内> static/fonts/NotoSansJP-Regular.ttf
+    2) Linux系のNoto CJK
+    3) Windows標準
+    4) 最後にデフォルト
+    """
+    for p in FONT_CANDIDATES:
+        try:
+            if not p.exists():
+                continue
+            # .ttc は index=0、.ttf/.otf はそのまま
+            if p.suffix.lower() == ".ttc":
+                source = ("ttc", str(p))
+                _open_font(source, LABEL_FONT_MAX)
+            else:
+                # 一部環境でパス解決に失敗するケースに備えて bytes 読み込みでも試す
+                try:
+                    source = ("path", str(p))
+                    _open_font(source, LABEL_FONT_MAX)
+                except Exception:
+                    with open(p, "rb") as f:
+                        source = ("bytes", f.read())
+                    _open_font(source, LABEL_FONT_MAX)
+            logger.info(f"[QR-FONT] using: {p}")
+            return source
+        except Exception as e:
+            logger.warning(f"[QR-FONT] failed: {p} ({e})")
+            continue
+
+    logger.error("[QR-FONT] fallback to default font (no JP glyphs)")
+    return ("default", None)
+
+
+def get_jp_font(size=24):
+    """日本語表示可能なフォント（size ごとに1回だけ作る）"""
+    global _font_source
+    with _font_lock:
+        font = _font_cache.get(size)
+        if font is None:
+            if _font_source is None:
+                _font_source = _resolve_font_source()
+            font = _font_cache[size] = _open_font(_font_source, size)
+        return font
+
+
+def _text_width(font, text):
+    # 送り幅で測る（インクの外接矩形 getbbox より軽く、左右のはみ出しも含むので収まり判定には安全側）
+    return font.getlength(text)
+
+
+def fit_label_font(text, max_w, min_size=LABEL_FONT_MIN, max_size=LABEL_FONT_MAX):
+    """
+    幅 max_w に収まるいちばん大きいサイズのフォントを返す（最小サイズでもはみ出すなら最小サイズ）
+    たいていの名前は最大サイズで収まるので先にそれだけ測り、はみ出すときはサイズを二分探索する
+    """
+    font = get_jp_font(max_size)
+    if _text_width(font, text) <= max_w:
+        return font
+    lo, hi, best = min_size, max_size - 1, min_size
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        if _text_width(get_jp_font(mid), text) <= max_w:
+            best, lo = mid, mid + 1
+        else:
+            hi = mid - 1
+    return get_jp_font(best)
+
+
+def render_qr_label(token, name):
+    """QRトークン1件分のカードを描いて PNG のバイト列で返す"""
+    # 1) QR本体生成
+    img = qrcode.make(token).convert("RGB")
+
+    # 2) 上部に名前用の白帯を追加（QRを壊さない）
+    w, h = img.size
+    canvas = Image.new("RGB", (w, h + LABEL_HEADER_H), "white")
+    canvas.paste(img, (0, LABEL_HEADER_H))
+
+    # 3) 左上に会員名を描画。左右の余白を除いた幅に収まるサイズで
+    name_text = f"{name}"
+    font = fit_label_font(name_text, w - LABEL_MARGIN * 2)
+    ImageDraw.Draw(canvas).text((LABEL_MARGIN, LABEL_MARGIN), name_text, fill=(0, 0, 0), font=font)
+
+    buf = io.BytesIO()
+    canvas.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def render_qr_labels(items):
+    """[(token, name), ...] をまとめて描く（プロセスプールに渡す1回分）"""
+    return [render_qr_label(token, name) for token, name in items]
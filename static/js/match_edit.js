@@ -20,6 +20,7 @@ document.addEventListener("DOMContentLoaded", () => {
   const addBtn = document.getElementById("add-button");
   const sort = getQueryParam("sort_participants") || "member_code";
   const order = getQueryParam("order_participants") || "asc";
+  const room = encodeURIComponent(window.room || "");  // 受付する会場（URL の ?room=）
   const repeatModal = document.getElementById("repeat-match-modal");
   const repeatContinueBtn = document.getElementById("repeat-match-continue");
   const repeatCancelBtn = document.getElementById("repeat-match-cancel");
@@ -44,7 +45,7 @@ document.addEventListener("DOMContentLoaded", () => {
   }
 
   // 初期読み込み：参加者一覧取得
-  fetch(`/api/participants?date=${today}&sort=${sort}&order=${order}&_=${Date.now()}`, {
+  fetch(`/api/participants?date=${today}&sort=${sort}&order=${order}&room=${room}&_=${Date.now()}`, {
     cache: 'no-store',
     headers: { 'Cache-Control': 'no-cache' }
   })
@@ -62,7 +63,7 @@ document.addEventListener("DOMContentLoaded", () => {
     });
 
   async function reloadParticipants() {
-    const res = await fetch(`/api/participants?date=${today}&sort=${sort}&order=${order}&_=${Date.now()}`, {
+    const res = await fetch(`/api/participants?date=${today}&sort=${sort}&order=${order}&room=${room}&_=${Date.now()}`, {
       cache: 'no-store',
       headers: { 'Cache-Control': 'no-cache' }
     });
@@ -93,7 +94,7 @@ document.addEventListener("DOMContentLoaded", () => {
     fetch("/api/participants", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ date: today, ids: ids })
+      body: JSON.stringify({ date: today, ids: ids, room: window.room || "" })
     })
     .then(res => res.json())
     .then(data => {
@@ -165,7 +166,7 @@ document.addEventListener("DOMContentLoaded", () => {
       .then(res => res.json())
       .then(data => {
         if (data.success) {
-          window.location.href = "/match/play";
+          window.location.href = window.room ? `/match/play?room=${room}` : "/match/play";
         } else {
           alert("参加者の保存に失敗しました。");
         }
@@ -134,20 +134,40 @@ document.addEventListener("DOMContentLoaded", async () => { // HTML文書の読
   }
 
   try {
-    handicapRules = await fetchHandicapRules();
-
     // 🔽 ここだけ追加（URLから並び替えキーを取得）
     const sortKey = window.sortKey || "member_code";
     const sortOrder = window.sortOrder || "asc";
 
-    // 🔄 並び替え指定付きで参加者を取得
-    const participants = await fetchTodayParticipants(today, sortKey, sortOrder);
+    // 🔄 駒落ち・参加者（並び替え指定付き）・カード・既定枚数を1リクエストで取得
+    const boot = await fetchBootstrap(today, sortKey, sortOrder);
+    handicapRules = boot.handicap_rules || [];
+    const participants = boot.participants || [];
+    allParticipants = participants;
     window.participants = participants;
-    const cards = await fetchMatchCards(today);
+    const cards = boot.cards || [];
 
     await renderMatchCards(cards);
     renderParticipantTable(participants);
 
+    // 📡 他タブレットの変更をライブ反映
+    startLiveStream(today);
+
+    // 🔢 本日のペア回数表（同日再戦の警告用）
+    loadTodayPairCounts();
+
+    // 🪑 結果保存後の自動着席（端末ごとの設定）
+    const autoSeat = document.getElementById("auto-seat-toggle");
+    if (autoSeat) {
+      autoSeat.checked = isAutoSeatEnabled();
+      autoSeat.addEventListener("change", () => {
+        localStorage.setItem(AUTO_SEAT_KEY, autoSeat.checked ? "1" : "0");
+      });
+    }
+
+    // 📮 前回の送信待ちが残っていれば送る
+    updateResultQueueStatus(loadResultQueue().length);
+    flushResultQueue();
+
   } catch (error) {
     console.error("初期化中にエラー：", error);
   }
@@ -197,14 +217,14 @@ document.addEventListener("DOMContentLoaded", async () => { // HTML文書の読
       try {
         const res = await fetch("/api/end_today", {
           method: "POST",
-          headers: { "Content-Type": "application/json" },
+          headers: liveHeaders(),
           body: JSON.stringify({ date: window.today }) // JSTずれが気になる場合はサーバ側でJST再計算
         });
         const data = await res.json();
         if (data.success) {
           alert("本日の参加者をリセットし、過去の対局カードを整理しました。");
           // 参加者編集へ戻る（仕様上ここに戻るのが自然）
-          window.location.href = "/match/edit";
+          window.location.href = window.room ? `/match/edit?room=${encodeURIComponent(window.room)}` : "/match/edit";
         } else {
           alert("処理に失敗しました: " + (data.message || ""));
         }
@@ -217,7 +237,21 @@ document.addEventListener("DOMContentLoaded", async () => { // HTML文書の読
   }
 });
 
+// ✅ 初期表示用の一括取得（ETag で再検証：変化がなければ 304 でキャッシュを使う）
+async function fetchBootstrap(date, sort = "member_code", order = "asc") {
+  const res = await fetch(
+    `/api/match_play/bootstrap?date=${encodeURIComponent(date)}&sort=${sort}&order=${order}${roomQuery()}`,
+    { cache: "no-cache" }
+  );
+  const data = await res.json();
+  window.defaultCardCount = data.card_count || 5;
+  if (data.strength_order_map) window.strengthOrderMap = data.strength_order_map;
+  if (data.handicap_list) window.handicapList = data.handicap_list;
+  return data;
+}
+
 async function fetchDefaultCardCount() {
+  if (window.defaultCardCount) return window.defaultCardCount;  // bootstrap 取得済みなら再取得しない
   const res = await fetch("/api/default_card_count");
   const data = await res.json();
   return data.count || 5;
@@ -225,9 +259,10 @@ async function fetchDefaultCardCount() {
 
 // ✅ 参加者一覧取得
 async function fetchTodayParticipants(date, sort = "member_code", order = "asc") {
-  const res = await fetch(`/api/participants?date=${date}&sort=${sort}&order=${order}`);
+  const res = await fetch(`/api/participants?date=${date}&sort=${sort}&order=${order}${roomQuery()}`);
   const data = await res.json();
   allParticipants = data;
+  window.participants = data;  // getParticipantDataById が古い一覧を見ないように
   return data;
 }
 
@@ -239,52 +274,244 @@ async function fetchHandicapRules() {
 
 // ✅ ブラウザリロード時に対局カード状態取得　/api/match_card_state/load を呼び、cards配列を受け取る
 async function fetchMatchCards(date) {
-  const res = await fetch(`/api/match_card_state/load?date=${date}`);
+  const res = await fetch(`/api/match_card_state/load?date=${date}${roomQuery()}`);
   const data = await res.json();
   console.log("🔍 fetchMatchCards():", data);
   return data.cards || [];
 }
 
 
-// ✅ 参加者一覧描画（tbody部分）
-function renderParticipantTable(participants) {
-  const tbody = document.getElementById("participant-list");
-  if (!tbody) return;
+// ===== ライブ更新（SSE）：他タブレットでの変更を差分で反映 =====
+// 自分が送った変更のエコーは clientId で見分けて無視する
+function newClientId() {
+  return (window.crypto && crypto.randomUUID) ? crypto.randomUUID()
+                                              : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+window.clientId = window.clientId || newClientId();
+
+// 保存系の fetch に付ける共通ヘッダー（送信元 clientId・この端末の会場付き）
+function liveHeaders() {
+  return {
+    "Content-Type": "application/json",
+    "X-Client-Id": window.clientId,
+    "X-Room": encodeURIComponent(window.room || ""),
+  };
+}
+
+// 取得系の URL に付ける会場パラメータ（会場が1つのクラブでは付けない）
+function roomQuery() {
+  return window.room ? `&room=${encodeURIComponent(window.room)}` : "";
+}
+
+let liveSource = null;
+let liveReloadTimer = null;
+
+function startLiveStream(date) {
+  if (!window.EventSource || liveSource) return;
+  // 切断時は EventSource が Last-Event-ID 付きで自動再接続する
+  // 購読はこの端末の会場だけ（他の会場のカード更新・受付は届かない）
+  liveSource = new EventSource(`/api/live/stream?date=${encodeURIComponent(date)}${roomQuery()}`);
+
+  const parse = (ev) => {
+    try { return JSON.parse(ev.data); } catch (_) { return null; }
+  };
+  const isMine = (msg) => !!(msg && msg.origin && msg.origin === window.clientId);
+
+  // 自分の変更のエコーは描画し直さず、版（version）の控えだけ更新する
+  liveSource.addEventListener("card", (ev) => {
+    const msg = parse(ev);
+    if (!msg) return;
+    if (isMine(msg)) return rememberCardState(msg.payload);
+    queueRemoteCardState(msg.payload);
+  });
+
+  liveSource.addEventListener("cards", (ev) => {
+    const msg = parse(ev);
+    if (!msg) return;
+    for (const card of (msg.payload?.cards || [])) {
+      if (isMine(msg)) rememberCardState(card);
+      else queueRemoteCardState(card);
+    }
+  });
+
+  // 他端末の結果保存はペア回数表にも加算
+  liveSource.addEventListener("result", (ev) => {
+    const msg = parse(ev);
+    const r = msg?.payload;
+    if (!r || isMine(msg)) return;
+    addTodayPairCount(r.player1_id, r.player2_id, r.match_type, r.match_id);
+  });
+
+  // 受付/取消・結果保存（昇段級で棋力が変わることがある）は参加者一覧を取り直す
+  ["participants", "result"].forEach(kind => {
+    liveSource.addEventListener(kind, (ev) => {
+      const msg = parse(ev);
+      if (!msg || isMine(msg)) return;
+      scheduleParticipantsReload();
+    });
+  });
+}
+
+// 他端末からのカード更新は1フレームにまとめて描画（同じカードは最後の版だけ）
+function queueRemoteCardState(card) {
+  if (!card || card.card_index === undefined || card.card_index === null) return;
+  scheduleDomWrite(`card-${card.card_index}`, () => applyRemoteCardState(card));
+}
+
+// 連続イベントでの再取得をまとめる
+function scheduleParticipantsReload() {
+  clearTimeout(liveReloadTimer);
+  liveReloadTimer = setTimeout(() => { reloadParticipants(); }, 200);
+}
+
+// 1枚分のカード状態を差し替え（他カードや参加者テーブルは作り直さない）
+async function applyRemoteCardState(card) {
+  if (!card || card.card_index === undefined || card.card_index === null) return;
+  const container = document.getElementById("cards-container");
+  if (!container) return;
+
+  // 他端末で受付したばかりの参加者が載っている場合は先に一覧を取り直す
+  const unknown = [card.p1_id, card.p2_id].some(pid => pid && !getParticipantDataById(pid));
+  if (unknown) {
+    await fetchTodayParticipants(window.today, window.sortKey || "member_code", window.sortOrder || "asc");
+  }
 
-  tbody.innerHTML = participants
-    .filter(p => !assignedParticipantIds.has(p.id))
-    .map(p => `
-      <tr draggable="true" ondragstart="drag(event)" id="participant-${p.id}">
+  const index = card.card_index;
+  const current = document.getElementById(`match-card-${index}`);
+  // 表示中と同じ版なら作り直さない（版 0 ＝未保存カードは常に反映）
+  if (current && card.version && Number(current.dataset.version || 0) >= Number(card.version)) return;
+
+  const fresh = createMatchCard(index, card);
+  if (current) {
+    current.replaceWith(fresh);
+  } else {
+    // card_index の順序を保って挿入
+    const next = Array.from(container.querySelectorAll(".match-card"))
+      .find(el => parseInt(el.id.replace("match-card-", ""), 10) > index);
+    container.insertBefore(fresh, next || null);
+  }
+  restoreMatchCardState(card);
+
+  // 割当済み参加者の除外状態を更新（データは変わらないので取り直さない）
+  refreshParticipantTable();
+}
+
+// ===== 描画の間引き =====
+// DOM への書き込みは requestAnimationFrame で1フレームにまとめる。
+// 同じ key の書き込みはそのフレーム内で最後の1回だけ実行（古いタブレットでのカクつき対策）
+const pendingDomWrites = new Map();
+let domWriteFrame = null;
+
+function scheduleDomWrite(key, fn) {
+  pendingDomWrites.set(key, fn);
+  if (domWriteFrame !== null) return;
+  domWriteFrame = requestAnimationFrame(() => {
+    domWriteFrame = null;
+    const writes = Array.from(pendingDomWrites.values());
+    pendingDomWrites.clear();
+    writes.forEach(write => write());
+  });
+}
+
+// ✅ 参加者の並べ替え（サーバーの _sort_participant_rows と同じ規則。手元のデータで並べ替える）
+function sortParticipantRows(rows, key, order) {
+  const codeKey = (v) => {
+    const str = String(v ?? "");
+    const isNum = /^\d+$/.test(str);
+    return [isNum ? 0 : 1, isNum ? Number(str) : 0, str];
+  };
+  let keyOf;
+  if (key === "member_code") keyOf = p => codeKey(p.member_code);
+  else if (key === "grade") keyOf = p => [typeof p.grade_order === "number" ? p.grade_order : -1];
+  else if (["name", "kana", "member_type"].includes(key)) keyOf = p => [p[key] || ""];
+  else keyOf = p => [String(p[key] ?? p.id)];
+
+  const dir = order === "desc" ? -1 : 1;
+  const cmp = (a, b) => (a < b ? -1 : a > b ? 1 : 0);
+  return rows
+    .map((p, i) => ({ p, k: keyOf(p), i }))
+    .sort((x, y) => {
+      for (let j = 0; j < x.k.length; j++) {
+        const c = cmp(x.k[j], y.k[j]);
+        if (c) return c * dir;
+      }
+      return x.i - y.i;  // 同順位は元の順（安定）
+    })
+    .map(x => x.p);
+}
+
+function participantRowHtml(p) {
+  return `
         <td>${p.member_code ?? ""}</td>
         <td><a href="/member/${p.id}/recent" target="_blank" class="person-link">${p.name}</a></td>
         <td>${p.kana}</td>
         <td>${p.grade}</td>
         <td>${p.member_type}</td>
-      </tr>
-    `).join("");
+      `;
+}
+
+// ✅ 参加者一覧描画（tbody部分）：行は id で使い回し、変わった行・順番だけ書き換える
+function renderParticipantTable(participants) {
+  scheduleDomWrite("participant-table", () => patchParticipantTable(participants || allParticipants));
+}
+
+function patchParticipantTable(participants) {
+  const tbody = document.getElementById("participant-list");
+  if (!tbody) return;
+
+  const rows = sortParticipantRows(
+    participants.filter(p => !assignedParticipantIds.has(p.id)),
+    window.sortKey || "member_code",
+    window.sortOrder || "asc"
+  );
+  const wanted = new Set(rows.map(p => `participant-${p.id}`));
+  const existing = new Map();
+  Array.from(tbody.children).forEach(tr => existing.set(tr.id, tr));
+
+  let cursor = tbody.firstElementChild;
+  const skipUnwanted = () => {
+    while (cursor && !wanted.has(cursor.id)) cursor = cursor.nextElementSibling;
+  };
+  skipUnwanted();
+
+  for (const p of rows) {
+    const rowId = `participant-${p.id}`;
+    const sig = [p.member_code ?? "", p.name, p.kana, p.grade, p.member_type].join("\u0001");
+    let tr = existing.get(rowId);
+    if (tr) {
+      existing.delete(rowId);
+      if (tr.dataset.sig !== sig) {
+        tr.innerHTML = participantRowHtml(p);
+        tr.dataset.sig = sig;
+      }
+      if (tr.style.display) tr.style.display = "";
+    } else {
+      tr = document.createElement("tr");
+      tr.id = rowId;
+      tr.setAttribute("draggable", "true");
+      tr.setAttribute("ondragstart", "drag(event)");
+      tr.innerHTML = participantRowHtml(p);
+      tr.dataset.sig = sig;
+    }
+
+    if (tr === cursor) {
+      cursor = cursor.nextElementSibling;
+      skipUnwanted();
+    } else {
+      tbody.insertBefore(tr, cursor);
+    }
+  }
+  // 一覧から外れた行（カードに載った・取消された）を消す
+  existing.forEach(tr => tr.remove());
 }
 
 // ✅ DBからロードしたカード状態をもとにHTMLを生成
-// match_type に応じてセレクト状態を復元し、info_htmlやoriginal_htmlも復元
+// match_type に応じてセレクト状態を復元し、駒落ち・先手などの項目から情報欄を描画
 function renderMatchCards(cards) {
   const container = document.getElementById("cards-container");
-  container.innerHTML = "";
-
-  if (!cards || cards.length === 0) {
-    // カード情報がない場合は default_card_count に従って空のカードを生成
-    fetchDefaultCardCount().then(defaultCount => {
-      const existingIndices = new Set((cards || []).map(c => c.card_index));
-      for (let i = 0; i < defaultCount; i++) {
-        if (!existingIndices.has(i)) {
-          const emptyCard = createMatchCard(i);
-          container.appendChild(emptyCard);
-        }
-      }
-    });
-    return;
-  }
+  cards = cards || [];
 
-  // カードが存在する場合、保存された状態で描画
+  // 割当済み参加者（参加者テーブルから除く）を作り直す
   assignedParticipantIds.clear(); // 初期化
 
   // 🔧 指導員は本日の参加者テーブルから消さないため、除外セットに入れない
@@ -295,196 +522,233 @@ function renderMatchCards(cards) {
       assignedParticipantIds.add(pid);
     }
   };
-
   cards.forEach(card => {
     addIfNonInstructor(card.p1_id);
     addIfNonInstructor(card.p2_id);
+  });
 
-    const index = card.card_index;
-    const cardElement = createMatchCard(index, card);
-    container.appendChild(cardElement);
-
-
-    // 要素取得（生成されたばかりの要素から取得）
-    const cardDiv = document.getElementById(`match-card-${index}`);
-    const infoDiv = document.getElementById(`match-info-${index}`);
-    const p1 = document.getElementById(`card${index}-player1`);
-    const p2 = document.getElementById(`card${index}-player2`);
-    const startBtn = document.getElementById(`start-button-${index}`);
-    const matchTypeSelect = document.getElementById(`match-type-${index}`);
-
-    if (cardDiv) cardDiv.dataset.status = card.status || "";
-    if (infoDiv) infoDiv.innerHTML = card.info_html || "";
-    if (matchTypeSelect) matchTypeSelect.value = card.match_type || "認定戦";
-    if (startBtn) startBtn.style.display = "none";  // 初期は隠す（後で可否を判定）
-
-    // ★ 対局中カードの色を復元（種別クラス付け直し）
-    if (cardDiv && card.status === "ongoing") {
-      // 既存タイプを全て外してから現在の種別を追加
-      ["認定戦","指導","フリー","初回認定"].forEach(c => cardDiv.classList.remove(c));
-      const mt = matchTypeSelect ? matchTypeSelect.value : (card.match_type || "認定戦");
-      if (mt) cardDiv.classList.add(mt);
-    }
+  // 保存済みカード＋既定枚数に足りない分の空カードを、番号順に並べる。
+  // 表示中のカードで版（version）が同じものは作り直さずそのまま使う
+  return fetchDefaultCardCount().then(defaultCount => {
+    const byIndex = new Map(cards.map(c => [c.card_index, c]));
+    const indices = new Set(byIndex.keys());
+    for (let i = 0; i < defaultCount; i++) indices.add(i);
 
-    if (p1) {
-      p1.dataset.participantId = card.p1_id || "";
-      p1.removeAttribute("data-original-html");   // ← もう使わない
-      if (card.p1_id) {
-        const p1data = getParticipantDataById(card.p1_id);
-        if (p1data) {
-          const nameLink = `<a href="/member/${p1data.id}/recent" target="_blank" class="person-link">${p1data.name}</a>`;
-          p1.innerHTML = `${nameLink}（${p1data.kana}）${p1data.grade}・${p1data.member_type}`;
-          p1.dataset.assigned = "true";
-        } else {
-          p1.innerHTML = "対局者1";
-          p1.dataset.assigned = "false";
-        }
+    const existing = new Map();
+    container.querySelectorAll(".match-card").forEach(el => {
+      existing.set(parseInt(el.id.replace("match-card-", ""), 10), el);
+    });
+
+    const restored = [];
+    let cursor = container.firstElementChild;
+    for (const index of Array.from(indices).sort((a, b) => a - b)) {
+      const card = byIndex.get(index) || null;
+      const version = String(card?.version ?? 0);
+      const el = existing.get(index);
+      existing.delete(index);
+
+      if (el && el.dataset.version === version) {
+        if (el === cursor) cursor = cursor.nextElementSibling;
+        else container.insertBefore(el, cursor);
+        continue;
       }
-    }
-    if (p2) {
-      p2.dataset.participantId = card.p2_id || "";
-      p2.removeAttribute("data-original-html");   // ← もう使わない
-      if (card.p2_id) {
-        const p2data = getParticipantDataById(card.p2_id);
-        if (p2data) {
-          const nameLink = `<a href="/member/${p2data.id}/recent" target="_blank" class="person-link">${p2data.name}</a>`;
-          p2.innerHTML = `${nameLink}（${p2data.kana}）${p2data.grade}・${p2data.member_type}`;
-          p2.dataset.assigned = "true";
-        } else {
-          p2.innerHTML = "対局者2";
-          p2.dataset.assigned = "false";
-        }
+      if (el) {
+        if (el === cursor) cursor = cursor.nextElementSibling;
+        el.remove();
       }
+      container.insertBefore(createMatchCard(index, card), cursor);
+      if (card) restored.push(card);
     }
+    existing.forEach(el => el.remove());
 
-    // 🔁 対局中のカードなら表示を復元
-    if (card.status === "ongoing" && p1 && p2) {
-      // 参加者情報を取得して名前等を抽出
-      const id1 = card.p1_id;
-      const id2 = card.p2_id;
-      const p1data = getParticipantDataById(id1);
-      const p2data = getParticipantDataById(id2);
-
-      // ✅ 復元時も「開始時点」の棋力が未保持なら今の表示値で保持（なければ何もしない）
-      const cardEl = document.getElementById(`match-card-${index}`);
-      if (cardEl) {
-        if (!cardEl.dataset.gradeAtTime1) cardEl.dataset.gradeAtTime1 = p1data?.grade || "";
-        if (!cardEl.dataset.gradeAtTime2) cardEl.dataset.gradeAtTime2 = p2data?.grade || "";
-      }      
-
-      // 🔑 復元時も対局種別と未認定者フラグで正しく分岐
-      const matchType = card.match_type || "認定戦";
-      const isInitialAssessment = matchType === "初回認定";
-      const isP1Unrated = p1data && p1data.grade === "未認定";
-      const isP2Unrated = p2data && p2data.grade === "未認定";
-
-      // 「◇（0.5勝）」を使うのは「初回認定戦」かつ「未認定者の相手側」だけ
-      const p1UseHalf = isInitialAssessment && !isP1Unrated && isP2Unrated;
-      const p2UseHalf = isInitialAssessment && !isP2Unrated && isP1Unrated;
-
-      // p1NameHtml
-      const p1NameHtml = `
-        <div><strong>
-          <a href="/member/${p1data.id}/recent" target="_blank" class="person-link">
-            ${p1data.name}
-          </a>
-          （${p1data.kana}）${p1data.grade}・${p1data.member_type}
-        </strong></div>
-        <select id="result1-${index}" onchange="autoFillResult(${index}, 1)">
-          <option value="">選択</option>
-          ${p1UseHalf
-            ? '<option value="◇">◇（0.5勝）</option>'
-            : '<option value="○">○（勝）</option>'}
-          ${p1UseHalf
-            ? '<option value="◆">◆（ノーカウント負）</option>'
-            : '<option value="●">●（負）</option>'}
-          <option value="△">△（分）</option>
-        </select>
-      `;
-      // p2NameHtml
-      const p2NameHtml = `
-        <div><strong>
-          <a href="/member/${p2data.id}/recent" target="_blank" class="person-link">
-            ${p2data.name}
-          </a>
-          （${p2data.kana}）${p2data.grade}・${p2data.member_type}
-        </strong></div>
-        <select id="result2-${index}" onchange="autoFillResult(${index}, 2)">
-          <option value="">選択</option>
-          ${p2UseHalf
-            ? '<option value="◇">◇（0.5勝）</option>'
-            : '<option value="○">○（勝）</option>'}
-          ${p2UseHalf
-            ? '<option value="◆">◆（ノーカウント負）</option>'
-            : '<option value="●">●（負）</option>'}
-          <option value="△">△（分）</option>
-        </select>
-      `;
+    // 要素が DOM に入ってから状態を復元
+    restored.forEach(card => restoreMatchCardState(card));
+  });
+}
 
-      p1.innerHTML = p1NameHtml;
-      p2.innerHTML = p2NameHtml;
+// ✅ 生成済みのカード要素に、保存された状態（対局者・情報・対局中表示・各ボタン）を復元
+function restoreMatchCardState(card) {
+  const index = card.card_index;
+  rememberCardState(card);
 
-      // 終了ボタンを復元
-      const resultAreaId = `end-button-area-${index}`;
-      if (!document.getElementById(resultAreaId)) {
-        const endBtnArea = document.createElement("div");
-        endBtnArea.id = resultAreaId;
-        endBtnArea.innerHTML = `<button onclick="endMatch(${index})">対局終了</button>`;
 
-        // ✅ ボタン共通エリアに追加
-        const btnContainer = document.getElementById(`button-area-${index}`);
-        if (btnContainer) {
-          btnContainer.appendChild(endBtnArea);
-        }
-      }
+  // 要素取得（生成されたばかりの要素から取得）
+  const cardDiv = document.getElementById(`match-card-${index}`);
+  const infoDiv = document.getElementById(`match-info-${index}`);
+  const p1 = document.getElementById(`card${index}-player1`);
+  const p2 = document.getElementById(`card${index}-player2`);
+  const startBtn = document.getElementById(`start-button-${index}`);
+  const matchTypeSelect = document.getElementById(`match-type-${index}`);
 
-      // 🔽 手合い解除ボタンも復元！
-      const cancelBtnId = `cancel-button-${index}`;
-      if (!document.getElementById(cancelBtnId)) {
-        const cancelBtnDiv = document.createElement("div");
-        cancelBtnDiv.id = cancelBtnId;
-        cancelBtnDiv.style = "margin-right: 0.5rem;";
-        cancelBtnDiv.innerHTML = `<button onclick="cancelMatch(${index})">手合い解除</button>`;
-
-        const btnContainer = document.getElementById(`button-area-${index}`);
-        if (btnContainer) {
-          btnContainer.insertBefore(cancelBtnDiv, btnContainer.firstChild); // 左に表示
-        }
-      }
+  if (cardDiv) {
+    cardDiv.dataset.status = card.status || "";
+    // 駒落ち・先手・開始時点の棋力・昇段級の見込み（情報欄はここから描画する）
+    cardDiv.dataset.handicap = card.handicap || "";
+    cardDiv.dataset.sente = card.sente || "";
+    cardDiv.dataset.nextGrade1 = card.p1_next_grade || "";
+    cardDiv.dataset.nextGrade2 = card.p2_next_grade || "";
+    if (card.p1_grade) cardDiv.dataset.gradeAtTime1 = card.p1_grade;
+    if (card.p2_grade) cardDiv.dataset.gradeAtTime2 = card.p2_grade;
+  }
+  if (infoDiv) infoDiv.innerHTML = "";
+  if (matchTypeSelect) matchTypeSelect.value = card.match_type || "認定戦";
+  if (startBtn) startBtn.style.display = "none";  // 初期は隠す（後で可否を判定）
+
+  // ★ 対局中カードの色を復元（種別クラス付け直し）
+  if (cardDiv && card.status === "ongoing") {
+    // 既存タイプを全て外してから現在の種別を追加
+    ["認定戦","指導","フリー","初回認定"].forEach(c => cardDiv.classList.remove(c));
+    const mt = matchTypeSelect ? matchTypeSelect.value : (card.match_type || "認定戦");
+    if (mt) cardDiv.classList.add(mt);
+  }
 
-      // 🔽 指導対局なら「昇段級」ボタンを復元
-      const buttonArea = document.getElementById(`button-area-${index}`);
-      if (matchType === "指導" && buttonArea && !document.getElementById(`promote-button-${index}`)) {
-        const promoteBtnDiv = document.createElement("div");
-        promoteBtnDiv.id = `promote-button-${index}`;
-        promoteBtnDiv.style = "margin-right: 0.5rem;";
-        promoteBtnDiv.innerHTML = `<button onclick="showShodanModal(${index})">昇段級</button>`;
-        buttonArea.insertBefore(promoteBtnDiv, buttonArea.firstChild);
+  if (p1) {
+    p1.dataset.participantId = card.p1_id || "";
+    p1.removeAttribute("data-original-html");   // ← もう使わない
+    if (card.p1_id) {
+      const p1data = getParticipantDataById(card.p1_id);
+      if (p1data) {
+        const nameLink = `<a href="/member/${p1data.id}/recent" target="_blank" class="person-link">${p1data.name}</a>`;
+        p1.innerHTML = `${nameLink}（${p1data.kana}）${p1data.grade}・${p1data.member_type}`;
+        p1.dataset.assigned = "true";
+      } else {
+        p1.innerHTML = "対局者1";
+        p1.dataset.assigned = "false";
       }
+    }
+  }
+  if (p2) {
+    p2.dataset.participantId = card.p2_id || "";
+    p2.removeAttribute("data-original-html");   // ← もう使わない
+    if (card.p2_id) {
+      const p2data = getParticipantDataById(card.p2_id);
+      if (p2data) {
+        const nameLink = `<a href="/member/${p2data.id}/recent" target="_blank" class="person-link">${p2data.name}</a>`;
+        p2.innerHTML = `${nameLink}（${p2data.kana}）${p2data.grade}・${p2data.member_type}`;
+        p2.dataset.assigned = "true";
+      } else {
+        p2.innerHTML = "対局者2";
+        p2.dataset.assigned = "false";
+      }
+    }
+  }
 
-      // 🔽 初回認定戦なら「棋力認定」ボタンを復元
-      if (matchType === "初回認定" && buttonArea && !document.getElementById(`shodan-button-${index}`)) {
-        const shodanBtnDiv = document.createElement("div");
-        shodanBtnDiv.id = `shodan-button-${index}`;
-        shodanBtnDiv.style = "margin-right: 0.5rem;";
-        shodanBtnDiv.innerHTML = `<button onclick="showShodanModal(${index})">棋力認定</button>`;
-        buttonArea.insertBefore(shodanBtnDiv, buttonArea.firstChild);
+  // 🔁 対局中のカードなら表示を復元
+  if (card.status === "ongoing" && p1 && p2) {
+    // 参加者情報を取得して名前等を抽出
+    const id1 = card.p1_id;
+    const id2 = card.p2_id;
+    const p1data = getParticipantDataById(id1);
+    const p2data = getParticipantDataById(id2);
+
+    // ✅ 復元時も「開始時点」の棋力が未保持なら今の表示値で保持（なければ何もしない）
+    const cardEl = document.getElementById(`match-card-${index}`);
+    if (cardEl) {
+      if (!cardEl.dataset.gradeAtTime1) cardEl.dataset.gradeAtTime1 = p1data?.grade || "";
+      if (!cardEl.dataset.gradeAtTime2) cardEl.dataset.gradeAtTime2 = p2data?.grade || "";
+    }      
+
+    // 🔑 復元時も対局種別と未認定者フラグで正しく分岐
+    const matchType = card.match_type || "認定戦";
+    const isInitialAssessment = matchType === "初回認定";
+    const isP1Unrated = p1data && p1data.grade === "未認定";
+    const isP2Unrated = p2data && p2data.grade === "未認定";
+
+    // 「◇（0.5勝）」を使うのは「初回認定戦」かつ「未認定者の相手側」だけ
+    const p1UseHalf = isInitialAssessment && !isP1Unrated && isP2Unrated;
+    const p2UseHalf = isInitialAssessment && !isP2Unrated && isP1Unrated;
+
+    // p1NameHtml
+    const p1NameHtml = `
+      <div><strong>
+        <a href="/member/${p1data.id}/recent" target="_blank" class="person-link">
+          ${p1data.name}
+        </a>
+        （${p1data.kana}）${p1data.grade}・${p1data.member_type}
+      </strong></div>
+      <select id="result1-${index}" onchange="autoFillResult(${index}, 1)">
+        <option value="">選択</option>
+        ${p1UseHalf
+          ? '<option value="◇">◇（0.5勝）</option>'
+          : '<option value="○">○（勝）</option>'}
+        ${p1UseHalf
+          ? '<option value="◆">◆（ノーカウント負）</option>'
+          : '<option value="●">●（負）</option>'}
+        <option value="△">△（分）</option>
+      </select>
+    `;
+    // p2NameHtml
+    const p2NameHtml = `
+      <div><strong>
+        <a href="/member/${p2data.id}/recent" target="_blank" class="person-link">
+          ${p2data.name}
+        </a>
+        （${p2data.kana}）${p2data.grade}・${p2data.member_type}
+      </strong></div>
+      <select id="result2-${index}" onchange="autoFillResult(${index}, 2)">
+        <option value="">選択</option>
+        ${p2UseHalf
+          ? '<option value="◇">◇（0.5勝）</option>'
+          : '<option value="○">○（勝）</option>'}
+        ${p2UseHalf
+          ? '<option value="◆">◆（ノーカウント負）</option>'
+          : '<option value="●">●（負）</option>'}
+        <option value="△">△（分）</option>
+      </select>
+    `;
+
+    p1.innerHTML = p1NameHtml;
+    p2.innerHTML = p2NameHtml;
+
+    // 終了ボタンを復元
+    const resultAreaId = `end-button-area-${index}`;
+    if (!document.getElementById(resultAreaId)) {
+      const endBtnArea = document.createElement("div");
+      endBtnArea.id = resultAreaId;
+      endBtnArea.innerHTML = `<button onclick="endMatch(${index})">対局終了</button>`;
+
+      // ✅ ボタン共通エリアに追加
+      const btnContainer = document.getElementById(`button-area-${index}`);
+      if (btnContainer) {
+        btnContainer.appendChild(endBtnArea);
       }
     }
-    updateStartButtonVisibility(index);
-  });
 
-  // ★追加：保存枚数が既定枚数より少ないときは不足分を空カードで補充
-  fetchDefaultCardCount().then(defaultCount => {
-    const existingIndices = new Set(cards.map(c => c.card_index));
-    for (let i = 0; i < defaultCount; i++) {
-      if (!existingIndices.has(i)) {
-        const emptyCard = createMatchCard(i);
-        container.appendChild(emptyCard);
+    // 🔽 手合い解除ボタンも復元！
+    const cancelBtnId = `cancel-button-${index}`;
+    if (!document.getElementById(cancelBtnId)) {
+      const cancelBtnDiv = document.createElement("div");
+      cancelBtnDiv.id = cancelBtnId;
+      cancelBtnDiv.style = "margin-right: 0.5rem;";
+      cancelBtnDiv.innerHTML = `<button onclick="cancelMatch(${index})">手合い解除</button>`;
+
+      const btnContainer = document.getElementById(`button-area-${index}`);
+      if (btnContainer) {
+        btnContainer.insertBefore(cancelBtnDiv, btnContainer.firstChild); // 左に表示
       }
     }
-  });
 
+    // 🔽 指導対局なら「昇段級」ボタンを復元
+    const buttonArea = document.getElementById(`button-area-${index}`);
+    if (matchType === "指導" && buttonArea && !document.getElementById(`promote-button-${index}`)) {
+      const promoteBtnDiv = document.createElement("div");
+      promoteBtnDiv.id = `promote-button-${index}`;
+      promoteBtnDiv.style = "margin-right: 0.5rem;";
+      promoteBtnDiv.innerHTML = `<button onclick="showShodanModal(${index})">昇段級</button>`;
+      buttonArea.insertBefore(promoteBtnDiv, buttonArea.firstChild);
+    }
+
+    // 🔽 初回認定戦なら「棋力認定」ボタンを復元
+    if (matchType === "初回認定" && buttonArea && !document.getElementById(`shodan-button-${index}`)) {
+      const shodanBtnDiv = document.createElement("div");
+      shodanBtnDiv.id = `shodan-button-${index}`;
+      shodanBtnDiv.style = "margin-right: 0.5rem;";
+      shodanBtnDiv.innerHTML = `<button onclick="showShodanModal(${index})">棋力認定</button>`;
+      buttonArea.insertBefore(shodanBtnDiv, buttonArea.firstChild);
+    }
+  }
+  renderMatchInfo(index);
+  updateStartButtonVisibility(index);
 }
 
 // ✅ 新規カードの初期HTML構造を生成
@@ -494,6 +758,7 @@ function createMatchCard(index, card = null) {
   div.id = `match-card-${index}`;
   div.style = "border: 1px solid #ccc; padding: 1rem; margin-bottom: 1rem; background-color: #f9f9f9;";
   div.dataset.status = card?.status || "pending";
+  div.dataset.version = String(card?.version ?? 0);
 
   if (div.dataset.status === "ongoing") {
     div.classList.add("in-progress");
@@ -528,9 +793,7 @@ function createMatchCard(index, card = null) {
     </div>
   </div>
 
-    <div id="match-info-${index}" style="margin-top: 0.5rem; color: #333;">
-      ${card?.info_html || ""}
-    </div>
+    <div id="match-info-${index}" style="margin-top: 0.5rem; color: #333;"></div>
 
   <div style="margin-top: 0.5rem; display: flex; justify-content: flex-end;" id="button-area-${index}">
     <div id="start-button-${index}" style="display: none;">
@@ -550,6 +813,34 @@ function createMatchCard(index, card = null) {
   return div;
 }
 
+// 🔒 着席の確保（サーバーの一意制約で、2台が同じ人を別のカードに座らせるのを防ぐ）
+// 戻り値: { ok, message?, claim? }。通信できないときは手元の判定だけで続行する
+async function claimSeat(cardIndex, participantId) {
+  const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
+  try {
+    const res = await fetch("/api/seat/claim", {
+      method: "POST",
+      headers: liveHeaders(),
+      body: JSON.stringify({ date: today, card_index: cardIndex, participant_id: participantId })
+    });
+    const data = await res.json().catch(() => ({}));
+    if (res.status === 409) return { ok: false, message: data.message, claim: data.claim };
+    return { ok: true, claim: data.claim };
+  } catch (e) {
+    console.warn("claimSeat failed (offline?)", e);
+    return { ok: true };
+  }
+}
+
+function releaseSeat(cardIndex, participantId) {
+  const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
+  fetch("/api/seat/release", {
+    method: "POST",
+    headers: liveHeaders(),
+    body: JSON.stringify({ date: today, card_index: cardIndex, participant_id: participantId })
+  }).catch(e => console.warn("releaseSeat failed", e));
+}
+
 // 🔹 ドロップ可能にする
 function allowDrop(ev) {
   ev.preventDefault();
@@ -586,6 +877,17 @@ async function drop(ev, slot, cardIndex) {
     return;
   }
 
+  // 🔒 先にサーバーで着席を確保（他の端末が先に座らせていたら、勝ったカードを案内して中止）
+  const claim = await claimSeat(cardIndex, id);
+  if (!claim.ok) {
+    alert(claim.message || "この参加者は別のカードに着席しています。");
+    if (claim.claim && (claim.claim.room || "") === (window.room || "")) {
+      scrollAndFlash(document.getElementById(`match-card-${claim.claim.card_index}`));
+    }
+    await reloadParticipants();
+    return;
+  }
+
   // DOM優先（テーブルの表示＝最新状態）
   const memberCode = (tds[0].innerText || "").trim();
   const name       = (tds[1].innerText || "").trim();
@@ -665,6 +967,9 @@ async function removeParticipant(slot, cardIndex, draggedId) {
     draggedElement.style.display = "";
   }
 
+  // 着席の確保を外す（カードを保存していなくても他の端末で座らせられるように）
+  if (participantId) releaseSeat(cardIndex, participantId);
+
   // スロット初期化
   slotElement.innerHTML = slot === "player1" ? "対局者1" : "対局者2";
   slotElement.dataset.assigned = "false";
@@ -675,6 +980,7 @@ async function removeParticipant(slot, cardIndex, draggedId) {
   // 対局情報も初期化
   const info = document.getElementById(`match-info-${cardIndex}`);
   if (info) info.innerHTML = "";
+  clearMatchInfoState(document.getElementById(`match-card-${cardIndex}`));
 
   const startBtn = document.getElementById(`start-button-${cardIndex}`);
   if (startBtn) startBtn.style.display = "none";
@@ -691,6 +997,93 @@ function calcHandicap(order1, order2, matchType) {
   return rule ? rule.handicap : "平手";
 }
 
+// window.strengthOrderMap を優先し、なければ participant.grade_order を使う
+function toStrengthOrder(p) {
+  if (!p) return 999;
+  if (window.strengthOrderMap && p.grade in window.strengthOrderMap) {
+    return window.strengthOrderMap[p.grade];
+  }
+  return (typeof p.grade_order === "number") ? p.grade_order : 999;
+}
+
+// 先手：駒落ちは上手（強い側）、「下位先手」は下位。平手・指導・認定は決めない
+// 棋力順は「弱い → 強い」の昇順（order が大きいほど強い）
+function calcSente(handicap, order1, order2) {
+  if (!handicap || order1 === order2) return "";
+  const p1Stronger = order1 > order2;
+  if (handicap.includes("下位先手")) return p1Stronger ? "p2" : "p1";
+  if (handicap.includes("落ち")) return p1Stronger ? "p1" : "p2";
+  return "";
+}
+
+function clearMatchInfoState(cardEl) {
+  if (!cardEl) return;
+  delete cardEl.dataset.handicap;
+  delete cardEl.dataset.sente;
+  delete cardEl.dataset.nextGrade1;
+  delete cardEl.dataset.nextGrade2;
+}
+
+// 🧩 カードの項目（駒落ち・先手・昇段級の見込み）から情報欄を描画
+function renderMatchInfo(index) {
+  const cardEl = document.getElementById(`match-card-${index}`);
+  const info = document.getElementById(`match-info-${index}`);
+  if (!cardEl || !info) return;
+
+  const id1 = document.getElementById(`card${index}-player1`)?.dataset.participantId;
+  const id2 = document.getElementById(`card${index}-player2`)?.dataset.participantId;
+  const handicap = cardEl.dataset.handicap || "";
+  if (!handicap || !id1 || !id2) {
+    info.innerHTML = "";
+    return;
+  }
+  const p1data = getParticipantDataById(id1);
+  const p2data = getParticipantDataById(id2);
+  const matchType = getMatchTypeValue(index);
+
+  // 🔽 駒落ちセレクト：初回認定戦のみ固定、それ以外は変更可
+  let html;
+  if (matchType === "初回認定") {
+    html = `駒落ち：<strong>${handicap}</strong><input type="hidden" id="handicap-select-${index}" value="${handicap}">`;
+  } else {
+    const options = [...new Set(handicapRules.map(r => r.handicap))];
+    // 🔸 指導対局の場合、「指導」を先頭に追加
+    if (matchType === "指導" && !options.includes("指導")) options.unshift("指導");
+    if (!options.includes(handicap)) options.unshift(handicap);
+    html = `駒落ち：
+      <select id="handicap-select-${index}" onchange="onHandicapChange(${index})">
+        ${options.map(opt => `<option value="${opt}" ${opt === handicap ? "selected" : ""}>${opt}</option>`).join("")}
+      </select>`;
+  }
+
+  const sente = cardEl.dataset.sente === "p1" ? p1data : cardEl.dataset.sente === "p2" ? p2data : null;
+  if (sente) {
+    html += `<span style="margin-left: 0.75rem;">先手：${sente.name}</span>`;
+  }
+
+  [[p1data, cardEl.dataset.nextGrade1], [p2data, cardEl.dataset.nextGrade2]].forEach(([p, nextGrade]) => {
+    if (p && nextGrade) {
+      html += `<div style="color: red; margin-top: 0.3rem;">${p.name} さんはこの対局に勝てば ${nextGrade} に昇段（級）します</div>`;
+    }
+  });
+  info.innerHTML = html;
+}
+
+// 駒落ちを手で変えたら先手も付け直して保存
+function onHandicapChange(index) {
+  const cardEl = document.getElementById(`match-card-${index}`);
+  const select = document.getElementById(`handicap-select-${index}`);
+  if (!cardEl || !select) return;
+  const id1 = document.getElementById(`card${index}-player1`)?.dataset.participantId;
+  const id2 = document.getElementById(`card${index}-player2`)?.dataset.participantId;
+  const order1 = toStrengthOrder(getParticipantDataById(id1));
+  const order2 = toStrengthOrder(getParticipantDataById(id2));
+  cardEl.dataset.handicap = select.value;
+  cardEl.dataset.sente = calcSente(select.value, order1, order2);
+  renderMatchInfo(index);
+  saveMatchCardState(index);
+}
+
 // 両者揃ったときの駒落ち計算・勝てば昇段級メッセージの表示
 // カード種別による駒落ち固定や◇（0.5勝）表示の条件もここ
 async function showMatchInfo(cardIndex) { 
@@ -712,6 +1105,8 @@ async function showMatchInfo(cardIndex) {
   // 🔄 infoブロックを初期化（以前の駒落ち/ボタンを消す）
   info.innerHTML = "";
   startBtn.style.display = "none";
+  const cardEl = document.getElementById(`match-card-${cardIndex}`);
+  clearMatchInfoState(cardEl);
 
   // 対局者2名が揃っていなければ処理終了
   if (!id1 || !id2) return;
@@ -719,7 +1114,6 @@ async function showMatchInfo(cardIndex) {
   const participant1 = getParticipantDataById(id1);
   const participant2 = getParticipantDataById(id2);
 
-  const cardEl = document.getElementById(`match-card-${cardIndex}`);
   if (cardEl) {
     if (!cardEl.dataset.gradeAtTime1 && participant1) {
       cardEl.dataset.gradeAtTime1 = participant1.grade || "";
@@ -754,46 +1148,17 @@ async function showMatchInfo(cardIndex) {
     return;
   }
 
-  // window.strengthOrderMap を優先し、なければ participant.grade_order を使う
-  const toOrder = (p) => {
-    if (!p) return 999;
-    if (window.strengthOrderMap && p.grade in window.strengthOrderMap) {
-      return window.strengthOrderMap[p.grade];
-    }
-    return (typeof p.grade_order === "number") ? p.grade_order : 999;
-  };
-
-  const order1 = toOrder(participant1);
-  const order2 = toOrder(participant2);
+  const order1 = toStrengthOrder(participant1);
+  const order2 = toStrengthOrder(participant2);
   let handicap = calcHandicap(order1, order2, matchType);
+  if (matchType === "指導") handicap = "指導";
 
-  // 🔽 駒落ちセレクト：初回認定戦のみ固定、それ以外は変更可
-  let handicapHtml = "";
-  let options = [...new Set(handicapRules.map(r => r.handicap))];
-
-  // 🔸 指導対局の場合、「指導」を先頭に追加
-  if (matchType === "指導") {
-    if (!options.includes("指導")) {
-      options.unshift("指導");
-    }
-    handicap = "指導";
-  }
-
-  const handicapSelect = `
-    <select id="handicap-select-${cardIndex}">
-      ${options.map(opt => `
-        <option value="${opt}" ${opt === handicap ? "selected" : ""}>${opt}</option>
-      `).join("")}
-    </select>
-  `;
-
-  if (matchType === "初回認定") {
-    handicapHtml = `駒落ち：<strong>${handicap}</strong><input type="hidden" id="handicap-select-${cardIndex}" value="${handicap}">`;
-  } else {
-    handicapHtml = `駒落ち：${handicapSelect}`;
+  // 🔽 駒落ち・先手はカードの項目として持ち、情報欄はそこから描画
+  if (cardEl) {
+    cardEl.dataset.handicap = handicap;
+    cardEl.dataset.sente = calcSente(handicap, order1, order2);
   }
-
-  info.innerHTML = handicapHtml;
+  renderMatchInfo(cardIndex);
   startBtn.style.display = "block";
 
   // 🔽 勝てば昇段級の表示チェック（player1とplayer2両方）
@@ -809,7 +1174,7 @@ async function showMatchInfo(cardIndex) {
 
     const checkRes = await fetch("/check_promotion", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: liveHeaders(),
       body: JSON.stringify({
         player_id: p.id,
         next_win_half: nextWinIsHalf
@@ -817,10 +1182,9 @@ async function showMatchInfo(cardIndex) {
     });
 
     const result = await checkRes.json();
-    if (result?.success && result.promote) {
-      const nextGrade = result.next_grade || "次段級";
-      const msg = `${p.name} さんはこの対局に勝てば ${nextGrade} に昇段（級）します`;
-      info.innerHTML += `<div style="color: red; margin-top: 0.3rem;">${msg}</div>`;
+    if (result?.success && result.promote && cardEl) {
+      cardEl.dataset[`nextGrade${i + 1}`] = result.next_grade || "次段級";
+      renderMatchInfo(cardIndex);
     }
   });
 
@@ -1055,6 +1419,9 @@ async function resetMatchCard(index) {
 
   // ステータス戻す＋ハイライト解除（★ ここで最初の card をそのまま使う）
   card.dataset.status = "pending";
+  clearMatchInfoState(card);
+  delete card.dataset.gradeAtTime1;
+  delete card.dataset.gradeAtTime2;
   // 対局中・種別クラスをすべて外す
   card.classList.remove("in-progress");
   ["認定戦","指導","フリー","初回認定"].forEach(c => card.classList.remove(c));
@@ -1071,9 +1438,9 @@ async function resetMatchCard(index) {
     onMatchTypeChange(matchTypeSelect, index);
     fetch("/api/update_match_type", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: liveHeaders(),
       body: JSON.stringify({ index: index, match_type: "認定戦" })
-    });
+    }).then(r => r.json()).then(d => rememberCardState(d?.card)).catch(() => {});
   }
   await reloadParticipants();
 }
@@ -1151,76 +1518,107 @@ function autoFillResult(index, changedSide) {
 }
 
 
-// 🔽 対局カードの状態をMatchCardStateに保存する
-async function saveMatchCardState(index) {
-  const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
+// 🔢 サーバー上のカード状態（version 付き）の控え：差分保存と競合検出に使う
+const cardSnapshots = {};
+
+function rememberCardState(card) {
+  if (!card || card.card_index === undefined || card.card_index === null) return;
+  const prev = cardSnapshots[card.card_index];
+  // 遅れて届いた古い版で上書きしない
+  if (prev && (prev.version || 0) > (card.version || 0)) return;
+  cardSnapshots[card.card_index] = { ...card };
+  const el = document.getElementById(`match-card-${card.card_index}`);
+  if (el) el.dataset.version = String(card.version ?? 0);
+}
+
+// 画面上のカードから保存対象フィールドを集める
+function collectCardFields(index) {
+  const cardEl = document.getElementById(`match-card-${index}`);
+  if (!cardEl) return null;
   const p1 = document.getElementById(`card${index}-player1`);
   const p2 = document.getElementById(`card${index}-player2`);
-  const info = document.getElementById(`match-info-${index}`);
-  const matchType = document.getElementById(`match-type-${index}`).value;
-  const status = document.getElementById(`match-card-${index}`).dataset.status || "";
-
-  const payload = {
-    date: today,
-    cards: [  // ← 必ず cards: [] の中に入れること！
-      {
-        index: index,  // ← Flask側と一致させる
-        match_type: matchType,
-        p1_id: p1?.dataset.participantId || "",
-        p2_id: p2?.dataset.participantId || "",
-        status: status,
-        info_html: info?.innerHTML || "",
-        original_html1: p1?.dataset.originalHtml || "",
-        original_html2: p2?.dataset.originalHtml || ""
-      }
-    ]
+  const handicapEl = document.getElementById(`handicap-select-${index}`);
+  const matchType = document.getElementById(`match-type-${index}`)?.value || "認定戦";
+  const bothSeated = !!(p1?.dataset.participantId && p2?.dataset.participantId);
+  return {
+    match_type: matchType,
+    p1_id: p1?.dataset.participantId || "",
+    p2_id: p2?.dataset.participantId || "",
+    status: cardEl.dataset.status || "",
+    handicap: bothSeated ? (handicapEl?.value || cardEl.dataset.handicap || "") : "",
+    sente: bothSeated ? (cardEl.dataset.sente || "") : "",
+    p1_grade: cardEl.dataset.gradeAtTime1 || "",
+    p2_grade: cardEl.dataset.gradeAtTime2 || "",
+    p1_next_grade: cardEl.dataset.nextGrade1 || "",
+    p2_next_grade: cardEl.dataset.nextGrade2 || ""
   };
+}
 
-  await fetch("/api/match_card_state/save", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(payload)
-  });
+// 控えと比べて変わったフィールドだけを送る（変更なしなら null）
+function buildCardDelta(index) {
+  const fields = collectCardFields(index);
+  if (!fields) return null;
+  const snap = cardSnapshots[index];
+  const delta = { index, expected_version: snap ? (snap.version || 0) : 0 };
+  let changed = false;
+  for (const [key, value] of Object.entries(fields)) {
+    if (!snap || (snap[key] ?? "") !== value) {
+      delta[key] = value;
+      changed = true;
+    }
+  }
+  return changed ? delta : null;
 }
 
-// 🔽 全ての対局カードの状態をMatchCardStateに保存する
-async function saveAllMatchCardStates() {
+// 差分をまとめて保存。409（他端末が先に更新）の場合はサーバーの最新状態を表示し直す
+async function postCardDeltas(deltas) {
+  if (!deltas.length) return true;
   const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
-  const cards = [];
-
-  const allCards = document.querySelectorAll(".match-card");
-  allCards.forEach(card => {
-    const index = parseInt(card.id.replace("match-card-", ""));
-    const p1 = document.getElementById(`card${index}-player1`);
-    const p2 = document.getElementById(`card${index}-player2`);
-    const info = document.getElementById(`match-info-${index}`);
-    const matchType = document.getElementById(`match-type-${index}`).value;
-    const status = card.dataset.status || "";
-
-    cards.push({
-      index,
-      match_type: matchType,
-      p1_id: p1?.dataset.participantId || "",
-      p2_id: p2?.dataset.participantId || "",
-      status,
-      info_html: info?.innerHTML || "",
-      original_html1: p1?.dataset.originalHtml || "",
-      original_html2: p2?.dataset.originalHtml || ""
-    });
-  });
 
-  await fetch("/api/match_card_state/save", {
+  const res = await fetch("/api/match_card_state/save", {
     method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({ date: today, cards })
+    headers: liveHeaders(),
+    body: JSON.stringify({ date: today, cards: deltas })  // ← 必ず cards: [] の中に入れること！
+  });
+  const data = await res.json().catch(() => ({}));
+
+  if (res.status === 409) {
+    for (const card of (data.cards || [])) {
+      cardSnapshots[card.card_index] = { ...card };
+      await applyRemoteCardState(card);
+    }
+    alert((data.message || "他の端末でカードが更新されています") + "。最新の状態を表示しました。");
+    return false;
+  }
+  (data.cards || []).forEach(rememberCardState);
+  return res.ok;
+}
+
+// 🔽 対局カードの状態をMatchCardStateに保存する（変更分のみ）
+async function saveMatchCardState(index) {
+  const delta = buildCardDelta(index);
+  return postCardDeltas(delta ? [delta] : []);
+}
+
+// 🔽 全ての対局カードの状態をMatchCardStateに保存する（変更のあったカードのみ・1リクエスト）
+async function saveAllMatchCardStates() {
+  const deltas = [];
+  document.querySelectorAll(".match-card").forEach(card => {
+    const index = parseInt(card.id.replace("match-card-", ""), 10);
+    const delta = buildCardDelta(index);
+    if (delta) deltas.push(delta);
   });
+  return postCardDeltas(deltas);
 }
 
 async function deleteMatchCardFromDB(index) {
   const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
-  await fetch(`/api/match_card_state/delete?date=${today}&index=${index}`, {
+  const res = await fetch(`/api/match_card_state/delete?date=${today}&index=${index}`, {
     method: "DELETE",
+    headers: liveHeaders(),
   });
+  const data = await res.json().catch(() => ({}));
+  rememberCardState(data.card);
 }
 
 // 🔽 手合い解除処理
@@ -1230,7 +1628,8 @@ async function cancelMatch(index) {
 
   // サーバーにDELETEリクエスト（p1/p2などを初期化）
   const res = await fetch(`/api/match_card_state/delete?date=${today}&index=${index}`, {
-    method: "DELETE"
+    method: "DELETE",
+    headers: liveHeaders()
   });
 
   const data = await res.json();
@@ -1238,6 +1637,7 @@ async function cancelMatch(index) {
     alert("手合い解除に失敗しました：" + data.message);
     return;
   }
+  rememberCardState(data.card);
 
   // 対局カードの状態を画面上でリセット
   const p1 = document.getElementById(`card${index}-player1`);
@@ -1298,9 +1698,9 @@ async function cancelMatch(index) {
     // best-effortでサーバ側にも反映（該当行が削除済みでもOK）
     fetch("/api/update_match_type", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: liveHeaders(),
       body: JSON.stringify({ index: index, match_type: "認定戦" })
-    });
+    }).then(r => r.json()).then(d => rememberCardState(d?.card)).catch(() => {});
   }
 
   // 参加者リストを再表示（重複排除のため）
@@ -1320,6 +1720,48 @@ function addMatchCard() {
   saveMatchCardState(newIndex);
 }
 
+// ⚡ 空きカードをサーバーの自動組み合わせでまとめて埋める
+async function autoPairCards() {
+  const freeIndices = Array.from(document.querySelectorAll(".match-card"))
+    .filter(el => el.dataset.status !== "ongoing")
+    .map(el => parseInt(el.id.replace("match-card-", ""), 10))
+    .filter(i => {
+      const p1 = document.getElementById(`card${i}-player1`);
+      const p2 = document.getElementById(`card${i}-player2`);
+      return p1?.dataset.assigned !== "true" && p2?.dataset.assigned !== "true";
+    });
+  if (freeIndices.length === 0) {
+    alert("空いている対局カードがありません。");
+    return;
+  }
+
+  try {
+    const res = await fetch("/api/pairing/auto", {
+      method: "POST",
+      headers: liveHeaders(),
+      body: JSON.stringify({ date: window.today, card_indices: freeIndices })
+    });
+    const data = await res.json();
+    if (!res.ok || !data.success) {
+      // 他端末と競合したときはサーバーの最新状態に合わせる
+      for (const card of (data.cards || [])) await applyRemoteCardState(card);
+      alert(data.message || "自動組み合わせに失敗しました。");
+      return;
+    }
+    if (!data.pairs.length) {
+      alert("組める参加者がいません（未認定・指導員は手で組んでください）。");
+      return;
+    }
+    for (const card of data.cards) {
+      await applyRemoteCardState(card);
+      await showMatchInfo(card.card_index);
+    }
+  } catch (e) {
+    console.error("自動組み合わせエラー:", e);
+    alert("自動組み合わせに失敗しました。");
+  }
+}
+
 function deleteCard(index) {
   const card = document.getElementById(`match-card-${index}`);
   if (card) {
@@ -1357,29 +1799,181 @@ function showShidoModal(index, payload) {
   };
 }
 
-// 🔽 分離した保存処理
+// 🔽 分離した保存処理（送信待ちキュー経由。通信断でも端末に保持して後で送る）
 async function actuallySaveMatch(index, payload) { // 対局結果を保存する処理
-  const res = await fetch("/save_match_result", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify(payload)
-  });
+  // サーバーはカードにまだこの2人が座っている（またはこの版のままの）ときだけカードを初期化する
+  const cardVersion = cardSnapshots[index] ? (cardSnapshots[index].version || 0) : null;
+  const clientId = enqueueResultItem({ kind: "result", ...payload, card_version: cardVersion });
+  // フリー対局は記録しないので、カードの初期化だけを別の項目で送る
+  if (payload.match_type === "フリー") {
+    enqueueResultItem({
+      kind: "card_reset", card_index: index,
+      player1_id: payload.player1_id, player2_id: payload.player2_id, card_version: cardVersion
+    });
+  }
+  const results = await flushResultQueue();
+  const mine = (results || []).find(r => r.client_id === clientId);
 
-  const data = await res.json(); // サーバーからのレスポンスを取得
-  if (data.success) {
-    alert(data.message || "対局結果を記録しました。");
+  if (mine && mine.status === "error") {
+    alert("保存に失敗しました：" + (mine.message || ""));
+  } else {
+    if (!mine) {
+      alert("通信できないため対局結果を端末に保存しました。接続が戻り次第、自動で送信します。");
+    } else if (mine.status === "duplicate") {
+      alert("この対局結果はすでに記録されています。");
+    } else {
+      alert("対局結果を記録しました。");
+    }
+    if (!mine || mine.status === "applied") {
+      addTodayPairCount(payload.player1_id, payload.player2_id, payload.match_type, mine?.match_id);
+    }
     removeParticipant("player1", index, `participant-${payload.player1_id}`);
     removeParticipant("player2", index, `participant-${payload.player2_id}`);
     resetMatchCard(index);
-    await reloadParticipants();   // ★ ここを追加：保存後は必ず最新参加者を再取得
-  } else {
-    alert("保存に失敗しました：" + data.message);
+    try {
+      await reloadParticipants();   // ★ ここを追加：保存後は必ず最新参加者を再取得
+    } catch (e) {
+      console.warn("参加者の再取得に失敗（オフライン）:", e);
+    }
   }
   const cancelBtn = document.getElementById(`cancel-button-${index}`);
   if (cancelBtn) cancelBtn.remove();
-  await deleteMatchCardFromDB(index);
+  if (mine) {
+    await deleteMatchCardFromDB(index);
+  }
+  // 🪑 空いたカードに待ち行列の次の組み合わせを入れる
+  if (mine && mine.status === "applied") {
+    await offerNextPair(index);
+  }
+}
+
+// ===== 対局待ちキュー =====
+// サーバー側の行列（対局数が少ない → 長く待っている順）から次の組み合わせを受け取る。
+// 「結果保存後に次の対局を自動で入れる」がオンなら確認なしで着席させる。
+const AUTO_SEAT_KEY = "taikyoku.autoSeat";
+
+function isAutoSeatEnabled() {
+  return localStorage.getItem(AUTO_SEAT_KEY) === "1";
+}
+
+async function offerNextPair(cardIndex) {
+  try {
+    let body = { date: window.today, card_index: cardIndex };
+    if (!isAutoSeatEnabled()) {
+      const res = await fetch(`/api/waiting_queue?date=${encodeURIComponent(window.today)}${roomQuery()}`);
+      const data = await res.json();
+      const next = data?.next;
+      if (!next) return;
+      const a = getParticipantDataById(next.p1_id);
+      const b = getParticipantDataById(next.p2_id);
+      const label = `${a?.name || next.p1_id}（${a?.grade || ""}） 対 ${b?.name || next.p2_id}（${b?.grade || ""}）・${next.handicap}`;
+      if (!confirm(`次の対局をカード${cardIndex + 1}に入れますか？\n${label}`)) return;
+      body = { ...body, p1_id: next.p1_id, p2_id: next.p2_id };
+    }
+
+    const res = await fetch("/api/waiting_queue/seat", {
+      method: "POST",
+      headers: liveHeaders(),
+      body: JSON.stringify(body)
+    });
+    const data = await res.json();
+    if (!res.ok || !data.success) {
+      if (body.p1_id) alert(data.message || "着席できませんでした。");
+      return;
+    }
+    await applyRemoteCardState(data.card);
+    await showMatchInfo(cardIndex);
+  } catch (e) {
+    console.warn("次の対局の提案に失敗:", e);
+  }
+}
+
+// ===== 対局結果の送信待ちキュー =====
+// 結果・昇段級を client_id 付きで localStorage に積み、/api/results/sync でまとめて送る。
+// サーバーは client_id で重複を判定するので、再送しても二重記録にならない。
+const RESULT_QUEUE_KEY = "taikyoku.pendingResults";
+let resultQueueFlush = null;  // 送信中の Promise（同時に2本走らせない）
+
+function loadResultQueue() {
+  try {
+    return JSON.parse(localStorage.getItem(RESULT_QUEUE_KEY) || "[]");
+  } catch (_) {
+    return [];
+  }
+}
+
+function saveResultQueue(queue) {
+  localStorage.setItem(RESULT_QUEUE_KEY, JSON.stringify(queue));
+  updateResultQueueStatus(queue.length);
+}
+
+function enqueueResultItem(item) {
+  const queue = loadResultQueue();
+  const entry = { ...item, client_id: item.client_id || newClientId(), date: window.today };
+  queue.push(entry);
+  saveResultQueue(queue);
+  return entry.client_id;
+}
+
+function updateResultQueueStatus(count) {
+  const el = document.getElementById("result-queue-status");
+  if (!el) return;
+  el.textContent = count > 0 ? `送信待ち ${count} 件` : "";
+  el.style.display = count > 0 ? "" : "none";
+}
+
+// 送信待ちをまとめて送る。戻り値：項目ごとの結果（通信できなければ null）
+async function flushResultQueue() {
+  // 送信中なら終わるのを待ってから、あらためて送る（直前に積んだ項目も確実に含める）
+  while (resultQueueFlush) {
+    await resultQueueFlush;
+  }
+  resultQueueFlush = sendResultQueueOnce();
+  try {
+    return await resultQueueFlush;
+  } finally {
+    resultQueueFlush = null;
+  }
+}
+
+async function sendResultQueueOnce() {
+  const queue = loadResultQueue();
+  if (!queue.length) return [];
+
+  // カード初期化の対象日をそろえるため、先頭と同じ日付の分だけ送る
+  const date = queue[0].date || window.today;
+  const batch = queue.filter(i => (i.date || window.today) === date);
+
+  try {
+    const res = await fetch("/api/results/sync", {
+      method: "POST",
+      headers: liveHeaders(),
+      body: JSON.stringify({ date, items: batch })
+    });
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    const data = await res.json();
+    if (!data.success) throw new Error(data.message || "sync failed");
+
+    (data.cards || []).forEach(rememberCardState);
+    const failed = (data.results || []).filter(r => r.status === "error");
+    if (failed.length) {
+      console.error("送信できなかった項目:", failed);
+    }
+
+    // 応答があった項目はキューから外す（error は再送しても直らないため破棄）
+    const answered = new Set((data.results || []).map(r => r.client_id));
+    saveResultQueue(loadResultQueue().filter(i => !answered.has(i.client_id)));
+    return data.results || [];
+  } catch (e) {
+    console.warn("送信待ちキューの送信に失敗（次回再送）:", e);
+    return null;
+  }
 }
 
+// 接続復帰時・定期的に再送
+window.addEventListener("online", () => { flushResultQueue(); });
+setInterval(() => { flushResultQueue(); }, 15000);
+
 // ✅ 二重送信ガード：同じカード index の保存を同時に走らせない
 const submittingMatches = new Set();
 
@@ -1463,30 +2057,49 @@ async function endMatch(index) {
         (participant.grade !== "未認定") &&
         (opponent?.grade === "未認定");
 
-      const checkRes = await fetch("/check_promotion", {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          player_id: winner.id,
-          next_win_half: nextWinIsHalf
-        })
-      });
+      let result = null;
+      try {
+        const checkRes = await fetch("/check_promotion", {
+          method: "POST",
+          headers: liveHeaders(),
+          body: JSON.stringify({
+            player_id: winner.id,
+            next_win_half: nextWinIsHalf
+          })
+        });
+        result = await checkRes.json();
+      } catch (e) {
+        // 通信断：昇段級判定はできないので結果の保存（キュー）を優先する
+        console.warn("昇段級チェックをスキップ（通信エラー）:", e);
+        continue;
+      }
 
-      const result = await checkRes.json();
       if (result?.success && result.promote && result.next_grade) {
         const reasonText = result.reason ? `条件「${result.reason}」` : "昇段（級）条件";
         const confirmed = confirm(`${participant.name} は ${reasonText} を満たしました。\n${result.next_grade} に昇段（級）させますか？`);
         if (confirmed) {
-          const res2 = await fetch("/api/promote_player", {
-            method: "POST",
-            headers: { "Content-Type": "application/json" },
-            body: JSON.stringify({
+          let pr = null;
+          try {
+            const res2 = await fetch("/api/promote_player", {
+              method: "POST",
+              headers: liveHeaders(),
+              body: JSON.stringify({
+                participant_id: winner.id,
+                new_grade: result.next_grade,
+                reason: result.reason || ""
+              })
+            });
+            pr = await res2.json();
+          } catch (e) {
+            // 通信断：昇段級も送信待ちキューへ（結果より先に並ぶので順序も保たれる）
+            enqueueResultItem({
+              kind: "promote",
               participant_id: winner.id,
               new_grade: result.next_grade,
               reason: result.reason || ""
-            })
-          });
-          const pr = await res2.json();
+            });
+            pr = { success: true, queued: true };
+          }
 
           if (pr && pr.success) {
             const target = allParticipants.find(p => p.id.toString() === winner.id.toString());
@@ -1499,8 +2112,9 @@ async function endMatch(index) {
             // 🔥 削除：gradeAtTime の上書きロジック
             // （対局開始時点の棋力は固定値のまま保持する）
 
-            await reloadParticipants();
-            alert("昇段級処理を完了しました。");
+            if (!pr.queued) await reloadParticipants();
+            alert(pr.queued ? "通信できないため昇段級を端末に保存しました（接続が戻り次第送信します）。"
+                            : "昇段級処理を完了しました。");
 
           } else {
             alert("昇段級に失敗しました：" + (pr?.message || ""));
@@ -1645,7 +2259,7 @@ function showShodanModal(index) {
 
     const res = await fetch("/api/promote_player", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: liveHeaders(),
       body: JSON.stringify({ participant_id: participantId, new_grade: newGrade, reason })
     });
 
@@ -1673,17 +2287,27 @@ function showShodanModal(index) {
 
 }
 
-async function reloadParticipants() {
-  const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
-
-  // 直近の並び順を維持（未設定ならデフォルトは 'grade' / 'asc' を想定）
-  const sortKey = (window.sortKey && typeof window.sortKey === "string") ? window.sortKey : "grade";
-  const sortOrder = (window.sortOrder === "desc" ? "desc" : "asc");
+// 取得中に頼まれた再取得は、今の取得が終わってから1回だけ行う
+let participantsFetch = null;
+let participantsRefetch = null;
 
-  // 並び順パラメータを明示的に渡す（← ここがポイント）
-  const participants = await fetchTodayParticipants(today, sortKey, sortOrder);
+function fetchParticipantsCoalesced() {
+  const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
+  if (!participantsFetch) {
+    participantsFetch = fetchTodayParticipants(today).finally(() => { participantsFetch = null; });
+    return participantsFetch;
+  }
+  if (!participantsRefetch) {
+    participantsRefetch = participantsFetch.catch(() => {}).then(() => {
+      participantsRefetch = null;
+      return fetchParticipantsCoalesced();
+    });
+  }
+  return participantsRefetch;
+}
 
-  // 🔽 対局カードをスキャンして再構築
+// 🔽 対局カードをスキャンして、参加者テーブルから除く人を作り直す
+function collectAssignedParticipantIds() {
   assignedParticipantIds.clear();
 
   // 指導員は本日の参加者テーブルから消さない（カード復元時の方針と合わせる）
@@ -1703,15 +2327,25 @@ async function reloadParticipants() {
     addIfNonInstructor(p1?.dataset.participantId);
     addIfNonInstructor(p2?.dataset.participantId);
   });
+}
+
+// 手元のデータのまま、カードの割当だけ反映して描き直す
+function refreshParticipantTable() {
+  collectAssignedParticipantIds();
+  renderParticipantTable(allParticipants);
+}
 
-  renderParticipantTable(participants);
+// 参加者データを取り直して描き直す（受付・昇段級など、データ自体が変わったとき）
+async function reloadParticipants() {
+  await fetchParticipantsCoalesced();
+  refreshParticipantTable();
 }
 
-// 🔽 並び替え処理（APIを呼び直して描画）
+// 🔽 並び替え処理（手元のデータを並べ替えて描画。サーバーへは取りに行かない）
 async function sortParticipants(key) {
   const url = new URL(window.location.href);
-  const currentSort = url.searchParams.get("sort") || "id";
-  const currentOrder = url.searchParams.get("order") || "asc";
+  const currentSort = url.searchParams.get("sort") || window.sortKey || "id";
+  const currentOrder = url.searchParams.get("order") || window.sortOrder || "asc";
 
   // 昇順⇔降順の切替
   const newOrder = (currentSort === key && currentOrder === "asc") ? "desc" : "asc";
@@ -1722,12 +2356,9 @@ async function sortParticipants(key) {
   // URLだけ更新（履歴残さず）
   window.history.replaceState(null, "", url);
 
-  // 並び替えたデータを再取得して描画
-  const today = window.today;
-  const sorted = await fetch(`/api/participants?date=${today}&sort=${key}&order=${newOrder}`);
-  const data = await sorted.json();
-  allParticipants = data; // 上書き
-  renderParticipantTable(data);
+  window.sortKey = key;
+  window.sortOrder = newOrder;
+  renderParticipantTable(allParticipants);
 }
 
 function onMatchTypeChange(select, index) {
@@ -1739,6 +2370,47 @@ function getMatchTypeValue(cardIndex) {
   return sel ? sel.value : "認定戦";
 }
 
+// ===== 本日のペア対局回数表 =====
+// { "<id>|<id>": { "認定戦": n, "初回認定": m, ... } }。記録済みの対局のみ
+let todayPairCounts = null;
+const countedMatchIds = new Set();   // SSE と自端末保存で二重加算しないため
+const RATED_MATCH_TYPES = ["認定戦", "初回認定"];
+
+function pairKey(a, b) {
+  const [x, y] = [String(a), String(b)].sort();
+  return `${x}|${y}`;
+}
+
+async function loadTodayPairCounts() {
+  try {
+    const today = window.today || new Date(Date.now() + 9 * 60 * 60 * 1000).toISOString().slice(0, 10);
+    const res = await fetch(`/api/today_pair_counts?date=${encodeURIComponent(today)}${roomQuery()}`);
+    const data = await res.json();
+    if (data?.success) todayPairCounts = data.pairs || {};
+  } catch (e) {
+    console.warn("ペア回数表の取得に失敗:", e);
+  }
+  return todayPairCounts;
+}
+
+// 結果保存（自端末・他端末）のたびに加算
+function addTodayPairCount(id1, id2, matchType, matchId = null) {
+  if (!id1 || !id2 || !matchType) return;
+  if (matchId !== null && matchId !== undefined) {
+    if (countedMatchIds.has(matchId)) return;
+    countedMatchIds.add(matchId);
+  }
+  if (!todayPairCounts) todayPairCounts = {};
+  const byType = todayPairCounts[pairKey(id1, id2)] ||= {};
+  byType[matchType] = (byType[matchType] || 0) + 1;
+}
+
+async function getTodayRatedPairCount(id1, id2) {
+  const counts = todayPairCounts || await loadTodayPairCounts() || {};
+  const byType = counts[pairKey(id1, id2)] || {};
+  return RATED_MATCH_TYPES.reduce((sum, t) => sum + Number(byType[t] || 0), 0);
+}
+
 // 本日認定系の同一ペア回数を問い合わせ、必要ならモーダル/確認を出す
 async function checkRepeatAndMaybeWarn(cardIndex) {
   try {
@@ -1752,13 +2424,8 @@ async function checkRepeatAndMaybeWarn(cardIndex) {
     const id2 = p2?.dataset.participantId;
     if (!id1 || !id2) return true;
 
-    // サーバに回数確認（JST当日、認定系・記録済のみを集計）
-    const res = await fetch(`/api/today_pair_count?p1=${encodeURIComponent(id1)}&p2=${encodeURIComponent(id2)}`);
-    const data = await res.json();
-
-    if (!data?.success) return true;
-
-    const count = Number(data.count || 0);
+    // 本日のペア回数表（初期表示で1回取得し、結果保存のたびに手元で加算）から認定系の回数を数える
+    const count = await getTodayRatedPairCount(id1, id2);
     if (count < 1) return true; // 初対局ならそのまま進行
 
     // 2回目以上 → モーダル（なければ confirm にフォールバック）
@@ -1853,7 +2520,7 @@ async function checkPromotionAndMaybePromote(index, payload) {
     // サーバに「次の1勝で昇段級か？」を問い合わせ
     const resp = await fetch("/check_promotion", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: liveHeaders(),
       body: JSON.stringify({
         player_id: winner.id,
         next_win_half: nextWinIsHalf
@@ -1867,7 +2534,7 @@ async function checkPromotionAndMaybePromote(index, payload) {
       if (confirmed) {
         const res2 = await fetch("/api/promote_player", {
           method: "POST",
-          headers: { "Content-Type": "application/json" },
+          headers: liveHeaders(),
           body: JSON.stringify({
             participant_id: winner.id,
             new_grade: result.next_grade,
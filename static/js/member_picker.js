@@ -0,0 +1,74 @@
+// 会員選択の入力補完：<select data-member-picker> の前に検索欄を置き、
+// 入力のたびに /api/members/search（よみがな・名前・会員IDの前方一致）で候補だけを読み込む。
+//   data-inactive="1" … 退会者も候補に含める
+// 候補の <option> には data-grade（棋力）を付ける（初回認定のチェックなどで使う）
+(function () {
+  const DEBOUNCE_MS = 150;
+
+  function optionLabel(m) {
+    return `${m.name}｜${m.kana}（${m.grade}）`;
+  }
+
+  function attach(select) {
+    if (select.disabled || select.dataset.pickerReady) return;
+    select.dataset.pickerReady = "1";
+
+    const input = document.createElement("input");
+    input.type = "search";
+    input.autocomplete = "off";
+    input.placeholder = "よみがな・名前・会員IDで検索";
+    input.style.display = "block";
+    input.style.marginBottom = "0.3rem";
+    input.style.minWidth = select.style.minWidth || "260px";
+    input.style.padding = "0.4rem";
+    select.parentNode.insertBefore(input, select);
+
+    // 先頭の「-- 選択 --」は残す
+    const placeholder = select.querySelector('option[value=""]');
+    let timer = null;
+    let controller = null;
+
+    function render(rows) {
+      const current = select.selectedOptions[0];
+      const keep = current && current.value ? current : null;
+      select.innerHTML = "";
+      if (placeholder) select.appendChild(placeholder);
+      if (keep && !rows.some(m => String(m.id) === keep.value)) select.appendChild(keep);
+      rows.forEach(m => {
+        const opt = document.createElement("option");
+        opt.value = m.id;
+        opt.dataset.grade = m.grade || "";
+        opt.textContent = optionLabel(m);
+        if (keep && keep.value === String(m.id)) opt.selected = true;
+        select.appendChild(opt);
+      });
+      // 候補が1件なら選んでおく（入力しきったとき）
+      if (!keep && rows.length === 1) select.value = String(rows[0].id);
+    }
+
+    async function search() {
+      const q = input.value.trim();
+      if (!q) return;
+      if (controller) controller.abort();  // 古い問い合わせは捨てる
+      controller = new AbortController();
+      const params = new URLSearchParams({ q });
+      if (select.dataset.inactive === "1") params.set("inactive", "1");
+      try {
+        const res = await fetch(`/api/members/search?${params}`, { signal: controller.signal });
+        if (!res.ok) return;
+        render(await res.json());
+      } catch (e) {
+        if (e.name !== "AbortError") console.warn("member search failed:", e);
+      }
+    }
+
+    input.addEventListener("input", () => {
+      clearTimeout(timer);
+      timer = setTimeout(search, DEBOUNCE_MS);
+    });
+  }
+
+  document.addEventListener("DOMContentLoaded", () => {
+    document.querySelectorAll("select[data-member-picker]").forEach(attach);
+  });
+})();